@@ -2,25 +2,120 @@
 This module contains functions for background correction. The different types are available via Enum BGCorrectionType.
 @author: Nathanael Jöhrmann
 """
+import warnings
 from enum import Enum, auto
-from functools import partial
-from typing import Optional
+from functools import partial, lru_cache
+from typing import Optional, Tuple, Dict, List
 
 import numpy as np
-from numpy.polynomial import Legendre
+from numpy.polynomial.legendre import legvander
 
 
-def subtract_mean_level(array2d: np.ndarray) -> np.ndarray:
+class BufferPool:
     """
-    Correct an offset in the array2d by subtracting the mean level.
+    Pool of preallocated ndarrays, that can be reused e.g. when correcting many measurements of the same shape.
+    Buffers are identified by shape, dtype and an optional key. Take note, that a new buffer is not initialized and
+    that its content might be overwritten, when the same buffer is requested again.
+
+    :InstanceAttributes:
+    nbytes: Total size of all buffers in the pool [bytes] (read-only property).
+    :EndInstanceAttributes:
+    """
+    def __init__(self):
+        self._buffers: Dict[tuple, np.ndarray] = {}
+
+    def get(self, shape: Tuple[int, ...], dtype=np.float64, key: str = "") -> np.ndarray:
+        """
+        Returns the buffer for shape, dtype and key (a new buffer is allocated only on the first request).
+        :param shape:
+        :param dtype: (default np.float64)
+        :param key: Optional name, used to distinguish buffers with the same shape and dtype.
+        :return: ndarray
+        """
+        buffer_key = (tuple(shape), np.dtype(dtype), key)
+        if buffer_key not in self._buffers:
+            self._buffers[buffer_key] = np.empty(shape, dtype=dtype)
+        return self._buffers[buffer_key]
+
+    def clear(self):
+        """Remove all buffers from pool."""
+        self._buffers.clear()
+
+    @property
+    def nbytes(self) -> int:
+        """Returns the total size of all buffers in the pool [bytes]."""
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+
+def _copy_to(array2d: np.ndarray, out: Optional[np.ndarray]) -> np.ndarray:
+    """Returns a copy of array2d (written into out, if out is not None)."""
+    if out is None:
+        return array2d.copy()
+    np.copyto(out, array2d)
+    return out
+
+
+def _check_out_dtype(out: Optional[np.ndarray], inplace: bool):
+    """Raise a TypeError, if the result of a background correction can not be written to out (no float array)."""
+    if out is not None and not np.issubdtype(out.dtype, np.floating):
+        raise TypeError(f"Background correction {'inplace' if inplace else 'with out'} needs a float array "
+                        f"(got dtype {out.dtype}).")
+
+
+def _subtract_product(array2d: np.ndarray, left: np.ndarray, right: np.ndarray,
+                      out: Optional[np.ndarray] = None, chunk_rows: int = 256) -> np.ndarray:
+    """
+    Returns array2d - left @ right. The product is calculated in chunks of rows, so no full size temporary array is
+    needed (out might also be array2d itself).
+    """
+    if out is None:
+        out = np.empty(array2d.shape, dtype=np.result_type(array2d.dtype, np.float64))
+    for start in range(0, array2d.shape[-2], chunk_rows):
+        rows = slice(start, start + chunk_rows)
+        np.subtract(array2d[..., rows, :], left[..., rows, :] @ right, out=out[..., rows, :])
+    return out
+
+
+def _contains_nan(array2d: np.ndarray) -> bool:
+    """Fast check for NaN values in array2d (without creating a boolean array)."""
+    return bool(np.isnan(np.sum(array2d)))
+
+
+def subtract_mean_level(array2d: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Correct an offset in the array2d by subtracting the mean level (NaN values are ignored).
     :param array2d:
+    :param out: optional array for the result (might be array2d itself)
     :return: ndarray
     """
-    result = array2d - array2d.mean()
+    mean = array2d.mean()
+    if np.isnan(mean):
+        mean = np.nanmean(array2d)
+    result = np.subtract(array2d, mean, out=out)
     return result
 
 
-def subtract_legendre_fit(array2d: np.ndarray, keep_offset: bool = False, deg: int = 1) -> Optional[np.ndarray]:
+@lru_cache(maxsize=32)
+def _legendre_basis(n: int, deg: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the legendre basis (pseudo-Vandermonde matrix for n points in [-1, 1] up to degree deg) and its
+    pseudo-inverse. Both are cached, because most measurements share the same shape and degree.
+    """
+    basis = legvander(np.linspace(-1, 1, n), deg)
+    pseudo_inverse = np.linalg.pinv(basis)
+    basis.flags.writeable = False
+    pseudo_inverse.flags.writeable = False
+    return basis, pseudo_inverse
+
+
+def _legendre_line_fit(values: np.ndarray, deg: int) -> np.ndarray:
+    """Least squares legendre fit of degree deg along the last axis of values, evaluated at the same points."""
+    basis, pseudo_inverse = _legendre_basis(values.shape[-1], deg)
+    return (values @ pseudo_inverse.T) @ basis.T
+
+
+def subtract_legendre_fit(array2d: np.ndarray, keep_offset: bool = False, deg: int = 1,
+                          out: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
     """
     Use a legendre polynomial fit of degree legendre_deg in X and Y direction to correct background.
     legendre_deg = 0 ... subtract mean value
@@ -28,53 +123,310 @@ def subtract_legendre_fit(array2d: np.ndarray, keep_offset: bool = False, deg: i
     legendre_deg = 2 ... subtract simple curved mean surface
     legendre_deg = 3 ... also corrects "s-shaped" distortion
     ...
+    array2d might also be a stack of arrays with the same shape (shape: n, rows, cols). In that case, all arrays
+    are corrected at once. If out is given, the result is written to out (which might be array2d itself).
     """
     if deg == 0 and keep_offset:
-        return array2d.copy()  # return a copy of input data
-    n_row = np.linspace(-1, 1, array2d.shape[0])
-    n_col = np.linspace(-1, 1, array2d.shape[1])
-    mean_row = array2d.mean(axis=1)
-    mean_col = array2d.mean(axis=0)
-
-    fit_x = Legendre.fit(n_row, mean_row, deg)
-    fit_y = Legendre.fit(n_col, mean_col, deg)
-
-    result = array2d.copy()
-    result = (result.transpose() - np.polynomial.legendre.legval(n_row, fit_x.coef)).transpose()
-    result = result - np.polynomial.legendre.legval(n_col, fit_y.coef)
+        return _copy_to(array2d, out)  # return a copy of input data
+    return _subtract_legendre_fit_of_means(array2d, array2d.mean(axis=-1), array2d.mean(axis=-2), keep_offset, deg,
+                                           out)
+
+
+def _subtract_legendre_fit_of_means(array2d: np.ndarray, mean_row: np.ndarray, mean_col: np.ndarray,
+                                    keep_offset: bool, deg: int, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """subtract_legendre_fit with already calculated row and column means"""
+    mean = mean_row.mean(axis=-1)[..., np.newaxis, np.newaxis]
+    fit_row = _legendre_line_fit(mean_row, deg)
+    fit_col = _legendre_line_fit(mean_col, deg)
+
+    result = np.subtract(array2d, fit_row[..., :, np.newaxis], out=out)
+    result -= fit_col[..., np.newaxis, :]
     if keep_offset:
-        result = result + 2 * array2d.mean()  # mean was subtracted 2 times (once for fit_x ans once for fit_y)
+        result += 2 * mean  # mean was subtracted 2 times (once for fit_x ans once for fit_y)
     else:
-        result = result + array2d.mean()
+        result += mean
     return result
 
 
-def subtract_mean_gradient_plane(array2d: np.ndarray, keep_offset: bool = False) -> Optional[np.ndarray]:
+@lru_cache(maxsize=32)
+def _legendre_orthonormal_basis(n: int, deg: int) -> np.ndarray:
+    """
+    Returns an orthonormal basis (QR factorization of the legendre basis) for n points in [-1, 1] up to degree deg.
+    Column i spans the same polynomials as the legendre polynomials up to degree i. The result is cached.
+    """
+    result, _ = np.linalg.qr(legvander(np.linspace(-1, 1, n), deg))
+    result.flags.writeable = False
+    return result
+
+
+@lru_cache(maxsize=32)
+def _polynomial_surface_basis(rows: int, cols: int, deg: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the orthonormal bases in row and column direction, and a mask selecting all terms x^i * y^j with
+    i + j <= deg. The tensor product of both bases restricted to the mask spans all 2D polynomials up to degree deg,
+    so the least squares fit is a projection on this basis. The result is cached for each shape and degree.
+    """
+    basis_row = _legendre_orthonormal_basis(rows, deg)
+    basis_col = _legendre_orthonormal_basis(cols, deg)
+    i, j = np.indices((basis_row.shape[1], basis_col.shape[1]))
+    term_mask = (i + j) <= deg
+    term_mask.flags.writeable = False
+    return basis_row, basis_col, term_mask
+
+
+def subtract_polynomial_surface_fit(array2d: np.ndarray, keep_offset: bool = False, deg: int = 1,
+                                    out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Use a least squares fit of a 2D polynomial surface of degree deg (all terms x^i * y^j with i + j <= deg,
+    including cross terms like x*y) to correct background. The needed factorization is calculated once for each
+    shape and degree and reused for all measurements.
+    array2d might also be a stack of arrays with the same shape (shape: n, rows, cols).
+    If out is given, the result is written to out (which might be array2d itself).
+    """
+    basis_row, basis_col, term_mask = _polynomial_surface_basis(array2d.shape[-2], array2d.shape[-1], deg)
+    return _subtract_surface_of_coefficients(array2d, basis_row.T @ array2d @ basis_col, basis_row, basis_col,
+                                             term_mask, keep_offset, out)
+
+
+def _subtract_surface_of_coefficients(array2d: np.ndarray, coefficients: np.ndarray, basis_row: np.ndarray,
+                                      basis_col: np.ndarray, term_mask: np.ndarray, keep_offset: bool,
+                                      out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    subtract_polynomial_surface_fit with already calculated coefficients. The bases might be of higher degree than
+    given by term_mask (the orthonormal bases are nested), so coefficients can be shared for several degrees.
+    """
+    n_row, n_col = term_mask.shape
+    basis_row, basis_col = basis_row[:, :n_row], basis_col[:, :n_col]
+    coefficients = coefficients[..., :n_row, :n_col] * term_mask
+    if keep_offset:
+        coefficients[..., 0, 0] = 0  # constant term is the mean value (all other terms have mean 0)
+    return _subtract_product(array2d, basis_row @ coefficients, basis_col.T, out)
+
+
+def _mean_gradient(array2d: np.ndarray, axis: int) -> float:
+    """
+    Returns the mean value of np.gradient(array2d)[axis] without creating the gradient array. The sum of the central
+    differences is a telescoping sum, so only the first and last two rows (columns) are needed.
+    """
+    values = np.moveaxis(array2d, axis, 0)
+    if values.shape[0] < 2:
+        raise ValueError("At least 2 values are needed along each axis to calculate a gradient.")
+    edge_sum = 1.5 * values[-1] - 0.5 * values[-2] + 0.5 * values[1] - 1.5 * values[0]
+    return edge_sum.sum() / array2d.size
+
+
+def subtract_mean_gradient_plane(array2d: np.ndarray, keep_offset: bool = False,
+                                 out: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
     """
     Returns 2d numpy.ndarray with subtracted mean gradient plane from given array2d. Using the gradient might give
      better results, when the measurement has asymmetric structures like large objects on a surface.
                                   _ _ _ _ _ _ _ _ _ _
     example: ____________________|                  |__
+    If out is given, the result is written to out (which might be array2d itself).
+    """
+    mean = array2d.mean()
+    try:
+        gradient_x, gradient_y = _mean_gradient(array2d, 0), _mean_gradient(array2d, 1)
+    except ValueError:
+        warnings.warn("subtract_mean_gradient_plane needs at least 2 values along each axis - "
+                      "only the mean value is subtracted.")
+        if keep_offset:
+            return _copy_to(array2d, out)
+        return np.subtract(array2d, mean, out=out)
+
+    result = _subtract_gradient_plane(array2d, gradient_x, gradient_y, out)
+    plane_mean = gradient_x * (array2d.shape[0] - 1) / 2 + gradient_y * (array2d.shape[1] - 1) / 2
+    if keep_offset:
+        result += plane_mean
+    else:
+        result -= mean - plane_mean
+    return result
+
+
+def nansubtract_mean_gradient_plane(array2d: np.ndarray, keep_offset: bool = False) -> Optional[np.ndarray]:
+    """
+    Same as subtract_mean_gradient_plane, but NaN values (e.g. padding in GDEFSticher.values) are ignored when
+    calculating the mean gradient and the mean level. NaN values stay NaN in the result.
+    """
+    return _subtract_masked_mean_gradient_plane(array2d, np.isnan(array2d), keep_offset)
+
+
+def _subtract_gradient_plane(array2d: np.ndarray, gradient_x: float, gradient_y: float,
+                             out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Subtract the plane nx * gradient_x + ny * gradient_y (nx, ny: pixel indices) from array2d."""
+    plane_x = np.arange(array2d.shape[0]) * gradient_x
+    plane_y = np.arange(array2d.shape[1]) * gradient_y
+    result = np.subtract(array2d, plane_x[:, np.newaxis], out=out)
+    result -= plane_y[np.newaxis, :]
+    return result
+
+
+def subtract_line_median(array2d: np.ndarray, keep_offset: bool = False,
+                         out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Line leveling: subtract the median value of each scan line (row) to remove line-to-line offsets.
+    array2d might also be a stack of arrays with the same shape (shape: n, rows, cols).
+    If out is given, the result is written to out (which might be array2d itself).
+    """
+    line_median = np.median(array2d, axis=-1, keepdims=True)
+    result = np.subtract(array2d, line_median, out=out)
+    if keep_offset:
+        result += line_median.mean(axis=(-2, -1), keepdims=True)
+    return result
+
+
+def subtract_line_fit(array2d: np.ndarray, keep_offset: bool = False, deg: int = 0,
+                      out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Line leveling: subtract a legendre polynomial fit of degree deg from each scan line (row).
+    deg = 0 ... subtract mean value of each line
+    deg = 1 ... subtract tilt of each line
+    ...
+    The fits of all lines are calculated at once (least squares with the cached pseudo-inverse of the legendre basis).
+    array2d might also be a stack of arrays with the same shape (shape: n, rows, cols).
+    If out is given, the result is written to out (which might be array2d itself).
+    """
+    basis, pseudo_inverse = _legendre_basis(array2d.shape[-1], deg)
+    mean = array2d.mean(axis=(-2, -1), keepdims=True)
+    result = _subtract_product(array2d, array2d @ pseudo_inverse.T, basis.T, out)
+    if keep_offset:
+        result += mean
+    return result
+
+
+def _subtract_masked_line_median(array2d: np.ndarray, mask: np.ndarray, keep_offset: bool = False) -> np.ndarray:
+    """Like subtract_line_median, but the median of each line is calculated without masked pixels."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)  # all pixels of a line masked
+        line_median = np.nanmedian(np.where(mask, np.nan, array2d), axis=-1, keepdims=True)
+    result = array2d - np.nan_to_num(line_median)
+    if keep_offset:
+        result += np.nanmean(array2d) - np.nanmean(result)
+    return result
+
+
+def _subtract_masked_line_fit(array2d: np.ndarray, mask: np.ndarray, keep_offset: bool = False,
+                              deg: int = 0) -> np.ndarray:
+    """
+    Like subtract_line_fit, but masked pixels are ignored for the fit. The weighted normal equations for all lines
+    are created and solved at once.
+    """
+    basis, _ = _legendre_basis(array2d.shape[-1], deg)
+    weights = (~mask).astype(float)
+    values = np.where(mask, 0, array2d)
+    matrices = np.einsum('rc,ci,cj->rij', weights, basis, basis)
+    vectors = np.einsum('rc,ci->ri', weights * values, basis)
+    coefficients = np.einsum('rij,rj->ri', np.linalg.pinv(matrices), vectors)
+    result = array2d - coefficients @ basis.T
+    if keep_offset:
+        result += np.nanmean(array2d) - np.nanmean(result)
+    return result
+
+
+def _weighted_fit_terms(shape: Tuple[int, int], deg: int,
+                        additive: bool) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the row and column factors (shape: rows x n_terms, cols x n_terms) of all terms used for a weighted fit.
+    If additive is True, only terms depending on x or y are used (like subtract_legendre_fit), else all terms
+    x^i * y^j with i + j <= deg (like subtract_polynomial_surface_fit).
+    """
+    basis_row = _legendre_orthonormal_basis(shape[0], deg)
+    basis_col = _legendre_orthonormal_basis(shape[1], deg)
+    i, j = np.indices((basis_row.shape[1], basis_col.shape[1]))
+    term_mask = (i * j == 0) if additive else (i + j <= deg)
+    return basis_row[:, i[term_mask]], basis_col[:, j[term_mask]]
+
+
+def _weighted_normal_equations(row_terms: np.ndarray, col_terms: np.ndarray,
+                               weights: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns matrix and vector of the weighted normal equations without creating the full design matrix."""
+    n_terms = row_terms.shape[1]
+    row_products = (row_terms[:, :, np.newaxis] * row_terms[:, np.newaxis, :]).reshape(-1, n_terms ** 2)
+    col_products = (col_terms[:, :, np.newaxis] * col_terms[:, np.newaxis, :]).reshape(-1, n_terms ** 2)
+    matrix = np.einsum('rk,rk->k', row_products, weights @ col_products).reshape(n_terms, n_terms)
+    vector = np.einsum('rt,rt->t', row_terms, (weights * values) @ col_terms)
+    return matrix, vector
+
+
+def subtract_weighted_fit(array2d: np.ndarray, weights: np.ndarray, keep_offset: bool = False, deg: int = 1,
+                          additive: bool = False, robust: bool = False, max_iterations: int = 30) -> np.ndarray:
     """
-    # result = array2d[:] # !!! slicing of np.ndarray only cretes viw, not copy !!!
-    result = array2d.copy()  # !!! slicing of np.ndarray only cretes viw, not copy !!!
+    Subtract a weighted least squares fit of a legendre polynomial of degree deg. Pixels with weight 0 (e.g. masked
+    indents or particles) are ignored for the fit, but corrected too.
+    If robust is True, the fit is repeated with iteratively reweighted least squares (Huber weights), reducing the
+    influence of outliers. Only the contributions of pixels whose weight changed are updated in the normal
+    equations for each iteration, so no full re-fit is necessary.
+    If keep_offset is False, the fitted surface (including its offset) is subtracted, so the fitted background is at
+    z = 0. Otherwise, the mean value of array2d is preserved.
 
+    :param array2d:
+    :param weights: ndarray with same shape as array2d (0 ... ignore pixel)
+    :param keep_offset:
+    :param deg: degree of legendre polynomial
+    :param additive: If True, fit a sum of polynomials in x and y (like subtract_legendre_fit), else a 2D polynomial
+     surface including cross terms (like subtract_polynomial_surface_fit).
+    :param robust: use iteratively reweighted least squares
+    :param max_iterations: max. number of iterations for robust fit
+    :return: ndarray
+    """
+    huber_k = 1.345
+    row_terms, col_terms = _weighted_fit_terms(array2d.shape, deg, additive)
+    valid = weights > 0
+    values = np.where(valid, array2d, 0)  # masked pixels might be NaN
+    matrix, vector = _weighted_normal_equations(row_terms, col_terms, weights, values)
+    coefficients = np.linalg.lstsq(matrix, vector, rcond=None)[0]
+
+    current_weights = weights.astype(float)
+    for _ in range(max_iterations if robust else 0):
+        residuals = values - (row_terms * coefficients) @ col_terms.T
+        valid_residuals = residuals[valid]
+        scale = 1.4826 * np.median(np.abs(valid_residuals - np.median(valid_residuals)))
+        if scale == 0:
+            break
+        huber_weights = np.minimum(1, huber_k * scale / np.maximum(np.abs(residuals), np.finfo(float).tiny))
+        new_weights = weights * huber_weights
+        changed = np.flatnonzero(new_weights != current_weights)
+        if changed.size == 0:
+            break
+        # update normal equations only with the changed pixels
+        changed_rows, changed_cols = np.unravel_index(changed, array2d.shape)
+        changed_terms = row_terms[changed_rows] * col_terms[changed_cols]
+        delta = (new_weights - current_weights).ravel()[changed]
+        matrix += changed_terms.T @ (delta[:, np.newaxis] * changed_terms)
+        vector += changed_terms.T @ (delta * values.ravel()[changed])
+        current_weights = new_weights
+
+        new_coefficients = np.linalg.lstsq(matrix, vector, rcond=None)[0]
+        converged = np.allclose(new_coefficients, coefficients, rtol=1e-8, atol=1e-8 * scale)
+        coefficients = new_coefficients
+        if converged:
+            break
+
+    result = array2d - (row_terms * coefficients) @ col_terms.T
+    if keep_offset:
+        result += np.nanmean(array2d) - np.nanmean(result)
+    return result
+
+
+def _subtract_masked_mean_gradient_plane(array2d: np.ndarray, mask: np.ndarray, keep_offset: bool = False):
+    """Like subtract_mean_gradient_plane, but the mean gradient (and offset) is calculated without masked pixels."""
     try:
         value_gradient = np.gradient(array2d)
     except ValueError:
-        print("ValueError in subtract_mean_gradient_plane")
+        warnings.warn("subtract_mean_gradient_plane needs at least 2 values along each axis - "
+                      "only the mean value is subtracted.")
+        result = array2d.astype(float)
         if not keep_offset:
-            result = result - result.mean()
+            result -= np.nanmean(np.where(mask, np.nan, result))
         return result
 
-    mean_value_gradient_x = value_gradient[0].mean()
-    mean_value_gradient_y = value_gradient[1].mean()
-    for (nx, ny), _ in np.ndenumerate(array2d):
-        result[nx, ny] = array2d[nx, ny] - nx * mean_value_gradient_x - ny * mean_value_gradient_y
+    gradient_x = np.nanmean(np.where(mask, np.nan, value_gradient[0]))
+    gradient_y = np.nanmean(np.where(mask, np.nan, value_gradient[1]))
+    result = _subtract_gradient_plane(array2d, gradient_x, gradient_y)
     if keep_offset:
-        result = result + (array2d.mean() - result.mean())
+        result += np.nanmean(array2d) - np.nanmean(result)
     else:
-        result = subtract_mean_level(result)
+        result -= np.nanmean(np.where(mask, np.nan, result))
     return result
 
 
@@ -89,36 +441,305 @@ class BGCorrectionType(Enum):
     legendre_2 = auto()
     legendre_3 = auto()
     raw_data = auto()
+    surface_1 = auto()
+    surface_2 = auto()
+    surface_3 = auto()
+    surface_4 = auto()
+    surface_5 = auto()
+    line_median = auto()
+    line_mean = auto()
+    line_legendre_1 = auto()
+    line_legendre_2 = auto()
+    line_legendre_3 = auto()
 
 
 # add all new BGCorrectionType here, so correct background works properly.
-# Each function has to accept two parameters, np.ndarray and bool and return np.ndarray.
+# Each function has to accept two parameters, np.ndarray and bool, and an optional keyword parameter out
+# (np.ndarray for the result, might be the input array itself) and return np.ndarray.
 correct_background_dict = {
     BGCorrectionType.gradient: subtract_mean_gradient_plane,
     BGCorrectionType.legendre_0: partial(subtract_legendre_fit, deg=0),
     BGCorrectionType.legendre_1: partial(subtract_legendre_fit, deg=1),
     BGCorrectionType.legendre_2: partial(subtract_legendre_fit, deg=2),
     BGCorrectionType.legendre_3: partial(subtract_legendre_fit, deg=3),
+    BGCorrectionType.surface_1: partial(subtract_polynomial_surface_fit, deg=1),
+    BGCorrectionType.surface_2: partial(subtract_polynomial_surface_fit, deg=2),
+    BGCorrectionType.surface_3: partial(subtract_polynomial_surface_fit, deg=3),
+    BGCorrectionType.surface_4: partial(subtract_polynomial_surface_fit, deg=4),
+    BGCorrectionType.surface_5: partial(subtract_polynomial_surface_fit, deg=5),
+    BGCorrectionType.line_median: subtract_line_median,
+    BGCorrectionType.line_mean: partial(subtract_line_fit, deg=0),
+    BGCorrectionType.line_legendre_1: partial(subtract_line_fit, deg=1),
+    BGCorrectionType.line_legendre_2: partial(subtract_line_fit, deg=2),
+    BGCorrectionType.line_legendre_3: partial(subtract_line_fit, deg=3),
+}
+
+
+# (deg, additive) used by subtract_weighted_fit for masked or robust background correction
+weighted_fit_dict = {
+    BGCorrectionType.legendre_0: (0, True),
+    BGCorrectionType.legendre_1: (1, True),
+    BGCorrectionType.legendre_2: (2, True),
+    BGCorrectionType.legendre_3: (3, True),
+    BGCorrectionType.surface_1: (1, False),
+    BGCorrectionType.surface_2: (2, False),
+    BGCorrectionType.surface_3: (3, False),
+    BGCorrectionType.surface_4: (4, False),
+    BGCorrectionType.surface_5: (5, False),
+}
+
+# degree of line fit for line leveling types (besides line_median)
+line_fit_dict = {
+    BGCorrectionType.line_mean: 0,
+    BGCorrectionType.line_legendre_1: 1,
+    BGCorrectionType.line_legendre_2: 2,
+    BGCorrectionType.line_legendre_3: 3,
+}
+
+# functions used for masked background correction, if correction type is not in weighted_fit_dict
+# Each function has to accept three parameters, np.ndarray, mask (np.ndarray) and bool and return np.ndarray.
+masked_correction_dict = {
+    BGCorrectionType.gradient: _subtract_masked_mean_gradient_plane,
+    BGCorrectionType.line_median: _subtract_masked_line_median,
+    BGCorrectionType.line_mean: partial(_subtract_masked_line_fit, deg=0),
+    BGCorrectionType.line_legendre_1: partial(_subtract_masked_line_fit, deg=1),
+    BGCorrectionType.line_legendre_2: partial(_subtract_masked_line_fit, deg=2),
+    BGCorrectionType.line_legendre_3: partial(_subtract_masked_line_fit, deg=3),
 }
 
 
 def correct_background(array2d: np.ndarray, correction_type: BGCorrectionType,
-                       keep_offset: bool = False) -> Optional[np.ndarray]:
+                       keep_offset: bool = False, mask: Optional[np.ndarray] = None,
+                       robust: bool = False, out: Optional[np.ndarray] = None,
+                       inplace: bool = False) -> Optional[np.ndarray]:
     """
-    Returns a numpy.ndarray with corrections given by parameters. Input array2d is not changed.
+    Returns a numpy.ndarray with corrections given by parameters. Input array2d is not changed (unless inplace=True).
+    NaN values (e.g. padding of stiched data) are ignored for the correction and stay NaN in the result.
+    Using mask, a region of interest (e.g. an indent) can be excluded from the fit. In that case, the background
+    outside the mask is set to z = 0 (if keep_offset is False). With robust=True, the fit is less sensitive to
+    outliers (iteratively reweighted least squares; only available for types in weighted_fit_dict).
+    Using out (a preallocated float array with the same shape as array2d) or inplace=True (write result to array2d,
+    which has to be a float array), no full size temporary arrays are created (except for masked or robust correction).
 
     :param array2d:
     :param correction_type:
     :param keep_offset:
+    :param mask: boolean ndarray with same shape as array2d; True ... pixel is ignored for fit (default None)
+    :param robust: use robust fit (default False)
+    :param out: optional array for the result
+    :param inplace: If True, array2d is overwritten with the result (default False).
     :return: ndarray
     """
     if array2d is None:
         return None
+    if inplace:
+        out = array2d
+    _check_out_dtype(out, inplace)
 
     if correction_type == BGCorrectionType.raw_data:
-        return array2d.copy()  # return a copy of input data - used in GDEFMeasurement class to restore original values
+        # return a copy of input data - used in GDEFMeasurement class to restore original values
+        return _copy_to(array2d, out)
+
+    contains_nan = _contains_nan(array2d)
+    if mask is None and not robust and not contains_nan:
+        return correct_background_dict[correction_type](array2d, keep_offset, out=out)
+
+    if mask is None:
+        mask = np.zeros(array2d.shape, dtype=bool)
+    if contains_nan:  # NaN values are handled like masked pixels
+        mask = mask | np.isnan(array2d)
+    if correction_type in weighted_fit_dict:
+        deg, additive = weighted_fit_dict[correction_type]
+        result = subtract_weighted_fit(array2d, (~mask).astype(float), keep_offset, deg, additive, robust)
+    elif robust:
+        raise ValueError(f"Robust fit is not available for {correction_type}")
+    else:
+        result = masked_correction_dict[correction_type](array2d, mask, keep_offset)
+    return result if out is None else _copy_to(result, out)
+
 
-    return correct_background_dict[correction_type](array2d, keep_offset)
+# BGCorrectionTypes in correct_background_dict, whose function also accepts a stack of arrays (shape: n, rows, cols)
+stack_correction_types = {
+    BGCorrectionType.legendre_0,
+    BGCorrectionType.legendre_1,
+    BGCorrectionType.legendre_2,
+    BGCorrectionType.legendre_3,
+    BGCorrectionType.surface_1,
+    BGCorrectionType.surface_2,
+    BGCorrectionType.surface_3,
+    BGCorrectionType.surface_4,
+    BGCorrectionType.surface_5,
+    BGCorrectionType.line_median,
+    BGCorrectionType.line_mean,
+    BGCorrectionType.line_legendre_1,
+    BGCorrectionType.line_legendre_2,
+    BGCorrectionType.line_legendre_3,
+}
+
+
+def correct_background_stack(stack: np.ndarray, correction_type: BGCorrectionType,
+                             keep_offset: bool = False, out: Optional[np.ndarray] = None,
+                             inplace: bool = False) -> Optional[np.ndarray]:
+    """
+    Same as correct_background, but for a stack of arrays with the same shape (shape: n, rows, cols).
+    Correction types in stack_correction_types are calculated for the whole stack with one call (no Python loop over
+    the arrays). All other types (and stacks containing NaN values) are corrected array by array.
+
+    :param stack: ndarray with shape (n, rows, cols)
+    :param correction_type:
+    :param keep_offset:
+    :param out: optional array for the result
+    :param inplace: If True, stack is overwritten with the result (default False).
+    :return: ndarray
+    """
+    if stack is None:
+        return None
+    if inplace:
+        out = stack
+    _check_out_dtype(out, inplace)
+
+    if correction_type in stack_correction_types and not _contains_nan(stack):
+        return correct_background_dict[correction_type](stack, keep_offset, out=out)
+
+    if out is None:
+        return np.stack([correct_background(array2d, correction_type, keep_offset) for array2d in stack])
+    for array2d, array2d_out in zip(stack, out):
+        correct_background(array2d, correction_type, keep_offset, out=array2d_out)
+    return out
+
+
+def correct_background_all(array2d: np.ndarray, correction_types: Optional[List[BGCorrectionType]] = None,
+                           keep_offset: bool = False) -> Dict[BGCorrectionType, np.ndarray]:
+    """
+    Returns a dict with the result of correct_background for each of the given correction_types. Intermediate results
+    (row and column means, surface and line fit coefficients) are calculated only once and shared between all
+    correction types (if array2d contains no NaN values). array2d might also be a stack of arrays with the same shape
+    (shape: n, rows, cols).
+
+    :param array2d:
+    :param correction_types: list of BGCorrectionType (default None -> all types)
+    :param keep_offset:
+    :return: dict {BGCorrectionType: ndarray}
+    """
+    if correction_types is None:
+        correction_types = list(BGCorrectionType)
+    if _contains_nan(array2d):  # NaN values need a weighted fit for each correction type
+        return {x: correct_background_stack(array2d, x, keep_offset) if array2d.ndim > 2
+                else correct_background(array2d, x, keep_offset) for x in correction_types}
+    rows, cols = array2d.shape[-2:]
+    mean_row = array2d.mean(axis=-1)
+    mean_col = array2d.mean(axis=-2)
+
+    surface_degs = [weighted_fit_dict[x][0] for x in correction_types
+                    if x in weighted_fit_dict and not weighted_fit_dict[x][1]]
+    if surface_degs:  # coefficients of the highest degree contain the coefficients of all lower degrees
+        basis_row, basis_col, _ = _polynomial_surface_basis(rows, cols, max(surface_degs))
+        surface_coefficients = basis_row.T @ array2d @ basis_col
+
+    line_degs = [line_fit_dict[x] for x in correction_types if x in line_fit_dict]
+    if line_degs:
+        line_basis = _legendre_orthonormal_basis(cols, max(line_degs))
+        line_coefficients = array2d @ line_basis
+
+    result = {}
+    for correction_type in correction_types:
+        if correction_type in weighted_fit_dict:
+            deg, additive = weighted_fit_dict[correction_type]
+            if additive and deg == 0 and keep_offset:
+                result[correction_type] = array2d.copy()
+            elif additive:
+                result[correction_type] = _subtract_legendre_fit_of_means(array2d, mean_row, mean_col,
+                                                                          keep_offset, deg)
+            else:
+                result[correction_type] = _subtract_surface_of_coefficients(
+                    array2d, surface_coefficients, basis_row, basis_col,
+                    _polynomial_surface_basis(rows, cols, deg)[2], keep_offset)
+        elif correction_type in line_fit_dict:
+            n_terms = line_fit_dict[correction_type] + 1
+            corrected = array2d - line_coefficients[..., :n_terms] @ line_basis[:, :n_terms].T
+            if keep_offset:
+                corrected += mean_row.mean(axis=-1)[..., np.newaxis, np.newaxis]
+            result[correction_type] = corrected
+        elif array2d.ndim > 2:
+            result[correction_type] = correct_background_stack(array2d, correction_type, keep_offset)
+        else:
+            result[correction_type] = correct_background(array2d, correction_type, keep_offset)
+    return result
+
+
+def _nan_slope(values: np.ndarray) -> np.ndarray:
+    """Returns the slope of a linear least squares fit along the last axis of values (NaN values are ignored)."""
+    valid = ~np.isnan(values)
+    index = np.broadcast_to(np.arange(values.shape[-1]), values.shape)
+    n_valid = valid.sum(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        index_centered = np.where(valid, index - (index * valid).sum(axis=-1, keepdims=True) / n_valid, 0)
+        values_centered = np.where(valid, values - np.nansum(values, axis=-1, keepdims=True) / n_valid, 0)
+        return (index_centered * values_centered).sum(axis=-1) / (index_centered ** 2).sum(axis=-1)
+
+
+def get_correction_quality(array2d: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Returns cheap quality metrics for background corrected data (NaN values are ignored):
+    rms ... root mean square roughness of array2d (after subtracting the mean value)
+    tilt_x, tilt_y ... residual tilt [z / pixel] (slope of row and column means; x along axis 0 like in np.gradient)
+    tilt ... absolute residual tilt
+    array2d might also be a stack of arrays with the same shape (shape: n, rows, cols).
+
+    :param array2d:
+    :return: dict with quality metrics
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)  # all-NaN rows or columns
+        mean = np.nanmean(array2d, axis=(-2, -1), keepdims=True)
+        tilt_x = _nan_slope(np.nanmean(array2d, axis=-1))
+        tilt_y = _nan_slope(np.nanmean(array2d, axis=-2))
+        rms = np.sqrt(np.nanmean((array2d - mean) ** 2, axis=(-2, -1)))
+    return {"rms": rms, "tilt_x": tilt_x, "tilt_y": tilt_y, "tilt": np.hypot(tilt_x, tilt_y)}
+
+
+# default candidates for select_best_background_correction, ordered by number of fitted parameters (1, 3, 5, 6, 7, 10)
+selection_correction_types = [
+    BGCorrectionType.legendre_0,
+    BGCorrectionType.legendre_1,
+    BGCorrectionType.legendre_2,
+    BGCorrectionType.surface_2,
+    BGCorrectionType.legendre_3,
+    BGCorrectionType.surface_3,
+]
+
+
+def select_best_background_correction(array2d: np.ndarray,
+                                      correction_types: Optional[List[BGCorrectionType]] = None,
+                                      metric: str = "rms",
+                                      tolerance: float = 0.05) -> Tuple[BGCorrectionType, Dict[BGCorrectionType, dict]]:
+    """
+    Corrects array2d with all given correction_types (see correct_background_all) and returns the first type (in the
+    order of correction_types), whose value for metric (see get_correction_quality) is at most (1 + tolerance) times
+    the lowest value of all types, together with the quality metrics of all types.
+    Take note, that the rms always decreases for more flexible corrections (e.g. higher polynomial degree), even if they
+    only fit noise or real structures. So with tolerance=0, the most flexible correction is chosen nearly always.
+    With tolerance > 0 and correction_types ordered from least to most flexible, a more flexible correction is only
+    chosen, if it reduces the metric noticeably. The default candidates (selection_correction_types) are ordered
+    this way and do not contain line leveling types (one fit per scan line).
+
+    :param array2d: 2D ndarray (correct each array of a stack separately)
+    :param correction_types: list of BGCorrectionType, ordered from least to most flexible
+     (default None -> selection_correction_types)
+    :param metric: "rms", "tilt", "tilt_x" or "tilt_y"
+    :param tolerance: relative tolerance for metric, used to prefer less flexible corrections (default 0.05)
+    :return: tuple (selected BGCorrectionType, {BGCorrectionType: quality dict})
+    """
+    if array2d.ndim != 2:
+        raise ValueError(f"select_best_background_correction needs a 2D array (got shape {array2d.shape}); "
+                         f"select the correction for each array of a stack separately.")
+    if correction_types is None:
+        correction_types = selection_correction_types
+    corrected_dict = correct_background_all(array2d, correction_types)
+    quality_dict = {key: get_correction_quality(value) for key, value in corrected_dict.items()}
+    best_value = min(abs(quality[metric]) for quality in quality_dict.values())
+    selected = next(x for x in correction_types if abs(quality_dict[x][metric]) <= (1 + tolerance) * best_value)
+    return selected, quality_dict
 
 
 # def average_over_x(array2d: np.ndarray)-> np.ndarray:
@@ -0,0 +1,188 @@
+"""
+This module contains the cross-correlation functions used to find the best overlap position when stiching measurements.
+@author: Nathanael Jöhrmann
+"""
+from typing import Tuple
+
+import numpy as np
+from scipy import signal
+
+correlation_methods = ["direct", "fft", "ncc", "ncc_plane"]
+normalized_methods = ["ncc", "ncc_plane"]
+
+
+def cross_correlate(data01: np.ndarray, data02: np.ndarray, method: str = "fft") -> np.ndarray:
+    """
+    Returns the full 2D cross-correlation of data01 and data02 (same result as scipy.signal.correlate2d(data01, data02)).
+    Positions, where a NaN value of data01 is part of the overlap, are NaN (like for the direct method). For the fft
+    method, the same is true for NaN values in data02 (the direct method returns only NaN in this case).
+    :param data01: 2D ndarray
+    :param data02: 2D ndarray
+    :param method: "direct" (scipy.signal.correlate2d), "fft" (much faster for large arrays), "ncc"
+                   (normalized cross-correlation, see normalized_cross_correlate) or "ncc_plane" (normalized
+                   cross-correlation after subtracting a plane from each overlap)
+    :return: ndarray with shape (data01.shape[0] + data02.shape[0] - 1, data01.shape[1] + data02.shape[1] - 1)
+    """
+    if method == "direct":
+        return signal.correlate2d(data01, data02)
+    if method in normalized_methods:
+        return normalized_cross_correlate(data01, data02, detrend=method == "ncc_plane")
+    if method != "fft":
+        raise ValueError(f"Unknown correlation method '{method}' (use one of {correlation_methods})")
+
+    nan01, nan02 = np.isnan(data01), np.isnan(data02)
+    result = signal.correlate(np.where(nan01, 0, data01), np.where(nan02, 0, data02), mode="full", method="fft")
+    if nan01.any() or nan02.any():
+        nan_count = np.zeros(result.shape)
+        if nan01.any():
+            nan_count += signal.correlate(nan01.astype(np.float64), np.ones(data02.shape), method="fft")
+        if nan02.any():
+            nan_count += signal.correlate(np.ones(data01.shape), nan02.astype(np.float64), method="fft")
+        result[nan_count > 0.5] = np.nan  # counts are integers; 0.5 avoids FFT rounding errors
+    return result
+
+
+def _summed_area_table(array2d: np.ndarray) -> np.ndarray:
+    """Returns the summed-area table of array2d with a leading row and column of zeros."""
+    result = np.zeros((array2d.shape[0] + 1, array2d.shape[1] + 1))
+    np.cumsum(np.cumsum(array2d, axis=0), axis=1, out=result[1:, 1:])
+    return result
+
+
+def _overlap_windows(shape01: Tuple[int, int], shape02: Tuple[int, int]):
+    """
+    Returns (start, stop) indices of the overlapping windows in data01 and data02 for all positions of the full
+    correlation: rows01, rows02 (arrays with shape (n, 1)) and cols01, cols02 (arrays with shape (1, m)).
+    """
+    result = []
+    for axis, shape in zip(range(2), [(-1, 1), (1, -1)]):
+        position = np.arange(shape01[axis] + shape02[axis] - 1) - shape02[axis] + 1
+        start01 = np.clip(position, 0, shape01[axis]).reshape(shape)
+        stop01 = np.clip(position + shape02[axis], 0, shape01[axis]).reshape(shape)
+        result.append((start01, stop01))
+        result.append((start01 - position.reshape(shape), stop01 - position.reshape(shape)))
+    return result
+
+
+def _window_sums(table: np.ndarray, rows: Tuple[np.ndarray, np.ndarray], cols: Tuple[np.ndarray, np.ndarray]):
+    """Returns the sums of all windows [row0:row1, col0:col1] using the summed-area table."""
+    (row0, row1), (col0, col1) = rows, cols
+    row_sums = table[row1.ravel()] - table[row0.ravel()]  # gathering whole rows first is much faster
+    return row_sums[:, col1.ravel()] - row_sums[:, col0.ravel()]
+
+
+def _window_first_moments(array2d: np.ndarray, sums: np.ndarray, rows: Tuple[np.ndarray, np.ndarray],
+                          cols: Tuple[np.ndarray, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the first moments sum((i - i_mean) * array2d) and sum((j - j_mean) * array2d) of all windows
+    [row0:row1, col0:col1] (i, j: row and column index; i_mean, j_mean: center of the window) using summed-area
+    tables. sums are the window sums of array2d.
+    """
+    (row0, row1), (col0, col1) = rows, cols
+    row_index, col_index = np.ogrid[:array2d.shape[0], :array2d.shape[1]]
+    row_moment = _window_sums(_summed_area_table(row_index * array2d), rows, cols) - (row0 + row1 - 1) / 2 * sums
+    col_moment = _window_sums(_summed_area_table(col_index * array2d), rows, cols) - (col0 + col1 - 1) / 2 * sums
+    return row_moment, col_moment
+
+
+def normalized_cross_correlate(data01: np.ndarray, data02: np.ndarray, min_overlap: int = 1,
+                               detrend: bool = False) -> np.ndarray:
+    """
+    Returns the full 2D normalized cross-correlation (Pearson correlation coefficient of the overlapping parts) of data01
+    and data02. Different offsets and z-scales of data01 and data02 have no influence, and positions with a small
+    overlap are not preferred (unlike the raw cross-correlation). Sums and squared sums of all overlapping windows
+    are calculated with summed-area tables, so the cost is similar to cross_correlate(method="fft").
+    If detrend is True, a least squares plane is subtracted from both overlapping parts before correlating them, so
+    different tilts of data01 and data02 have no influence either. The planes are calculated from first-moment sums
+    (summed-area tables too; the row and column index are orthogonal on each rectangular window).
+    Positions with a NaN value in the overlap, less than min_overlap (at least 2) overlapping pixels or a constant
+    (or plane, if detrend is True) overlap are NaN.
+    :param data01: 2D ndarray
+    :param data02: 2D ndarray
+    :param min_overlap: min. number of overlapping pixels (default 1)
+    :param detrend: If True, subtract a plane from each overlap (default False)
+    :return: ndarray with shape (data01.shape[0] + data02.shape[0] - 1, data01.shape[1] + data02.shape[1] - 1)
+    """
+    nan01, nan02 = np.isnan(data01), np.isnan(data02)
+    data01 = np.where(nan01, 0, data01 - np.nanmean(data01))  # subtracting the mean improves numerical precision
+    data02 = np.where(nan02, 0, data02 - np.nanmean(data02))
+    sum_product = signal.correlate(data01, data02, mode="full", method="fft")
+
+    rows01, rows02, cols01, cols02 = _overlap_windows(data01.shape, data02.shape)
+    n_rows, n_cols = rows01[1] - rows01[0], cols01[1] - cols01[0]
+    n = n_rows * n_cols
+    n_nan = _window_sums(_summed_area_table(nan01), rows01, cols01)
+    n_nan = n_nan + _window_sums(_summed_area_table(nan02), rows02, cols02)
+    sum01 = _window_sums(_summed_area_table(data01), rows01, cols01)
+    sum02 = _window_sums(_summed_area_table(data02), rows02, cols02)
+    square_sum01 = _window_sums(_summed_area_table(data01 ** 2), rows01, cols01)
+    square_sum02 = _window_sums(_summed_area_table(data02 ** 2), rows02, cols02)
+    covariance = sum_product - sum01 * sum02 / np.maximum(n, 1)
+    variance01 = square_sum01 - sum01 ** 2 / np.maximum(n, 1)
+    variance02 = square_sum02 - sum02 ** 2 / np.maximum(n, 1)
+
+    if detrend:  # remove the projections on the (orthogonal) row and column index of each window
+        moments01 = _window_first_moments(data01, sum01, rows01, cols01)
+        moments02 = _window_first_moments(data02, sum02, rows02, cols02)
+        index_square_sums = (n_cols * n_rows * (n_rows ** 2 - 1) / 12, n_rows * n_cols * (n_cols ** 2 - 1) / 12)
+        for moment01, moment02, index_square_sum in zip(moments01, moments02, index_square_sums):
+            index_square_sum = np.where(index_square_sum > 0, index_square_sum, np.inf)  # single row or column
+            covariance -= moment01 * moment02 / index_square_sum
+            variance01 -= moment01 ** 2 / index_square_sum
+            variance02 -= moment02 ** 2 / index_square_sum
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = covariance / np.sqrt(variance01 * variance02)
+    constant = (variance01 <= 1e-10 * square_sum01) | (variance02 <= 1e-10 * square_sum02)  # incl. rounding errors
+    result[(n_nan > 0.5) | (n < max(min_overlap, 2)) | constant] = np.nan
+    return result
+
+
+def _subtract_plane(array2d: np.ndarray) -> np.ndarray:
+    """Returns array2d minus its least squares plane (row and column index are orthogonal after centering)."""
+    rows, cols = np.ogrid[:array2d.shape[0], :array2d.shape[1]]
+    rows, cols = rows - (array2d.shape[0] - 1) / 2, cols - (array2d.shape[1] - 1) / 2
+    result = array2d - np.mean(array2d)
+    for index in (rows, cols):
+        index_square_sum = np.sum(index ** 2) * array2d.size / index.size
+        if index_square_sum > 0:
+            result = result - index * np.sum(index * result) / index_square_sum
+    return result
+
+
+def correlation_at_positions(data01: np.ndarray, data02: np.ndarray, positions, normalized: bool = False,
+                             min_overlap: int = 1, detrend: bool = False) -> np.ndarray:
+    """
+    Returns the cross-correlation of data01 and data02 only for the given positions (y, x) of data02 relative to data01.
+    The values are the same as cross_correlate(data01, data02)[y + data02.shape[0] - 1, x + data02.shape[1] - 1].
+    This is used to refine an offset in a small search window.
+    :param data01: 2D ndarray
+    :param data02: 2D ndarray
+    :param positions: iterable of (y, x)
+    :param normalized: If True, the normalized cross-correlation is returned (see normalized_cross_correlate).
+    :param min_overlap: min. number of overlapping pixels for normalized cross-correlation
+    :param detrend: If True, a plane is subtracted from each overlap for normalized cross-correlation.
+    :return: 1D ndarray
+    """
+    result = []
+    for y, x in positions:
+        row0, row1 = max(0, y), min(data01.shape[0], y + data02.shape[0])
+        col0, col1 = max(0, x), min(data01.shape[1], x + data02.shape[1])
+        if row0 >= row1 or col0 >= col1:  # no overlap
+            result.append(0.0)
+            continue
+        overlap01 = data01[row0:row1, col0:col1]
+        overlap02 = data02[row0 - y:row1 - y, col0 - x:col1 - x]
+        if not normalized:
+            result.append(np.sum(overlap01 * overlap02))
+            continue
+        if detrend:
+            overlap01, overlap02 = _subtract_plane(overlap01), _subtract_plane(overlap02)
+        else:
+            overlap01, overlap02 = overlap01 - np.mean(overlap01), overlap02 - np.mean(overlap02)
+        denominator = np.sqrt(np.sum(overlap01 ** 2) * np.sum(overlap02 ** 2))
+        if overlap01.size < max(min_overlap, 2) or not denominator > 0:
+            result.append(np.nan)
+        else:
+            result.append(np.sum(overlap01 * overlap02) / denominator)
+    return np.array(result, dtype=np.float64)
@@ -3,26 +3,105 @@ This module is used to analyze indents. Right now this includes ,indent area and
 z-min/max. Right now it is still early work in progress, and major changes are likely.
 @author: Nathanael Jöhrmann
 """
-from typing import List
+from functools import lru_cache
+from typing import List, Optional, Tuple
 
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.axes import Axes
+from scipy import ndimage
 
+from afm_tools.peak_utils import subpixel_minimum_positions
 from gdef_reader.gdef_measurement import GDEFMeasurement
 
 
+@lru_cache(maxsize=8)
+def _centered_distance_grid(shape: Tuple[int, int]) -> np.ndarray:
+    """
+    Returns the (read-only) distance [px] of each pixel of an array with shape (2 * rows - 1, 2 * cols - 1) to its
+    central pixel (rows - 1, cols - 1). The grids are cached for each shape (least recently used ones are evicted), so
+    analyzers of measurements with the same shape share them. Use _centered_distance_grid.cache_clear() to free the
+    memory.
+    """
+    rows, cols = np.ogrid[1 - shape[0]:shape[0], 1 - shape[1]:shape[1]]
+    result = np.hypot(rows, cols)
+    result.flags.writeable = False
+    return result
+
+
+def _pixel_distance_grid(shape: Tuple[int, int], center: Tuple[int, int]) -> np.ndarray:
+    """
+    Returns the (read-only) distance [px] of each pixel of an array with given shape to center (a pixel inside the
+    array). The result is a view of the cached grid for shape (see _centered_distance_grid), so no new grid is
+    created for a new center.
+    """
+    row_start, col_start = shape[0] - 1 - center[0], shape[1] - 1 - center[1]
+    return _centered_distance_grid(tuple(shape))[row_start:row_start + shape[0], col_start:col_start + shape[1]]
+
+
+def _label_minimum_positions(values: np.ndarray, labels: np.ndarray, label_ids) -> List[Tuple[int, int]]:
+    """
+    Like ndimage.minimum_position(values, labels, label_ids), but only the bounding box of each label (see
+    ndimage.find_objects) is searched instead of sorting all pixels.
+    """
+    slices = ndimage.find_objects(labels)
+    result = []
+    for label_id in label_ids:
+        window = slices[label_id - 1]
+        window_values = np.where(labels[window] == label_id, values[window], np.inf)
+        row, col = np.unravel_index(np.argmin(window_values), window_values.shape)
+        result.append((int(row + window[0].start), int(col + window[1].start)))
+    return result
+
+
+def _label_maxima(values: np.ndarray, labels: np.ndarray, n_labels: int) -> np.ndarray:
+    """
+    Like ndimage.maximum(values, labels, range(1, n_labels + 1)), but only the bounding box of each label (see
+    ndimage.find_objects) is searched instead of sorting all pixels.
+    """
+    result = np.zeros(n_labels)
+    for i, window in enumerate(ndimage.find_objects(labels, n_labels)):
+        if window is not None:
+            result[i] = np.max(values[window][labels[window] == i + 1])
+    return result
+
+
+def _contact_radius(radius: np.ndarray, profile: np.ndarray, surface_limit: float) -> float:
+    """Returns the radius, at which the radial profile first reaches surface_limit (linear interpolation)."""
+    above = np.nonzero(profile >= surface_limit)[0]
+    if len(above) == 0:
+        return float(radius[-1])
+    i = above[0]
+    if i == 0:
+        return 0.0
+    return float(radius[i - 1] + (surface_limit - profile[i - 1]) * (radius[i] - radius[i - 1])
+                 / (profile[i] - profile[i - 1]))
+
+
 class GDEFIndentAnalyzer:
     """
-    Class to analyze a GDEFMeasurment with an indent.
+    Class to analyze a GDEFMeasurment with an indent (or several indents, see detect_indents()).
+
+    The masks are set by analyze_indent(), detect_indents() or add_map_with_indent_pile_up_mask_to_axes().
+    They can be used e.g. as mask for GDEFMeasurement.correct_background().
 
     :InstanceAttributes:
     measurement: GDEFMeasurement with the indent to analyze.
+    radius: Radius [m] around the indent minimum, that is analyzed.
+    indent_mask: Boolean ndarray; True for pixels of the indent (None, if not analyzed yet).
+    pileup_mask: Boolean ndarray; True for pixels of the pile-up (None, if not analyzed yet).
+    surface_mask: Boolean ndarray; True for pixels within radius, that are neither indent nor pile-up.
+    label_mask: ndarray (uint8); 0 outside radius, else label_surface, label_indent or label_pileup (read-only property)
+    indent_labels: ndarray (int); number (1, 2, ...) of the indent within whose radius a pixel is, else 0 (set by
+    detect_indents(); analyze_indent() sets 1 for all pixels within radius).
+    indent: List of pixel indices of the indent (read-only property; derived from indent_mask).
+    pileup: List of pixel indices of the pile-up (read-only property; derived from pileup_mask).
+    surface: List of pixel indices of the surface (read-only property; derived from surface_mask).
     :EndInstanceAttributes:
     """
-    # speed optimization to reduce calculationtime of _is_pixel_in_radius()
-    pixel_radius_distance_matrix = {}
-    max_pixel_radius_value = 0
+    label_surface = 1
+    label_indent = 2
+    label_pileup = 3
 
     def __init__(self, measurement: GDEFMeasurement):
         """
@@ -30,73 +109,172 @@ class GDEFIndentAnalyzer:
         """
         self.measurement = measurement
         self.radius = 0
-        self.pileup = []
-        self.indent = []
-        self.surface = []
+        self.indent_mask: Optional[np.ndarray] = None
+        self.pileup_mask: Optional[np.ndarray] = None
+        self.surface_mask: Optional[np.ndarray] = None
+        self.indent_labels: Optional[np.ndarray] = None
 
         self.below_surface_limit = 0
         self.above_surface_limit = 0
 
-    @classmethod
-    def _check_pixel_radius_dict(cls):
-        if cls.pixel_radius_distance_matrix == {}:  # todo: or GDEFMeasurement.max_pixel_radius_value < self.settings...
-            for x in range(-255, 256):
-                for y in range(-255, 256):  # todo: symmetry???
-                    cls.pixel_radius_distance_matrix[x, y] = (x ** 2 + y ** 2) ** 0.5
-
-    def _is_pixel_in_radius(self, position, center, radius):
-        """Radius in [m]"""
-        # optimized for speed; do not introduce help variables, if not necessary
-        if self.measurement.settings._pixel_width * GDEFIndentAnalyzer.pixel_radius_distance_matrix[
-                (position[0] - center[0]), (position[1] - center[1])] <= radius:
-            return True
-        else:
-            return False
+    def _get_radius_mask(self, center, radius) -> np.ndarray:
+        """Returns a boolean mask of all pixels within radius [m] around center (pixel index)."""
+        distance = _pixel_distance_grid(self.measurement.values.shape, tuple(center))
+        return self.measurement.settings._pixel_width * distance <= radius
 
     def _calc_volume_with_radius(self):
-        self._check_pixel_radius_dict()
         minimum = np.min(self.measurement.values)
         if minimum is None:
             return 0
         self.radius = abs(7 * minimum)
-        minimum_position = self._get_minimum_position()
-        pixel_area = self.measurement.settings.pixel_area()
-        result = 0
-        for index, value in np.ndenumerate(self.measurement.values):
-            if self._is_pixel_in_radius(index, minimum_position, self.radius):
-                result += value * pixel_area
-        return result
+        radius_mask = self._get_radius_mask(self._get_minimum_position(), self.radius)
+        return np.sum(self.measurement.values[radius_mask]) * self.measurement.settings.pixel_area()
 
-    def _get_indent_pile_up_area_mask(self, roughness_part=0.05):
-        self._check_pixel_radius_dict()
-        minimum = np.min(self.measurement.values)
+    def analyze_indent(self, roughness_part=0.05):
+        """
+        Set radius, indent_mask, pileup_mask and surface_mask. Pixels within radius around the minimum belong to the
+        indent, if z < roughness_part \* z_min, and to the pile-up, if z > abs(roughness_part \* z_min).
+        :param roughness_part:
+        :return: None
+        """
+        values = self.measurement.values
+        minimum = np.min(values)
         self.radius = abs(7 * minimum)
-        minimum_position = self._get_minimum_position()
+        radius_mask = self._get_radius_mask(self._get_minimum_position(), self.radius)
 
         self.below_surface_limit = roughness_part * minimum
         self.above_surface_limit = abs(self.below_surface_limit)
 
-        result = np.zeros((self.measurement.values.shape[0], self.measurement.values.shape[1], 4))
-
-        for index, _ in np.ndenumerate(self.measurement.values):
-            if self._is_pixel_in_radius(index, minimum_position, self.radius):
-                if self.measurement.values[index] < self.below_surface_limit:
-                    result[index] = (0, 0, 1, 0.6)
-                    self.indent.append(index)
-                elif self.measurement.values[index] > self.above_surface_limit:
-                    result[index] = (0, 1, 0, 0.6)
-                    self.pileup.append(index)
-                    self.surface.append(index)
-                else:
-                    result[index] = (0, 0, 0, 0.1)
+        self.indent_mask = radius_mask & (values < self.below_surface_limit)
+        self.pileup_mask = radius_mask & ~self.indent_mask & (values > self.above_surface_limit)
+        self.surface_mask = radius_mask & ~self.indent_mask & ~self.pileup_mask
+        self.indent_labels = radius_mask.astype(np.int32)
+
+    def detect_indents(self, roughness_part=0.05, threshold_part=0.5, min_pixels=10) -> List[dict]:
+        """
+        Detect and analyze all indents in the measurement (e.g. an array of 3x3 indents). Indents are connected regions
+        with z < threshold_part \* z_min and at least min_pixels pixels. Every pixel is assigned to the nearest indent
+        minimum, and then classified like in analyze_indent(), using z_min and radius of this indent.
+        Sets indent_mask, pileup_mask, surface_mask (all indents) and indent_labels.
+        :param roughness_part: see analyze_indent()
+        :param threshold_part: z-threshold for indent detection as part of the global z_min (default 0.5)
+        :param min_pixels: min. number of pixels below threshold of an indent (smaller regions are ignored)
+        :return: list with a dict for each indent (keys like get_indent_result()), sorted by position
+        """
+        values = self.measurement.values
+        core_labels, n_cores = ndimage.label(values < threshold_part * np.min(values))
+        core_ids = np.nonzero(np.bincount(core_labels.ravel(), minlength=n_cores + 1)[1:] >= min_pixels)[0] + 1
+        if len(core_ids) == 0:
+            self.indent_mask = self.pileup_mask = self.surface_mask = np.zeros(values.shape, dtype=bool)
+            self.indent_labels = np.zeros(values.shape, dtype=np.int32)
+            return []
+        centers = sorted(_label_minimum_positions(values, core_labels, core_ids))
+        minima = np.array([values[center] for center in centers])
+
+        seeds = np.ones(values.shape, dtype=bool)
+        seeds[tuple(np.transpose(centers))] = False
+        distance, nearest = ndimage.distance_transform_edt(seeds, return_indices=True)
+        center_labels = np.zeros(values.shape, dtype=np.int32)
+        center_labels[tuple(np.transpose(centers))] = np.arange(1, len(centers) + 1)
+        nearest_labels = center_labels[nearest[0], nearest[1]]  # label of nearest indent for each pixel
+
+        local_minimum = minima[nearest_labels - 1]
+        radius = np.abs(7 * minima)
+        radius_mask = self.measurement.settings._pixel_width * distance <= radius[nearest_labels - 1]
+        below_surface_limit = roughness_part * local_minimum
+        self.indent_mask = radius_mask & (values < below_surface_limit)
+        self.pileup_mask = radius_mask & ~self.indent_mask & (values > np.abs(below_surface_limit))
+        self.surface_mask = radius_mask & ~self.indent_mask & ~self.pileup_mask
+        self.indent_labels = np.where(radius_mask, nearest_labels, 0)
+
+        # area and volume for all indents in one pass over the label image
+        n_labels = len(centers) + 1
+        pixel_area = self.measurement.settings.pixel_area()
+        abs_values = np.abs(values)
+        indent_labels = np.where(self.indent_mask, nearest_labels, 0).ravel()
+        pileup_labels = np.where(self.pileup_mask, nearest_labels, 0).ravel()
+        indent_area = np.bincount(indent_labels, minlength=n_labels)[1:] * pixel_area
+        indent_volume = np.bincount(indent_labels, abs_values.ravel(), minlength=n_labels)[1:] * pixel_area
+        pileup_area = np.bincount(pileup_labels, minlength=n_labels)[1:] * pixel_area
+        pileup_volume = np.bincount(pileup_labels, abs_values.ravel(), minlength=n_labels)[1:] * pixel_area
+        maxima = _label_maxima(values, self.indent_labels, len(centers))
+
+        # radial profiles of all indents (rings of 1 px width around the nearest indent) from one bincount
+        subpixel_centers = subpixel_minimum_positions(values, centers)
+        rows, cols = np.indices(values.shape, sparse=True)
+        rings = np.rint(np.hypot(rows - subpixel_centers[nearest_labels - 1, 0],
+                                 cols - subpixel_centers[nearest_labels - 1, 1])).astype(np.intp)
+        n_rings = int(rings.max()) + 1
+        ring_labels = (nearest_labels * n_rings + rings).ravel()
+        ring_counts = np.bincount(ring_labels, minlength=n_labels * n_rings).reshape(n_labels, n_rings)
+        ring_sums = np.bincount(ring_labels, values.ravel(), minlength=n_labels * n_rings).reshape(n_labels, n_rings)
+        contact_radius = []
+        for i in range(len(centers)):
+            valid = ring_counts[i + 1] > 0
+            contact_radius.append(_contact_radius(np.nonzero(valid)[0] * self.measurement.settings._pixel_width,
+                                                  ring_sums[i + 1, valid] / ring_counts[i + 1, valid],
+                                                  roughness_part * minima[i]))
+
+        return [{
+            "indent_id": i,
+            "center_row": float(subpixel_centers[i, 0]),
+            "center_col": float(subpixel_centers[i, 1]),
+            "z_min": float(minima[i]),
+            "z_max": float(maxima[i]),
+            "radius": float(radius[i]),
+            "surface_limit": float(abs(roughness_part * minima[i])),
+            "contact_radius": contact_radius[i],
+            "contact_area": np.pi * contact_radius[i] ** 2,
+            "indent_area": float(indent_area[i]),
+            "indent_volume": float(indent_volume[i]),
+            "pileup_area": float(pileup_area[i]),
+            "pileup_volume": float(pileup_volume[i])
+        } for i in range(len(centers))]
+
+    def _get_indent_pile_up_area_mask(self, roughness_part: Optional[float] = 0.05):
+        if roughness_part is not None:
+            self.analyze_indent(roughness_part)
+        values = self.measurement.values
+        result = np.zeros((values.shape[0], values.shape[1], 4))
+        result[self.surface_mask] = (0, 0, 0, 0.1)
+        result[self.indent_mask] = (0, 0, 1, 0.6)
+        result[self.pileup_mask] = (0, 1, 0, 0.6)
+        return result
+
+    @property
+    def label_mask(self) -> Optional[np.ndarray]:
+        if self.indent_mask is None:
+            return None
+        result = np.zeros(self.indent_mask.shape, dtype=np.uint8)
+        result[self.surface_mask] = self.label_surface
+        result[self.indent_mask] = self.label_indent
+        result[self.pileup_mask] = self.label_pileup
         return result
 
-    def add_map_with_indent_pile_up_mask_to_axes(self, ax: Axes, roughness_part=0.05) -> Axes:
+    @staticmethod
+    def _mask_to_index_list(mask: Optional[np.ndarray]) -> List[Tuple[int, int]]:
+        if mask is None:
+            return []
+        return [(int(row), int(col)) for row, col in zip(*np.nonzero(mask))]
+
+    @property
+    def indent(self) -> List[Tuple[int, int]]:
+        return self._mask_to_index_list(self.indent_mask)
+
+    @property
+    def pileup(self) -> List[Tuple[int, int]]:
+        return self._mask_to_index_list(self.pileup_mask)
+
+    @property
+    def surface(self) -> List[Tuple[int, int]]:
+        return self._mask_to_index_list(self.surface_mask)
+
+    def add_map_with_indent_pile_up_mask_to_axes(self, ax: Axes, roughness_part: Optional[float] = 0.05) -> Axes:
         """
         Add a topography map with a color mask for pile-up to the given ax. Pile-up is determined as all pixels with
         z>0 + roughness_part \* z_max
         :param ax: Axes object, to whitch the masked map should be added
-        :param roughness_part:
+        :param roughness_part: If None, the masks of the last analysis are used (e.g. restored from IndentResultCache).
         :return: Axes
         """
         data = self._get_indent_pile_up_area_mask(roughness_part=roughness_part)
@@ -104,49 +282,87 @@ class GDEFIndentAnalyzer:
         ax.imshow(data, cmap=plt.cm.Reds_r, interpolation='none', extent=extent)
         return ax
 
-    # def analyze_indent(self, roughness_part=0.05):
-        pass
-
-    def _calc_area_and_volume(self, index_list):
-        area = 0
-        volume = 0
-        for index in index_list:
-            area += self.measurement.settings.pixel_area()
-            volume += self.measurement.settings.pixel_area() * abs(self.measurement.values[index])
+    def _calc_area_and_volume(self, mask: Optional[np.ndarray]) -> Tuple[float, float]:
+        if mask is None:
+            return 0, 0
+        pixel_area = self.measurement.settings.pixel_area()
+        area = np.count_nonzero(mask) * pixel_area
+        volume = np.sum(np.abs(self.measurement.values[mask])) * pixel_area
         return area, volume
 
-    def get_summary_table_data(self) -> List[list]:  # todo: consider move method to utils.py
+    # todo: consider move method to utils.py
+    def get_summary_table_data(self, indent_result: Optional[dict] = None) -> List[list]:
         """
         Returns a table (list of lists) with data of the indent. The result can be used directly to fill a pptx-table
         with `python-ppxt-interface <https://github.com/natter1/python_pptx_interface/>`_.
+        :param indent_result: result dict (e.g. from IndentResultCache); default None -> get_indent_result()
         :return:
         """
-        indent_area, indent_volume = self._calc_area_and_volume(self.indent)
-        pileup_area, pileup_volume = self._calc_area_and_volume(self.pileup)
-
-        result = [["z min / max [m]", f"{self.measurement.values.min():.2e} / {self.measurement.values.max():.2e}"]]
+        if indent_result is None:
+            indent_result = self.get_indent_result()
+        result = [["z min / max [m]", f"{indent_result['z_min']:.2e} / {indent_result['z_max']:.2e}"]]
         # result.append(["maximum [m]", f"{self.measurement.values.max():.2e}"])
-        result.append(["radius [m]", f"{self.radius:.2e}"])
-        result.append(["surface limit [m]", f"+/- {self.above_surface_limit:.2e}"])
+        result.append(["radius [m]", f"{indent_result['radius']:.2e}"])
+        result.append(["surface limit [m]", f"+/- {indent_result['surface_limit']:.2e}"])
 
-        result.append(["indent area [m^2]", f"{indent_area:.2e}"])
-        result.append(["indent volume [m^3]", f"{indent_volume:.2e}"])
+        result.append(["indent area [m^2]", f"{indent_result['indent_area']:.2e}"])
+        result.append(["indent volume [m^3]", f"{indent_result['indent_volume']:.2e}"])
 
-        result.append(["pileup area [m^2]", f"{pileup_area:.2e}"])
-        result.append(["pileup volume [m^3]", f"{pileup_volume:.2e}"])
+        result.append(["pileup area [m^2]", f"{indent_result['pileup_area']:.2e}"])
+        result.append(["pileup volume [m^3]", f"{indent_result['pileup_volume']:.2e}"])
 
         return result
 
-    def _get_minimum_position(self):
-        # ---------------------------------------------------------------------------------------------------
-        # this makes code actually slower (not this method, but other code parts ^^); so do not use np.where:
-        # delme = np.where(self.values == np.amin(self.values))
-        # return delme[0][0], delme[1][0]
-        # ---------------------------------------------------------------------------------------------------
-        minimum = np.min(self.measurement.values)
-        minimum_position = (0, 0)
-        for index, value in np.ndenumerate(self.measurement.values):
-            if value == minimum:
-                minimum_position = index
-                break
-        return minimum_position
\ No newline at end of file
+    def get_indent_result(self) -> dict:
+        """
+        Returns a dict with the results of the last analysis (see analyze_indent): indent_id, center_row, center_col
+        (sub-pixel position of the minimum [px]), z_min, z_max, radius, surface_limit, contact_radius [m], contact_area,
+        indent_area, pileup_area [m^2] and indent_volume, pileup_volume [m^3]. contact_radius is the radius, at which
+        the radial profile (see get_radial_profile) reaches -surface_limit.
+        :return: dict
+        """
+        indent_area, indent_volume = self._calc_area_and_volume(self.indent_mask)
+        pileup_area, pileup_volume = self._calc_area_and_volume(self.pileup_mask)
+        center = self.get_subpixel_minimum_position()
+        contact_radius = _contact_radius(*self.get_radial_profile(center), self.below_surface_limit)
+        return {
+            "indent_id": 0,
+            "center_row": float(center[0]),
+            "center_col": float(center[1]),
+            "z_min": float(self.measurement.values.min()),
+            "z_max": float(self.measurement.values.max()),
+            "radius": float(self.radius),
+            "surface_limit": float(self.above_surface_limit),
+            "contact_radius": contact_radius,
+            "contact_area": np.pi * contact_radius ** 2,
+            "indent_area": float(indent_area),
+            "indent_volume": float(indent_volume),
+            "pileup_area": float(pileup_area),
+            "pileup_volume": float(pileup_volume)
+        }
+
+    def get_subpixel_minimum_position(self) -> Tuple[float, float]:
+        """Returns the position of the minimum [px] refined by a local parabola fit (see subpixel_minimum_positions)."""
+        row, col = subpixel_minimum_positions(self.measurement.values, self._get_minimum_position())[0]
+        return float(row), float(col)
+
+    def get_radial_profile(self, center: Optional[Tuple[float, float]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the radial profile around center, averaged over rings with a width of 1 pixel.
+        :param center: center [px] (default: get_subpixel_minimum_position())
+        :return: radius [m] and mean z [m] of each ring
+        """
+        values = self.measurement.values
+        if center is None:
+            center = self.get_subpixel_minimum_position()
+        rows, cols = np.ogrid[:values.shape[0], :values.shape[1]]
+        rings = np.rint(np.hypot(rows - center[0], cols - center[1])).astype(np.intp).ravel()
+        counts = np.bincount(rings)
+        sums = np.bincount(rings, values.ravel())
+        valid = counts > 0
+        return np.nonzero(valid)[0] * self.measurement.settings._pixel_width, sums[valid] / counts[valid]
+
+    def _get_minimum_position(self) -> Tuple[int, int]:
+        """Returns the index of the (first) minimum of measurement.values."""
+        values = self.measurement.values
+        return tuple(int(i) for i in np.unravel_index(np.argmin(values), values.shape))
@@ -1,16 +1,132 @@
 """
 @author: Nathanael Jöhrmann
 """
+import hashlib
+import json
+import os
+import tempfile
 import warnings
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple, Union
 
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.figure import Figure
-from scipy import signal
 
+from afm_tools.background_correction import BGCorrectionType, correct_background
+from afm_tools.correlation import cross_correlate, correlation_at_positions, normalized_cross_correlate, \
+    normalized_methods
+from afm_tools.peak_utils import subpixel_minimum_positions
+from afm_tools.tiled_pyramid import TiledPyramid, downsample_nanmean
 from gdef_reader.gdef_measurement import GDEFMeasurement
 
+blending_modes = ["last", "mean", "feather", "distance"]
+
+
+@lru_cache(maxsize=8)
+def _blending_weights(shape: Tuple[int, int], blending: str) -> np.ndarray:
+    """
+    Returns the (read-only) weight of each pixel of an array with given shape for compose_mosaic. The weights
+    are cached, so measurements with the same shape share them.
+    """
+    ramp_y = np.minimum(np.arange(1, shape[0] + 1), np.arange(shape[0], 0, -1))  # distance to edge + 1 [px]
+    ramp_x = np.minimum(np.arange(1, shape[1] + 1), np.arange(shape[1], 0, -1))
+    if blending == "mean":
+        result = np.ones(shape)
+    elif blending == "feather":
+        result = np.outer(ramp_y, ramp_x).astype(np.float64)
+    else:  # "distance"
+        result = np.minimum.outer(ramp_y, ramp_x).astype(np.float64)
+    result.flags.writeable = False
+    return result
+
+
+def _resample_subpixel(array2d: np.ndarray, y_fraction: float, x_fraction: float) -> np.ndarray:
+    """
+    Returns array2d shifted by (y_fraction, x_fraction) pixels (0 <= fraction < 1) using bilinear interpolation.
+    For each axis with a fraction > 0, the first row/column is lost (the result starts one pixel later).
+    """
+    result = array2d
+    for axis, fraction in enumerate([y_fraction, x_fraction]):
+        if fraction > 0:
+            first, last = [slice(None)] * 2, [slice(None)] * 2
+            first[axis], last[axis] = slice(1, None), slice(None, -1)
+            result = (1 - fraction) * result[tuple(first)] + fraction * result[tuple(last)]
+    return result
+
+
+def compose_mosaic(arrays: Sequence[np.ndarray], positions, filename: Optional[Union[str, Path]] = None,
+                   blending: str = "last") -> np.ndarray:
+    """
+    Returns a new array containing all arrays at the given positions. The result is allocated once with the
+    bounding box of all arrays, areas not covered by any array are NaN. Overlapping areas are combined depending on
+    blending:
+
+    * "last": later arrays are on top (hard seams, fastest)
+    * "mean": mean value of all overlapping arrays
+    * "feather": weighted mean; the weight decreases linearly towards the edges (product of distances to the
+      nearest edge in x and y)
+    * "distance": weighted mean; the weight is the min. distance to the edge of the array
+
+    For blending other than "last", weighted values and weights are accumulated in two canvases (NaN values have
+    weight 0), and the result is their ratio.
+    If filename is given, the result is a np.memmap stored in this \*.npy file (for mosaics larger than the memory).
+    In this case, the weight canvas is a temporary memory-mapped file in the same folder, too.
+    Positions can be sub-pixel values. In this case, the arrays are resampled with bilinear interpolation
+    (arrays at whole pixel positions relative to the first array are not resampled).
+    :param arrays: list of 2D np.ndarray
+    :param positions: (row, col) of the upper left corner of each array (shifted by whole pixels, so that min. is 0)
+    :param filename: optional \*.npy file for a disk-backed result (default None -> result in memory)
+    :param blending: "last" (default), "mean", "feather" or "distance"
+    :return: np.ndarray (2D)
+    """
+    if blending not in blending_modes:
+        raise ValueError(f"Unknown blending '{blending}' (use one of {blending_modes})")
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    positions = positions - np.floor(positions.min(axis=0))
+    pixel_positions = np.floor(positions).astype(int)
+    fractions = positions - pixel_positions
+    arrays = [_resample_subpixel(array2d, *fraction) for array2d, fraction in zip(arrays, fractions)]
+    pixel_positions += fractions > 0  # resampled arrays start one pixel later
+    shapes = np.array([array2d.shape for array2d in arrays])
+    shape = tuple(int(x) for x in (pixel_positions + shapes).max(axis=0))
+    if filename is None:
+        result = np.empty(shape)
+    else:
+        result = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64, shape=shape)
+
+    if blending == "last":
+        result[:] = np.nan
+        for array2d, (row, col) in zip(arrays, pixel_positions):
+            result[row:row + array2d.shape[0], col:col + array2d.shape[1]] = array2d
+    else:
+        result[:] = 0  # sum of weighted values
+        weight_filename = None
+        if filename is None:
+            weight_sum = np.zeros(shape, dtype=np.float32)
+        else:
+            file_descriptor, weight_filename = tempfile.mkstemp(suffix=".npy", dir=Path(filename).parent)
+            os.close(file_descriptor)
+            weight_sum = np.lib.format.open_memmap(weight_filename, mode='w+', dtype=np.float32, shape=shape)
+        try:
+            for array2d, (row, col) in zip(arrays, pixel_positions):
+                valid = ~np.isnan(array2d)
+                weights = np.where(valid, _blending_weights(array2d.shape, blending), 0)
+                region = (slice(row, row + array2d.shape[0]), slice(col, col + array2d.shape[1]))
+                result[region] += weights * np.where(valid, array2d, 0)
+                weight_sum[region] += weights
+            with np.errstate(divide='ignore', invalid='ignore'):
+                np.divide(result, weight_sum, out=result)  # 0 / 0 -> NaN for areas without data
+        finally:
+            if weight_filename is not None:
+                del weight_sum  # release memory map before deleting its file
+                os.remove(weight_filename)
+    if filename is not None:
+        result.flush()
+    return result
+
 
 class GDEFSticher:
     """
@@ -18,58 +134,282 @@ class GDEFSticher:
     To reduce calculation time, the best overlap position is only searched in a fraction of the measurement area
     (defined by parameter initial_x_offset_fraction), and each measutrement is added to the right side.
     Make sure the given list of measurements is ordered from left to right, otherwise wrong results are to be expected.
+    The offsets of all neighbouring measurements are searched first (in a thread pool), then the stiched data is
+    allocated and filled once. To stich very large mosaics, canvas_filename can be used to store values
+    in a memory-mapped \*.npy file.
+    The offsets can be saved in a JSON file (see offsets_filename), so stiching the same measurements with the same
+    parameters again (e.g. after a different background correction) needs no cross-correlation. To stich another
+    channel of the same measurements, use from_offsets() with pair_offsets of the first sticher.
+
+    .. code:: python
+
+        topography = GDEFSticher(topography_measurements, method="ncc", offsets_filename="offsets.json")
+        phase = GDEFSticher.from_offsets(phase_measurements, topography.pair_offsets)
+
     To evaluate the stiching, show_control_figures can be set to True. This creates a summary image
     for each stiching step (using matplotlib plt.show()).
 
     :InstanceAttributes:
     measurements: list of GDEFMeasurements used for stiching
+    method: cross-correlation method ("fft", "direct", "ncc" or "ncc_plane", see afm_tools.correlation.cross_correlate).
+    "ncc" (normalized cross-correlation) is more robust for measurements with different z-offsets or z-scales,
+    "ncc_plane" also for measurements with different tilts (a plane is subtracted from each overlap).
+    For "ncc" and "ncc_plane", the overlap has to be at least ncc_min_overlap_fraction of the searched area.
+    n_levels: Number of resolution levels used to find the offsets (1 ... full resolution only). The offset is
+    searched on data downsampled by 2**(n_levels-1) and then refined at each finer level within +/- refine_radius px.
+    Fewer levels are used, if the searched area of the coarsest level would be smaller than coarse_min_size px per
+    axis (or for normalized methods, if the min. overlap of the coarsest level would be smaller than coarse_min_size px).
+    subpixel: If True, offsets are refined to sub-pixel values by a parabola fit to the normalized cross-correlation
+    around the peak, and measurements are placed with bilinear interpolation (see compose_mosaic).
+    max_workers: max. number of threads used to search the pairwise offsets (default None -> ThreadPoolExecutor default)
+    canvas_filename: If not None, values is a np.memmap stored in this \*.npy file.
+    pair_offsets: list of (i, j, y, x): position (y, x) of measurements[j] relative to measurements[i]
+    positions: np.ndarray (n, 2) with the position (row, col) of each measurement in values (float, if subpixel)
+    blending: How overlapping measurements are combined ("last", "mean", "feather" or "distance", see compose_mosaic).
+    initial_x_offset_fraction: Fraction of the measurement size, in which the offsets are searched.
+    offsets_filename: If not None, pair_offsets are loaded from (or saved to) this JSON file (see save_offsets).
     values: np.ndarray with stiched data
     pixel_width: Pixel width taken from first GDEFMeasurement in measurements (varying pixel sizes are not supported).
     :EndInstanceAttributes:
     """
+    refine_radius = 2
+    ncc_min_overlap_fraction = 0.1
+    coarse_min_size = 16
+    offsets_version = 1  # increase, if offsets in saved files are not valid anymore
 
     def __init__(self, measurements: List[GDEFMeasurement],
-                 initial_x_offset_fraction: float = 0.35, show_control_figures: bool = False):
+                 initial_x_offset_fraction: float = 0.35, show_control_figures: bool = False, method: str = "fft",
+                 n_levels: int = 1, subpixel: bool = False, max_workers: Optional[int] = None,
+                 canvas_filename: Optional[Union[str, Path]] = None, blending: str = "last",
+                 offsets_filename: Optional[Union[str, Path]] = None, pair_offsets: Optional[list] = None):
         """
         :param measurements:
         :param initial_x_offset_fraction: used to specify max. overlap area, thus increasing speed and reducing risk of wrong stiching
         :param show_control_figures:
+        :param method: cross-correlation method "fft" (default), "direct" (same offsets as "fft"), "ncc" (normalized)
+         or "ncc_plane" (normalized, plane subtracted from each overlap)
+        :param n_levels: number of resolution levels for coarse-to-fine offset search (default 1 -> full resolution)
+        :param subpixel: If True, sub-pixel offsets are used (default False)
+        :param max_workers: max. number of threads used to search the pairwise offsets
+        :param canvas_filename: optional \*.npy file for disk-backed values (default None -> values in memory)
+        :param blending: "last" (default; later measurements on top), "mean", "feather" or "distance"
+        :param offsets_filename: optional JSON file to load pair_offsets from or save them to
+        :param pair_offsets: known pair_offsets (no cross-correlation is calculated; see from_offsets)
         """
         self.measurements = measurements
+        self.method = method
+        self.n_levels = n_levels
+        self.subpixel = subpixel
+        self.max_workers = max_workers
+        self.canvas_filename = canvas_filename
+        self.blending = blending
+        self.initial_x_offset_fraction = initial_x_offset_fraction
+        self.offsets_filename = offsets_filename
+        self.pair_offsets: List[Tuple[int, int, float, float]] = []
+        self.positions: Optional[np.ndarray] = None
         self.values = None
         self.pixel_width = self.measurements[0].settings.pixel_width
         for measurement in self.measurements:
             if measurement.settings.pixel_width != self.pixel_width:
                 warnings.warn(f"Measurement {measurement.name} has a different pixel_width than used for GDEFSticher!")
 
-        self.stich(initial_x_offset_fraction, show_control_figures)
+        if pair_offsets is None:
+            self.stich(initial_x_offset_fraction, show_control_figures)
+        else:
+            self.pair_offsets = [tuple(pair_offset) for pair_offset in pair_offsets]
+            self.compose()
+
+    @classmethod
+    def from_offsets(cls, measurements, pair_offsets: list, subpixel: bool = False,
+                     canvas_filename: Optional[Union[str, Path]] = None, blending: str = "last"):
+        """
+        Create a sticher from known pair_offsets without any cross-correlation, e.g. to stich another channel
+        (phase, amplitude ...) of the same measurements with the pair_offsets of a topography sticher.
+        :param measurements: list of GDEFMeasurement (grid for GDEFGridSticher); same order as used for pair_offsets
+        :param pair_offsets: list of (i, j, y, x) (see pair_offsets)
+        :param subpixel: If False (default), positions are rounded to whole pixels.
+        :param canvas_filename: optional \*.npy file for disk-backed values (default None -> values in memory)
+        :param blending: "last" (default; later measurements on top), "mean", "feather" or "distance"
+        :return: GDEFSticher (or subclass)
+        """
+        return cls(measurements, subpixel=subpixel, canvas_filename=canvas_filename, blending=blending,
+                   pair_offsets=pair_offsets)
 
     def stich(self, initial_x_offset_fraction: float = 0.35, show_control_figures: bool = False) -> np.ndarray:
         """
-        Stiches a list of GDEFMeasurement.values using cross-correlation.
+        Stiches a list of GDEFMeasurement.values using cross-correlation. First, the offsets of all neighbouring
+        measurements are searched (see pair_offsets), or loaded from offsets_filename if possible. Then the
+        positions are calculated, and the stiched data is allocated and filled once (see compose).
         :param initial_x_offset_fraction: used to specify max. overlap area, thus increasing speed and reducing risk of wrong stiching
+        :param show_control_figures:
         :return: stiched np.ndarray
         """
-        result = self.measurements[0].values
-        x_offset_right = round(result.shape[1] * initial_x_offset_fraction)
-        for measurement in self.measurements[1:]:
-            result = self._stich(result, measurement.values, result.shape[1] - x_offset_right, show_control_figures)
-        self.values = result
-        return result
+        self.initial_x_offset_fraction = initial_x_offset_fraction
+        pair_offsets = None if self.offsets_filename is None else self.load_offsets(self.offsets_filename)
+        if pair_offsets is not None:
+            self.pair_offsets = pair_offsets
+            return self.compose()
+
+        pairs = self._neighbour_pairs()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:  # FFTs release the GIL
+            offsets = list(executor.map(lambda pair: self._find_pair_offset(*pair, initial_x_offset_fraction), pairs))
+        self.pair_offsets = [(i, j, y, x) for (i, j, _), (y, x, _) in zip(pairs, offsets)]
+        if self.offsets_filename is not None:
+            self.save_offsets(self.offsets_filename)
+        self.compose()
+
+        if show_control_figures:
+            for (i, j, _), (y, x, correlation) in zip(pairs, offsets):
+                data01, data02 = self.measurements[i].values, self.measurements[j].values
+                self._create_stich_control_figure(data01, data02, correlation, self._combine(data01, data02, y, x))
+                plt.show()
+        return self.values
+
+    def compose(self) -> np.ndarray:
+        """
+        Calculates positions from pair_offsets and composes values from the current GDEFMeasurement.values without
+        any cross-correlation (e.g. after a new background correction of the measurements or a change of blending).
+        :return: stiched np.ndarray
+        """
+        self.positions = self.solve_positions(len(self.measurements), self.pair_offsets, not self.subpixel)
+        self.values = compose_mosaic([measurement.values for measurement in self.measurements], self.positions,
+                                     self.canvas_filename, self.blending)
+        return self.values
+
+    def offsets_key(self) -> str:
+        """
+        Returns the key for pair_offsets in an offsets file. It depends on values_original of all measurements
+        (not on their background correction), the order of the measurements and all parameters of the offset search.
+        """
+        key_hash = hashlib.sha1()
+        for measurement in self.measurements:
+            values_original = np.ascontiguousarray(measurement.values_original)
+            key_hash.update(values_original.tobytes())
+            key_hash.update(repr((values_original.shape, values_original.dtype.str)).encode())
+        key_hash.update(repr((self.offsets_version, type(self).__name__, self._neighbour_pairs(), self.method,
+                              self.n_levels, self.subpixel, self.refine_radius, self.ncc_min_overlap_fraction,
+                              float(self.initial_x_offset_fraction))).encode())
+        return key_hash.hexdigest()
+
+    @staticmethod
+    def _read_offsets_file(filename: Union[str, Path]) -> dict:
+        """Returns the content of an offsets file (empty dict, if it is missing or damaged)."""
+        try:
+            with open(filename, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_offsets(self, filename: Union[str, Path]):
+        """
+        Save pair_offsets in the JSON file filename (entries for other measurements or parameters are kept).
+        The entry is stored with offsets_key() and contains the names of the measurements and the parameters.
+        :param filename: JSON file
+        :return: None
+        """
+        content = self._read_offsets_file(filename)
+        content[self.offsets_key()] = {
+            "names": [measurement.name for measurement in self.measurements],
+            "parameters": {"method": self.method, "n_levels": self.n_levels, "subpixel": self.subpixel,
+                           "initial_x_offset_fraction": self.initial_x_offset_fraction},
+            "pair_offsets": [[int(i), int(j), y, x] for i, j, y, x in self.pair_offsets]}
+        with open(filename, 'w') as file:
+            json.dump(content, file, indent=1)
 
-    def _stich(self, data01: np.ndarray, data02:np.ndarray, data01_x_offset: int, show_control_figures: bool = True) -> np.ndarray:
+    def load_offsets(self, filename: Union[str, Path]) -> Optional[List[Tuple[int, int, float, float]]]:
         """
-        Stiches two GDEFMeasurement.values using cross-correlation.
+        Returns the pair_offsets stored in the JSON file filename for the current measurements and parameters
+        (see offsets_key), or None if there is no such entry.
+        :param filename: JSON file
+        :return: list of (i, j, y, x) or None
+        """
+        entry = self._read_offsets_file(filename).get(self.offsets_key())
+        if entry is None:
+            return None
+        return [tuple(pair_offset) for pair_offset in entry["pair_offsets"]]
+
+    def _neighbour_pairs(self) -> List[Tuple[int, int, bool]]:
+        """Returns (i, j, below) for all neighbouring measurements (j is right of i or below i)."""
+        return [(i, i + 1, False) for i in range(len(self.measurements) - 1)]
+
+    def _find_pair_offset(self, i: int, j: int, below: bool, initial_x_offset_fraction: float):
+        """
+        Returns the position (y, x) of measurements[j] relative to measurements[i] (j right of i or below i) and
+        the correlation array used to find it.
+        """
+        data01, data02 = self.measurements[i].values, self.measurements[j].values
+        if below:  # search in transposed data, so that data02 is right of data01
+            data01, data02 = data01.T, data02.T
+        data01_x_offset = data01.shape[1] - round(data01.shape[1] * initial_x_offset_fraction)
+        y, x, correlation = self._find_offset(data01, data02, data01_x_offset)
+        return (x, y, correlation.T) if below else (y, x, correlation)
+
+    @staticmethod
+    def solve_positions(n_measurements: int, pair_offsets, round_positions: bool = True) -> np.ndarray:
+        """
+        Returns the positions (row, col) of all measurements, which fit best (least-squares) to the pairwise offsets.
+        The positions are shifted by whole pixels, so that the min. row and col is in range [0, 1).
+        :param n_measurements: number of measurements
+        :param pair_offsets: iterable of (i, j, y, x): position (y, x) of measurement j relative to measurement i
+        :param round_positions: If True (default), positions are rounded to whole pixels.
+        :return: np.ndarray (n_measurements, 2) of int (float, if round_positions is False)
+        """
+        pair_offsets = np.asarray(pair_offsets, dtype=np.float64).reshape(-1, 4)
+        pairs = pair_offsets[:, :2].astype(int)
+        design_matrix = np.zeros((len(pair_offsets), n_measurements))
+        design_matrix[np.arange(len(pair_offsets)), pairs[:, 0]] = -1
+        design_matrix[np.arange(len(pair_offsets)), pairs[:, 1]] = 1
+        # position of first measurement is fixed to (0, 0)
+        solution = np.linalg.lstsq(design_matrix[:, 1:], pair_offsets[:, 2:], rcond=None)[0]
+        result = np.vstack([[0, 0], solution])
+        if round_positions:
+            result = np.round(result).astype(int)
+        return result - np.floor(result.min(axis=0)).astype(result.dtype)
+
+    def _find_offset(self, data01: np.ndarray, data02: np.ndarray, data01_x_offset: int):
+        """
+        Returns the position (y, x) of data02 relative to data01 with the best cross-correlation, and the
+        correlation array used to find it.
         :param data01:
         :param data02:
         :param data01_x_offset: used to specify max. overlap area, thus increasing speed and reducing risk of wrong stiching
-        :return: np.ndarray (2D)
+        :return: y, x, correlation (y, x are float, if subpixel is True)
         """
-        # data01[:] = 10
-        # data02[:] = 10
+        if self.n_levels > 1:
+            y, x, correlation = self._find_offset_coarse_to_fine(data01, data02, data01_x_offset)
+        else:
+            y, x, correlation = self._find_offset_full(data01, data02, data01_x_offset)
+        if self.subpixel:
+            y, x = self._refine_subpixel(data01, data02, y, x)
+        return y, x, correlation
+
+    def _refine_subpixel(self, data01: np.ndarray, data02: np.ndarray, y: int, x: int) -> Tuple[float, float]:
+        """
+        Returns the sub-pixel position of the correlation peak near (y, x). Only the normalized cross-correlation
+        of the 3 x 3 neighbourhood is calculated (the raw correlation is biased by the size of the overlap). If a
+        neighbour is better, the window is moved (max. refine_radius times). The vertex of a parabola through the
+        peak and its neighbours is used for each axis.
+        """
+        for n_moves in range(self.refine_radius + 1):
+            window = [(y + dy, x + dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)]
+            neighbourhood = correlation_at_positions(
+                data01, data02, window, normalized=True, detrend=self.method == "ncc_plane",
+                min_overlap=self._ncc_min_overlap(data02.shape[0], data02.shape[1])).reshape(3, 3)
+            if np.all(np.isnan(neighbourhood)) or np.nanargmax(neighbourhood) == 4 or n_moves == self.refine_radius:
+                break
+            y, x = window[int(np.nanargmax(neighbourhood))]
+        dy, dx = subpixel_minimum_positions(-neighbourhood, (1, 1))[0] - 1
+        return float(y + dy), float(x + dx)
+
+    def _find_offset_full(self, data01: np.ndarray, data02: np.ndarray, data01_x_offset: int):
+        """Search the offset using the full cross-correlation (see _find_offset)."""
         data02_x_offset_right = data01.shape[1] - data01_x_offset
-        correlation = signal.correlate2d(data01[:, data01_x_offset:],
-                                         data02[:, :data02_x_offset_right])  #, boundary="wrap")  # using "wrap" ensures, that x, y below can be used directly
+        if self.method in normalized_methods:
+            correlation = normalized_cross_correlate(data01[:, data01_x_offset:], data02[:, :data02_x_offset_right],
+                                                     self._ncc_min_overlap(data02.shape[0], data02_x_offset_right),
+                                                     detrend=self.method == "ncc_plane")
+        else:
+            correlation = cross_correlate(data01[:, data01_x_offset:], data02[:, :data02_x_offset_right], self.method)
 
         reduced_correlation = correlation[:, data02_x_offset_right:]  # make sure, data02 is appended on right side
                                                                       # this reduces risk of wrong stiching, but measurements have to be in right order
@@ -87,28 +427,85 @@ class GDEFSticher:
 
         y, x = np.unravel_index(np.nanargmax(reduced_correlation), reduced_correlation.shape)  # find (first) best match
         y, x = y - data02.shape[0] + 1, x + 1 + data01_x_offset  # - data02_x_offset_right)  # test with two identical datasets -> should give: y, x = 0, 0
-        # ax_orig.plot(x, y, 'ro')
+        return int(y), int(x), reduced_correlation
 
-        data01_x0 = - min(0, x)
-        data01_y0 = - min(0, y)
-        data02_x0 = max(0, x)
-        data02_y0 = max(0, y)
+    def _find_offset_coarse_to_fine(self, data01: np.ndarray, data02: np.ndarray, data01_x_offset: int):
+        """
+        Like _find_offset, but the full search is done on data downsampled by 2**(n_levels-1). The offset is then
+        refined at each finer level within a window of +/- refine_radius pixels.
+        :return: y, x, correlation (of coarsest level)
+        """
+        levels01 = [data01[:, data01_x_offset:]]  # data02 is only placed right of data01_x_offset
+        levels02 = [data02]
+        for _ in range(self._effective_n_levels(levels01[0].shape, data02.shape) - 1):
+            levels01.append(downsample_nanmean(levels01[-1]))
+            levels02.append(downsample_nanmean(levels02[-1]))
+        y, x, correlation = self._find_offset_full(levels01[-1], levels02[-1], 0)
 
-        data01_height = data01.shape[0] + data01_y0
-        data01_width = data01.shape[1] + data01_x0
+        window = np.arange(-self.refine_radius, self.refine_radius + 1)
+        for level01, level02 in zip(levels01[-2::-1], levels02[-2::-1]):
+            positions = [(2 * y + dy, 2 * x + dx) for dy in window for dx in window if 2 * x + dx > 0]
+            level_correlation = correlation_at_positions(
+                level01, level02, positions, normalized=self.method in normalized_methods,
+                detrend=self.method == "ncc_plane",
+                min_overlap=self._ncc_min_overlap(level02.shape[0], level01.shape[1]))
+            if np.all(np.isnan(level_correlation)):
+                y, x = 2 * y, 2 * x
+            else:
+                y, x = positions[int(np.nanargmax(level_correlation))]
+        return int(y), int(x + data01_x_offset), correlation
 
-        data02_height = data02.shape[0] + data02_y0
-        data02_width = data02.shape[1] + data02_x0
+    def _effective_n_levels(self, shape01: Tuple[int, int], shape02: Tuple[int, int]) -> int:
+        """
+        Returns the number of levels (max. n_levels) for the coarse-to-fine search in data01 (shape01; searched area
+        only) for data02 (shape02). The coarsest level has to be at least coarse_min_size px per axis, and for
+        normalized methods its min. overlap has to be at least coarse_min_size px, otherwise the search on the coarsest level is unreliable.
+        """
+        n_levels = 1
+        while n_levels < self.n_levels:
+            factor = 2 ** n_levels  # downsampling factor of the next level
+            height = min(shape01[0], shape02[0]) // factor
+            width = min(shape01[1], shape02[1]) // factor
+            if min(height, width) < self.coarse_min_size:
+                break
+            if self.method in normalized_methods and self._ncc_min_overlap(shape02[0] // factor,
+                                                              shape01[1] // factor) < self.coarse_min_size:
+                break
+            n_levels += 1
+        return n_levels
 
-        result = np.full([max(data01_height, data02_height), max(data01_width, data02_width)], np.nan)
+    def _ncc_min_overlap(self, height: int, width: int) -> int:
+        """Returns the min. number of overlapping pixels for normalized cross-correlation in a search area."""
+        return int(self.ncc_min_overlap_fraction * height * width)
 
-        result[data01_y0:data01_height, data01_x0:data01_width] = data01
-        result[data02_y0:data02_height, data02_x0:data02_width] = data02
+    @staticmethod
+    def _combine(data01: np.ndarray, data02: np.ndarray, y: float, x: float) -> np.ndarray:
+        """Returns a new array containing data01 and data02 (at position y, x relative to data01; data02 on top)."""
+        return compose_mosaic([data01, data02], [(0, 0), (y, x)])
 
-        if show_control_figures:
-            plt = self._create_stich_control_figure(data01, data02, reduced_correlation, result)
-            plt.show()
-        return result
+    def correct_background(self, correction_type: BGCorrectionType = BGCorrectionType.legendre_1,
+                           keep_offset: bool = False) -> np.ndarray:
+        """
+        Corrects background of the stiched values (e.g. to level the whole mosaic at once). NaN values in the
+        padding areas are ignored for the correction.
+        :param correction_type: select type of background correction
+        :param keep_offset: If True keeps average offset, otherwise average offset is reduced to 0 (default).
+        :return: corrected np.ndarray (also saved in values)
+        """
+        self.values = correct_background(self.values, correction_type=correction_type, keep_offset=keep_offset)
+        return self.values
+
+    def save_pyramid(self, path: Union[str, Path], tile_size: int = 256,
+                     n_levels: Optional[int] = None) -> TiledPyramid:
+        """
+        Save the stiched data as TiledPyramid (tiled, multi-resolution and memory-mapped) in folder path.
+        :param path: Folder for the pyramid files.
+        :param tile_size: Edge length of the square tiles [px] (default 256).
+        :param n_levels: Number of resolution levels (default None -> coarsest level fits into one tile)
+        :return: TiledPyramid
+        """
+        return TiledPyramid.create(self.values, path, pixel_width=self.pixel_width, tile_size=tile_size,
+                                   n_levels=n_levels)
 
     # def create_cropped_figure(self, max_figure_size: Tuple[float, float] = (20, 10), dpi: int = 300) -> Figure:
     #     # todo: something is broken here
@@ -136,3 +533,61 @@ class GDEFSticher:
 
         return result
 
+
+class GDEFGridSticher(GDEFSticher):
+    """
+    GDEFGridSticher combines AFM area-measurements scanned on a rectangular grid. The offsets between all
+    neighbouring measurements (right and below) are searched independently (in a thread pool), like for GDEFSticher.
+    The position of each measurement is then calculated by a global least-squares fit to all pairwise offsets, so
+    errors of single offsets do not accumulate along a row or column. Finally, the mosaic is composed once.
+    The offset to the right neighbour is searched within initial_x_offset_fraction of the measurement width,
+    the offset to the measurement below within initial_x_offset_fraction of the measurement height.
+    All other attributes and methods are the same as for GDEFSticher.
+
+    .. code:: python
+
+        sticher = GDEFGridSticher([[m00, m01, m02], [m10, m11, m12]], method="ncc")
+        pyramid = sticher.save_pyramid(Path("mosaic"))
+
+    :InstanceAttributes:
+    grid: list of rows (top to bottom) with GDEFMeasurements (left to right). Rows may have different lengths.
+    measurements: list of all GDEFMeasurements in grid (row by row)
+    :EndInstanceAttributes:
+    """
+
+    def __init__(self, grid: List[List[GDEFMeasurement]], initial_x_offset_fraction: float = 0.35,
+                 method: str = "fft", n_levels: int = 1, subpixel: bool = False, max_workers: Optional[int] = None,
+                 canvas_filename: Optional[Union[str, Path]] = None, blending: str = "last",
+                 offsets_filename: Optional[Union[str, Path]] = None, pair_offsets: Optional[list] = None):
+        """
+        :param grid: list of rows (top to bottom) with GDEFMeasurements (left to right)
+        :param initial_x_offset_fraction: used to specify max. overlap area, thus increasing speed and reducing risk of wrong stiching
+        :param method: cross-correlation method "fft" (default), "direct" (same offsets as "fft"), "ncc" (normalized)
+         or "ncc_plane" (normalized, plane subtracted from each overlap)
+        :param n_levels: number of resolution levels for coarse-to-fine offset search (default 1 -> full resolution)
+        :param subpixel: If True, sub-pixel offsets and positions are used (default False)
+        :param max_workers: max. number of threads used to search the pairwise offsets
+        :param canvas_filename: optional \*.npy file for disk-backed values (default None -> values in memory)
+        :param blending: "last" (default; later measurements on top), "mean", "feather" or "distance"
+        :param offsets_filename: optional JSON file to load pair_offsets from or save them to
+        :param pair_offsets: known pair_offsets (no cross-correlation is calculated; see from_offsets)
+        """
+        self.grid = grid
+        super().__init__([measurement for row in grid for measurement in row], initial_x_offset_fraction,
+                         method=method, n_levels=n_levels, subpixel=subpixel, max_workers=max_workers,
+                         canvas_filename=canvas_filename, blending=blending, offsets_filename=offsets_filename,
+                         pair_offsets=pair_offsets)
+
+    def _neighbour_pairs(self) -> List[Tuple[int, int, bool]]:
+        """Returns (i, j, below) for all neighbouring measurements (j is right of i or below i)."""
+        index = {}
+        for row, measurements in enumerate(self.grid):
+            for col, _ in enumerate(measurements):
+                index[row, col] = len(index)
+        result = []
+        for (row, col), i in index.items():
+            if (row, col + 1) in index:
+                result.append((i, index[row, col + 1], False))
+            if (row + 1, col) in index:
+                result.append((i, index[row + 1, col], True))
+        return result
@@ -0,0 +1,136 @@
+"""
+This module contains functions to analyze nanoindents in many \*.gdf or \*.pygdf files using a process pool.
+The results are collected in a table with one row per indent, that can be saved as \*.csv or \*.npy file
+(numpy structured array). This way, statistics over many indents are possible without creating any figures.
+@author: Nathanael Jöhrmann
+"""
+import csv
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Union
+
+import numpy as np
+
+from afm_tools.gdef_indent_analyzer import GDEFIndentAnalyzer
+from gdef_reader.gdef_importer import GDEFImporter
+from gdef_reader.gdef_measurement import GDEFMeasurement
+
+indent_result_fields = ["filename", "name", "comment", "indent_id", "center_row", "center_col", "z_min", "z_max",
+                        "radius", "surface_limit", "contact_radius", "contact_area", "indent_area", "indent_volume",
+                        "pileup_area", "pileup_volume"]
+
+
+def load_measurements(filename: Path) -> List[GDEFMeasurement]:
+    """
+    Returns all measurements from a \*.gdf file or the measurement from a \*.pygdf file. Take note, that pickle
+    is used to load \*.pygdf files. Make sure to only use files from trustworthy sources.
+    :param filename: Path to \*.gdf or \*.pygdf file
+    :return: list of GDEFMeasurement
+    """
+    if filename.suffix == ".pygdf":
+        with open(filename, 'rb') as file:
+            measurement = pickle.load(file)
+        measurement.pygdf_filename = filename
+        return [measurement]
+    return GDEFImporter(filename).export_measurements()
+
+
+def _analyze_file(filename: Path, roughness_part: float, multi_indent: bool) -> List[dict]:
+    """Worker function: analyze all topography measurements in filename."""
+    result = []
+    for measurement in load_measurements(filename):
+        if not measurement.settings.source_channel == 11:  # only analyze topography data
+            continue
+        analyzer = GDEFIndentAnalyzer(measurement)
+        if multi_indent:
+            indent_results = analyzer.detect_indents(roughness_part)
+        else:
+            analyzer.analyze_indent(roughness_part)
+            indent_results = [analyzer.get_indent_result()]
+        for indent_result in indent_results:
+            row = {"filename": str(filename), "name": measurement.name, "comment": measurement.comment or ""}
+            row.update(indent_result)
+            result.append(row)
+    return result
+
+
+def find_measurement_files(paths: Union[Path, Iterable[Path]]) -> List[Path]:
+    """
+    Returns a sorted list of all \*.gdf and \*.pygdf files in the given folder(s). Files in paths are used directly.
+    :param paths: folder, file or iterable of folders and files
+    :return: list of Path
+    """
+    if isinstance(paths, (str, Path)):
+        paths = [paths]
+    result = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            result.extend(file for file in path.iterdir() if file.suffix in (".gdf", ".pygdf"))
+        else:
+            result.append(path)
+    return sorted(result)
+
+
+def analyze_indents(paths: Union[Path, Iterable[Path]], roughness_part: float = 0.05, multi_indent: bool = False,
+                    max_workers: Optional[int] = None,
+                    progress_callback: Optional[Callable[[int, int], None]] = None) -> List[dict]:
+    """
+    Analyze the indents of all topography measurements in the given folder(s) or files (see find_measurement_files)
+    with GDEFIndentAnalyzer. Each file is analyzed by a worker of a process pool. The result contains one dict
+    per indent with the keys in indent_result_fields, sorted by filename (independent of the number of workers).
+
+    .. code:: python
+
+        results = analyze_indents(Path("nanoindents"), max_workers=4)
+        save_indent_results(results, Path("nanoindents/indent_results.csv"))
+
+    :param paths: folder, file or iterable of folders and files
+    :param roughness_part: see GDEFIndentAnalyzer.analyze_indent()
+    :param multi_indent: If True, each measurement can contain several indents (see GDEFIndentAnalyzer.detect_indents)
+    :param max_workers: max. number of worker processes (default None -> number of CPUs)
+    :param progress_callback: optional callable(n_analyzed_files, n_files), called whenever a file is analyzed
+    :return: list of dict
+    """
+    filenames = find_measurement_files(paths)
+    file_results = [[] for _ in filenames]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        future_dict = {executor.submit(_analyze_file, filename, roughness_part, multi_indent): i
+                       for i, filename in enumerate(filenames)}
+        for n_analyzed, future in enumerate(as_completed(future_dict), 1):
+            file_results[future_dict[future]] = future.result()
+            if progress_callback:
+                progress_callback(n_analyzed, len(filenames))
+    return [row for rows in file_results for row in rows]
+
+
+def indent_results_to_array(results: List[dict]) -> np.ndarray:
+    """
+    Returns the results from analyze_indents() as numpy structured array (field names see indent_result_fields).
+    :param results: list of dict
+    :return: structured np.ndarray
+    """
+    text_fields = indent_result_fields[:3]
+    dtype = [(field, "U" + str(max([1] + [len(row[field]) for row in results]))) for field in text_fields]
+    dtype += [("indent_id", np.int32)] + [(field, np.float64) for field in indent_result_fields[4:]]
+    return np.array([tuple(row[field] for field in indent_result_fields) for row in results], dtype=dtype)
+
+
+def save_indent_results(results: List[dict], filename: Path):
+    """
+    Save results from analyze_indents() as table with one row per indent. The file type is selected by the suffix
+    of filename: \*.csv (text) or \*.npy (numpy structured array, load with np.load(filename)).
+    :param results: list of dict
+    :param filename: Path with suffix .csv or .npy
+    :return: None
+    """
+    filename = Path(filename)
+    if filename.suffix == ".csv":
+        with open(filename, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=indent_result_fields)
+            writer.writeheader()
+            writer.writerows(results)
+    elif filename.suffix == ".npy":
+        np.save(filename, indent_results_to_array(results))
+    else:
+        raise ValueError(f"Unknown file type '{filename.suffix}' (use .csv or .npy)")
@@ -0,0 +1,136 @@
+"""
+This module contains IndentResultCache, a persistent on-disk cache for results of GDEFIndentAnalyzer.
+It is used to skip the indent analysis, when a report is recreated for unchanged measurements.
+@author: Nathanael Jöhrmann
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from afm_tools.gdef_indent_analyzer import GDEFIndentAnalyzer
+from gdef_reader.gdef_measurement import GDEFMeasurement
+
+
+class IndentResultCache:
+    """
+    Persistent cache for results of GDEFIndentAnalyzer.analyze_indent(). Each entry is stored as \*.npz file in
+    path, containing the label mask and the result dict (see GDEFIndentAnalyzer.get_indent_result). Entries are keyed
+    by a hash of measurement.values (the analyzed data, including background correction), the pixel size and
+    roughness_part. If the total size of all entries exceeds max_size, the least recently used entries are deleted.
+    Take note, that the key does not use values_original and the correction type: measurement.values might also be
+    changed without a BGCorrectionType (e.g. masked or robust correction, or values set directly), and only the
+    analyzed data decides, if a result is still valid. Therefore, each lookup hashes the full values array, and
+    the same raw data corrected with a different type (or correction parameters) is a cache miss.
+
+    .. code:: python
+
+        cache = IndentResultCache(Path("indent_cache"))
+        indent_result = cache.analyze(GDEFIndentAnalyzer(measurement), roughness_part=0.05)
+
+    :InstanceAttributes:
+    path: Folder containing the cache files.
+    max_size: Max. total size of all cache files [bytes].
+    nbytes: Total size of all cache files [bytes] (read-only property).
+    :EndInstanceAttributes:
+    """
+    cache_version = 2  # increase, if the analysis changes, to invalidate old entries
+
+    def __init__(self, path: Union[str, Path], max_size: int = 500 * 2 ** 20):
+        """
+        :param path: Folder for the cache files (created if necessary).
+        :param max_size: Max. total size of all cache files [bytes] (default 500 MiB).
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+
+    @classmethod
+    def key(cls, measurement: GDEFMeasurement, roughness_part: float) -> str:
+        """Returns the cache key for the analysis of measurement with roughness_part."""
+        values = np.ascontiguousarray(measurement.values)  # analyzed data (depends on the background correction)
+        key_hash = hashlib.sha1(values.tobytes())
+        key_hash.update(repr((cls.cache_version, values.shape, values.dtype.str, measurement.settings.pixel_width,
+                              measurement.settings.pixel_height, float(roughness_part))).encode())
+        return key_hash.hexdigest()
+
+    def _filename(self, key: str) -> Path:
+        return self.path.joinpath(f"{key}.npz")
+
+    def get(self, analyzer: GDEFIndentAnalyzer, roughness_part: float) -> Optional[dict]:
+        """
+        Returns the cached result dict for analyzer.measurement and restores the masks, radius and surface limits of
+        analyzer (as if analyzer.analyze_indent(roughness_part) was called). Returns None, if there is no entry.
+        :param analyzer: GDEFIndentAnalyzer
+        :param roughness_part:
+        :return: dict or None
+        """
+        filename = self._filename(self.key(analyzer.measurement, roughness_part))
+        try:
+            with np.load(filename) as data:
+                label_mask = data["label_mask"]
+                entry = json.loads(str(data["entry"]))
+        except (OSError, KeyError, ValueError):  # missing or damaged entry
+            return None
+        os.utime(filename)  # mark entry as recently used
+
+        analyzer.indent_mask = label_mask == analyzer.label_indent
+        analyzer.pileup_mask = label_mask == analyzer.label_pileup
+        analyzer.surface_mask = label_mask == analyzer.label_surface
+        analyzer.indent_labels = (label_mask > 0).astype(np.int32)
+        analyzer.radius = entry["radius"]
+        analyzer.below_surface_limit = entry["below_surface_limit"]
+        analyzer.above_surface_limit = entry["above_surface_limit"]
+        return entry["result"]
+
+    def put(self, analyzer: GDEFIndentAnalyzer, roughness_part: float, indent_result: dict):
+        """
+        Store masks and indent_result of analyzer (after analyzer.analyze_indent(roughness_part)).
+        :param analyzer: GDEFIndentAnalyzer
+        :param roughness_part:
+        :param indent_result: result dict (see GDEFIndentAnalyzer.get_indent_result)
+        :return: None
+        """
+        entry = {"radius": analyzer.radius, "below_surface_limit": analyzer.below_surface_limit,
+                 "above_surface_limit": analyzer.above_surface_limit, "result": indent_result}
+        filename = self._filename(self.key(analyzer.measurement, roughness_part))
+        with open(filename, 'wb') as file:
+            np.savez_compressed(file, label_mask=analyzer.label_mask, entry=np.array(json.dumps(entry)))
+        self._evict()
+
+    def analyze(self, analyzer: GDEFIndentAnalyzer, roughness_part: float = 0.05) -> dict:
+        """
+        Returns the result dict of analyzer.analyze_indent(roughness_part) from cache (restoring the state of
+        analyzer). If there is no entry, the indent is analyzed and the result is stored.
+        :param analyzer: GDEFIndentAnalyzer
+        :param roughness_part:
+        :return: dict (see GDEFIndentAnalyzer.get_indent_result)
+        """
+        result = self.get(analyzer, roughness_part)
+        if result is None:
+            analyzer.analyze_indent(roughness_part)
+            result = analyzer.get_indent_result()
+            self.put(analyzer, roughness_part, result)
+        return result
+
+    def _evict(self):
+        """Delete least recently used entries, until the total size is below max_size."""
+        files = sorted(self.path.glob("*.npz"), key=lambda file: file.stat().st_mtime)
+        size = sum(file.stat().st_size for file in files)
+        for file in files:
+            if size <= self.max_size:
+                break
+            size -= file.stat().st_size
+            file.unlink()
+
+    def clear(self):
+        """Delete all cache entries."""
+        for file in self.path.glob("*.npz"):
+            file.unlink()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(file.stat().st_size for file in self.path.glob("*.npz"))
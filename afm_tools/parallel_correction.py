@@ -0,0 +1,79 @@
+"""
+This module contains functions to correct the background of many measurements in parallel using a process pool.
+The value arrays are shared with the worker processes via shared memory, so no pickling of the data is needed.
+@author: Nathanael Jöhrmann
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+from afm_tools.background_correction import BGCorrectionType, correct_background_stack
+
+
+def _correct_shared_stack(shared_memory_name: str, shape: Tuple[int, int, int], start: int, stop: int,
+                          correction_type: BGCorrectionType, keep_offset: bool) -> int:
+    """Worker function: correct stack[start:stop] of the stack in shared memory in place."""
+    shared_memory = SharedMemory(name=shared_memory_name)
+    try:
+        stack = np.ndarray(shape, dtype=np.float64, buffer=shared_memory.buf)
+        correct_background_stack(stack[start:stop], correction_type, keep_offset, inplace=True)
+        del stack  # release buffer before closing shared memory
+    finally:
+        shared_memory.close()
+    return stop - start
+
+
+def parallel_correct_background(arrays: List[np.ndarray], correction_type: BGCorrectionType,
+                                keep_offset: bool = False, max_workers: Optional[int] = None,
+                                chunk_size: int = 4,
+                                progress_callback: Optional[Callable[[int, int], None]] = None) -> List[np.ndarray]:
+    """
+    Returns a list with the background corrected arrays (same order as arrays), using a process pool.
+    Arrays with the same shape are copied into one shared memory block, and each worker corrects chunk_size
+    arrays of it in place (see correct_background_stack). The result does not depend on the number of workers.
+
+    :param arrays: list of 2D np.ndarray
+    :param correction_type: select type of background correction
+    :param keep_offset: If True keeps average offset, otherwise average offset is reduced to 0 (default).
+    :param max_workers: max. number of worker processes (default None -> number of CPUs)
+    :param chunk_size: number of arrays corrected by a worker in one task
+    :param progress_callback: optional callable(n_corrected, n_total), called whenever a task is finished
+    :return: list of np.ndarray
+    """
+    shape_dict = {}
+    for i, array2d in enumerate(arrays):
+        shape_dict.setdefault(array2d.shape, []).append(i)
+
+    result: List[Optional[np.ndarray]] = [None] * len(arrays)
+    shared_memories = []
+    try:
+        tasks = []
+        for shape, indices in shape_dict.items():
+            stack_shape = (len(indices), *shape)
+            shared_memory = SharedMemory(create=True, size=max(1, int(np.prod(stack_shape)) * 8))
+            shared_memories.append(shared_memory)
+            np.stack([arrays[i] for i in indices],
+                     out=np.ndarray(stack_shape, dtype=np.float64, buffer=shared_memory.buf))
+            tasks.extend((shared_memory.name, stack_shape, start, min(start + chunk_size, len(indices)))
+                         for start in range(0, len(indices), chunk_size))
+
+        n_corrected = 0
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_correct_shared_stack, *task, correction_type, keep_offset) for task in tasks]
+            for future in as_completed(futures):
+                n_corrected += future.result()
+                if progress_callback:
+                    progress_callback(n_corrected, len(arrays))
+
+        for shared_memory, indices in zip(shared_memories, shape_dict.values()):
+            stack = np.ndarray((len(indices), *arrays[indices[0]].shape), dtype=np.float64, buffer=shared_memory.buf)
+            for i, values in zip(indices, stack.copy()):
+                result[i] = values
+            del stack  # release buffer before closing shared memory
+    finally:
+        for shared_memory in shared_memories:
+            shared_memory.close()
+            shared_memory.unlink()
+    return result
@@ -0,0 +1,30 @@
+"""
+This module contains helper functions to locate peaks (minima or maxima) in 2D data with sub-pixel accuracy.
+They are used e.g. for indent centers and for the offsets of stiched measurements.
+@author: Nathanael Jöhrmann
+"""
+import numpy as np
+
+
+def subpixel_minimum_positions(values: np.ndarray, positions) -> np.ndarray:
+    """
+    Returns the sub-pixel positions of local minima. Each integer position is refined by the vertex of a parabola
+    through the pixel and its two neighbours (separately for each axis). Positions at the border are not refined.
+    :param values: 2D ndarray
+    :param positions: integer positions (row, col) of local minima; shape (2,) or (n, 2)
+    :return: ndarray with shape (n, 2)
+    """
+    positions = np.asarray(positions, dtype=int).reshape(-1, 2)
+    result = positions.astype(np.float64)
+    for axis in range(2):
+        step = np.zeros(2, dtype=int)
+        step[axis] = 1
+        inside = (positions[:, axis] > 0) & (positions[:, axis] < values.shape[axis] - 1)
+        z_minus = values[tuple((positions[inside] - step).T)]
+        z_0 = values[tuple(positions[inside].T)]
+        z_plus = values[tuple((positions[inside] + step).T)]
+        curvature = z_minus - 2 * z_0 + z_plus
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset = np.where(curvature > 0, 0.5 * (z_minus - z_plus) / curvature, 0)
+        result[inside, axis] += np.clip(offset, -0.5, 0.5)
+    return result
@@ -0,0 +1,201 @@
+"""
+This module contains TiledPyramid, an on-disk multi-resolution storage for large 2D data (e.g. stiched measurements).
+Each resolution level is split into square tiles of fixed size, which are stored in a memory-mapped \*.npy file.
+This way, a region can be read at a given resolution without loading the full-resolution data.
+@author: Nathanael Jöhrmann
+"""
+import json
+import math
+import warnings
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+
+def downsample_nanmean(array2d: np.ndarray, factor: int = 2) -> np.ndarray:
+    """
+    Returns array2d downsampled by factor, using the mean value of each (factor x factor) block. NaN values are ignored
+    (all-NaN blocks result in NaN). If the shape of array2d is not a multiple of factor, the last blocks are smaller.
+    :param array2d:
+    :param factor: downsampling factor in x and y direction
+    :return: ndarray
+    """
+    if not np.isnan(np.sum(array2d)):  # faster path without NaN handling
+        row_starts = np.arange(0, array2d.shape[0], factor)
+        col_starts = np.arange(0, array2d.shape[1], factor)
+        sums = np.add.reduceat(np.add.reduceat(array2d, row_starts, axis=0), col_starts, axis=1)
+        counts = np.outer(np.diff(row_starts, append=array2d.shape[0]), np.diff(col_starts, append=array2d.shape[1]))
+        return sums / counts
+
+    n_rows = math.ceil(array2d.shape[0] / factor)
+    n_cols = math.ceil(array2d.shape[1] / factor)
+    padded = np.full((n_rows * factor, n_cols * factor), np.nan)
+    padded[:array2d.shape[0], :array2d.shape[1]] = array2d
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)  # mean of all-NaN blocks
+        return np.nanmean(padded.reshape(n_rows, factor, n_cols, factor), axis=(1, 3))
+
+
+class TiledPyramid:
+    """
+    TiledPyramid stores 2D data (e.g. GDEFSticher.values) in a folder on disk. Level 0 holds the full resolution,
+    each following level is downsampled by a factor of 2 (using the mean value, ignoring NaN). Every level is split
+    into square tiles of tile_size pixels, stored in a memory-mapped \*.npy file. Regions are always given in
+    pixel coordinates of level 0, so the same coordinates can be used for every resolution.
+    The attributes values and pixel_width return the data of display_level, so a TiledPyramid can be used
+    directly with the functions in gdef_reporter.plotter_utils.
+
+    .. code:: python
+
+        pyramid = TiledPyramid.create(sticher.values, path, pixel_width=sticher.pixel_width)
+        overview = pyramid.read_region(level=pyramid.n_levels - 1)
+        detail = pyramid.read_region(0, 512, 10_000, 12_000, level=1)
+
+    :InstanceAttributes:
+    path: Folder containing the pyramid files.
+    shape: Shape of the full resolution data (level 0).
+    tile_size: Edge length of the square tiles [px].
+    n_levels: Number of resolution levels. Level n is downsampled by a factor of 2**n.
+    display_level: Level used for values and pixel_width (default: finest level fitting into max_display_shape).
+    values: np.ndarray with the data of display_level (read-only property)
+    pixel_width: Pixel width of display_level [m] (read-only property)
+    :EndInstanceAttributes:
+    """
+    meta_filename = "pyramid.json"
+    max_display_shape = (1024, 1024)
+
+    def __init__(self, path: Union[str, Path]):
+        """
+        Open an existing TiledPyramid. Use TiledPyramid.create() to create a new one.
+        :param path: Folder containing the pyramid files.
+        """
+        self.path = Path(path)
+        with open(self.path.joinpath(self.meta_filename), 'r') as file:
+            meta = json.load(file)
+        self.shape: Tuple[int, int] = tuple(meta["shape"])
+        self.tile_size: int = meta["tile_size"]
+        self.n_levels: int = meta["n_levels"]
+        self._pixel_width: Optional[float] = meta["pixel_width"]
+        self._levels = [np.load(self._level_filename(self.path, level), mmap_mode='r')
+                        for level in range(self.n_levels)]
+        self.display_level = self.best_level(self.max_display_shape)
+
+    @classmethod
+    def create(cls, array2d: np.ndarray, path: Union[str, Path], pixel_width: Optional[float] = None,
+               tile_size: int = 256, n_levels: Optional[int] = None, dtype=np.float64) -> "TiledPyramid":
+        """
+        Create a TiledPyramid from array2d in folder path (existing pyramid files are overwritten).
+        array2d is copied tile by tile, so it can also be a np.memmap.
+        :param array2d: 2D data (e.g. GDEFSticher.values)
+        :param path: Folder for the pyramid files (created if necessary).
+        :param pixel_width: Pixel width of array2d [m]
+        :param tile_size: Edge length of the square tiles [px] (default 256).
+        :param n_levels: Number of levels. If None (default), levels are added until the coarsest level fits in one tile.
+        :param dtype: dtype used to store the tiles (default np.float64)
+        :return: TiledPyramid
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        if n_levels is None:
+            n_levels = max(1, math.ceil(math.log2(max(array2d.shape) / tile_size)) + 1)
+
+        shape = tuple(int(x) for x in array2d.shape)
+        level_shape = shape
+        for level in range(n_levels):
+            n_tile_rows = math.ceil(level_shape[0] / tile_size)
+            n_tile_cols = math.ceil(level_shape[1] / tile_size)
+            tiles = np.lib.format.open_memmap(cls._level_filename(path, level), mode='w+', dtype=dtype,
+                                              shape=(n_tile_rows, n_tile_cols, tile_size, tile_size))
+            for tile_row in range(n_tile_rows):
+                for tile_col in range(n_tile_cols):
+                    row0, col0 = tile_row * tile_size, tile_col * tile_size
+                    if level == 0:
+                        data = array2d[row0:row0 + tile_size, col0:col0 + tile_size]
+                    else:  # each tile is calculated from 2 x 2 tiles of the previous level
+                        data = downsample_nanmean(cls._read_tiles(previous_tiles, previous_shape, tile_size,
+                                                                  2 * row0, 2 * (row0 + tile_size),
+                                                                  2 * col0, 2 * (col0 + tile_size)))
+                    tiles[tile_row, tile_col] = np.nan
+                    tiles[tile_row, tile_col, :data.shape[0], :data.shape[1]] = data
+            tiles.flush()
+            previous_tiles, previous_shape = tiles, level_shape
+            level_shape = (math.ceil(level_shape[0] / 2), math.ceil(level_shape[1] / 2))
+
+        with open(path.joinpath(cls.meta_filename), 'w') as file:
+            json.dump({"shape": shape, "tile_size": tile_size, "n_levels": n_levels, "pixel_width": pixel_width}, file)
+        return cls(path)
+
+    @staticmethod
+    def _level_filename(path: Path, level: int) -> Path:
+        return path.joinpath(f"level_{level:02}.npy")
+
+    @staticmethod
+    def _read_tiles(tiles: np.ndarray, level_shape: Tuple[int, int], tile_size: int,
+                    row_start: int, row_stop: int, col_start: int, col_stop: int) -> np.ndarray:
+        """Assemble the given region (pixel coordinates of the tiles level) from the tiles touching it."""
+        row_stop, col_stop = min(row_stop, level_shape[0]), min(col_stop, level_shape[1])
+        tile_row0, tile_col0 = row_start // tile_size, col_start // tile_size
+        tile_row1, tile_col1 = math.ceil(row_stop / tile_size), math.ceil(col_stop / tile_size)
+        block = np.asarray(tiles[tile_row0:tile_row1, tile_col0:tile_col1])  # reads only the needed tiles
+        block = block.transpose(0, 2, 1, 3).reshape(block.shape[0] * tile_size, block.shape[1] * tile_size)
+        row0, col0 = row_start - tile_row0 * tile_size, col_start - tile_col0 * tile_size
+        return block[row0:row0 + row_stop - row_start, col0:col0 + col_stop - col_start]
+
+    def level_shape(self, level: int) -> Tuple[int, int]:
+        """Returns the shape of the data at the given level."""
+        factor = 2 ** level
+        return math.ceil(self.shape[0] / factor), math.ceil(self.shape[1] / factor)
+
+    def level_pixel_width(self, level: int) -> Optional[float]:
+        """Returns the pixel width [m] at the given level (None, if pixel_width of level 0 is unknown)."""
+        if self._pixel_width is None:
+            return None
+        return self._pixel_width * 2 ** level
+
+    def best_level(self, max_shape: Tuple[int, int], region_shape: Optional[Tuple[int, int]] = None) -> int:
+        """
+        Returns the finest level at which a region of region_shape (level 0 pixels) fits into max_shape.
+        :param max_shape: max. shape (rows, cols) of the requested data
+        :param region_shape: shape of the region in level 0 pixels (default: shape of the whole data)
+        :return: level (coarsest level, if region does not fit at any level)
+        """
+        if region_shape is None:
+            region_shape = self.shape
+        for level in range(self.n_levels):
+            factor = 2 ** level
+            if math.ceil(region_shape[0] / factor) <= max_shape[0] and math.ceil(region_shape[1] / factor) <= max_shape[1]:
+                return level
+        return self.n_levels - 1
+
+    def read_region(self, row_start: int = 0, row_stop: Optional[int] = None,
+                    col_start: int = 0, col_stop: Optional[int] = None, level: int = 0) -> np.ndarray:
+        """
+        Returns the region [row_start:row_stop, col_start:col_stop] at the given level. Coordinates are given in
+        pixels of level 0, so the returned array has a shape reduced by 2**level. Only tiles touching the region
+        are read from disk.
+        :param row_start:
+        :param row_stop: (default: last row)
+        :param col_start:
+        :param col_stop: (default: last column)
+        :param level: resolution level (0 ... full resolution)
+        :return: ndarray
+        """
+        if not 0 <= level < self.n_levels:
+            raise ValueError(f"level has to be in range 0 ... {self.n_levels - 1}")
+        row_stop = self.shape[0] if row_stop is None else min(row_stop, self.shape[0])
+        col_stop = self.shape[1] if col_stop is None else min(col_stop, self.shape[1])
+        factor = 2 ** level
+        return self._read_tiles(self._levels[level], self.level_shape(level), self.tile_size,
+                                row_start // factor, math.ceil(row_stop / factor),
+                                col_start // factor, math.ceil(col_stop / factor))
+
+    @property
+    def values(self) -> np.ndarray:
+        """Returns the data of display_level."""
+        return self.read_region(level=self.display_level)
+
+    @property
+    def pixel_width(self) -> Optional[float]:
+        """Returns the pixel width [m] of display_level."""
+        return self.level_pixel_width(self.display_level)
@@ -9,15 +9,22 @@ from types import ModuleType, DynamicClassAttribute
 from typing import Tuple
 
 import gdef_reader.gdef_importer as gdef_importer
-from afm_tools import background_correction, gdef_sticher, gdef_indent_analyzer
+from afm_tools import background_correction, gdef_sticher, gdef_indent_analyzer, tiled_pyramid, \
+    parallel_correction, indent_batch_analysis, indent_result_cache, correlation, peak_utils
 from gdef_reader import gdef_measurement
 from gdef_reporter import plotter_utils
 
 module_list = [
     gdef_importer,
     gdef_indent_analyzer,
+    indent_batch_analysis,
+    indent_result_cache,
     gdef_measurement,
     gdef_sticher,
+    correlation,
+    peak_utils,
+    tiled_pyramid,
+    parallel_correction,
     background_correction,
     plotter_utils
 ]
@@ -2,7 +2,8 @@ from pathlib import Path
 
 import matplotlib.pyplot as plt
 
-from afm_tools.background_correction import BGCorrectionType
+from afm_tools.background_correction import BGCorrectionType, correct_background_all, \
+    select_best_background_correction
 from gdef_reader.gdef_importer import GDEFImporter
 
 gdf_path = Path.cwd().parent.joinpath("resources").joinpath("example_01.gdf")
@@ -22,15 +23,20 @@ measurement.comment = "imported (default settings)"
 #     fig = measurement.create_plot()
 #     fig.show()
 
-correction_summary_fig, axes = plt.subplots(3, 2, dpi=150, figsize=(8, 4.5))
+correction_summary_fig, axes = plt.subplots(4, 4, dpi=150, figsize=(14, 6))
 
 ax_list = axes.flatten()
 
-for i, correction_type in enumerate(BGCorrectionType):
-    measurement.correct_background(correction_type,keep_offset=True)
+# correct_background_all shares intermediate results between all BGCorrectionTypes
+corrected_dict = correct_background_all(measurement.values_original, keep_offset=True)
+for i, (correction_type, values) in enumerate(corrected_dict.items()):
+    measurement.values = values
     measurement.comment = correction_type.name
     measurement.set_topography_to_axes(ax_list[i], add_id=False)
 
+best_correction_type, _ = select_best_background_correction(measurement.values_original, metric="tilt")
+print(f"correction type with lowest residual tilt: {best_correction_type.name}")
+
 for ax in ax_list[len(BGCorrectionType):]:
     ax.remove()
 correction_summary_fig.tight_layout()
@@ -5,7 +5,7 @@ All the settings used during that specific measurement are stored in a GDEFSetti
 """
 import pickle
 from pathlib import Path
-from typing import Optional, Tuple, List
+from typing import Callable, Optional, Tuple, List
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -13,7 +13,8 @@ from matplotlib.axes import Axes
 from matplotlib.figure import Figure
 
 from afm_tools.background_correction import BGCorrectionType, \
-    correct_background
+    correct_background, BufferPool
+from afm_tools.parallel_correction import parallel_correct_background
 from gdef_reader.gdef_data_strucutres import GDEFHeader
 from gdef_reporter.plotter_utils import plot_to_ax
 
@@ -303,7 +304,8 @@ class GDEFMeasurement:
         figure_tight.tight_layout()
         return figure_tight
 
-    def correct_background(self, correction_type: BGCorrectionType = BGCorrectionType.legendre_1, keep_offset: bool = False):
+    def correct_background(self, correction_type: BGCorrectionType = BGCorrectionType.legendre_1, keep_offset: bool = False,
+                           mask: Optional[np.ndarray] = None, robust: bool = False):
         """
         Corrects background using the given correction_type on values_original and save the result in values.
         If keep_z_offset is True, the mean value of dataset is preserved. Otherwise the average value is set to zero.
@@ -312,11 +314,14 @@ class GDEFMeasurement:
 
         :param correction_type: select type of background correction
         :param keep_offset: If True (default) keeps average offset, otherwise average offset is reduced to 0.
+        :param mask: boolean ndarray; True for pixels (e.g. an indent), that should be ignored for the fit (default None)
+        :param robust: If True, use a robust fit, that is less sensitive to outliers (default False).
         :return: None
         """
         if not self.settings.source_channel == 11:  # only correct topography data
             return
-        self.values = correct_background(self.values_original, correction_type=correction_type, keep_offset=keep_offset)
+        self.values = correct_background(self.values_original, correction_type=correction_type, keep_offset=keep_offset,
+                                         mask=mask, robust=robust)
         self.background_correction_type = correction_type
 
     def get_summary_table_data(self) -> List[list]:  # todo: consider move method to utils.py
@@ -336,3 +341,76 @@ class GDEFMeasurement:
             result.append(["name", f"{self.gdf_basename}_block_{self.gdf_block_id:03}"])
 
         return result
+
+
+def batch_correct_background(measurements: List[GDEFMeasurement],
+                             correction_type: BGCorrectionType = BGCorrectionType.legendre_1,
+                             keep_offset: bool = False, buffer_pool: Optional[BufferPool] = None):
+    """
+    Corrects background for all given measurements (see GDEFMeasurement.correct_background). Each measurement is
+    corrected directly from values_original into its result array, so no stack of all measurements is created.
+    If a buffer_pool is given, the result is written into the existing measurement.values arrays where possible
+    (so old values arrays are overwritten!). Otherwise, a buffer from buffer_pool is used as new values array.
+    This way, peak memory is predictable and repeated corrections need no new allocations.
+
+    :param measurements: list of GDEFMeasurement
+    :param correction_type: select type of background correction
+    :param keep_offset: If True (default) keeps average offset, otherwise average offset is reduced to 0.
+    :param buffer_pool: optional BufferPool used for the values arrays of the measurements
+    :return: None
+    """
+    for measurement in measurements:
+        if not measurement.settings.source_channel == 11:  # only correct topography data
+            continue
+        if measurement.values_original is None:
+            measurement.correct_background(correction_type, keep_offset)
+            continue
+
+        out = None
+        if buffer_pool is not None:
+            if _is_reusable_buffer(measurement.values, measurement.values_original):
+                out = measurement.values
+            else:
+                out = buffer_pool.get(measurement.values_original.shape,
+                                      key=f"batch_correct_background_{id(measurement)}")
+        measurement.values = correct_background(measurement.values_original, correction_type, keep_offset, out=out)
+        measurement.background_correction_type = correction_type
+
+
+def parallel_batch_correct_background(measurements: List[GDEFMeasurement],
+                                      correction_type: BGCorrectionType = BGCorrectionType.legendre_1,
+                                      keep_offset: bool = False, max_workers: Optional[int] = None,
+                                      progress_callback: Optional[Callable[[int, int], None]] = None):
+    """
+    Same as batch_correct_background, but the measurements are corrected by a process pool
+    (see afm_tools.parallel_correction.parallel_correct_background). The values are passed to the workers via
+    shared memory, and the results are written back into the measurements in the given order.
+
+    :param measurements: list of GDEFMeasurement
+    :param correction_type: select type of background correction
+    :param keep_offset: If True (default) keeps average offset, otherwise average offset is reduced to 0.
+    :param max_workers: max. number of worker processes (default None -> number of CPUs)
+    :param progress_callback: optional callable(n_corrected, n_total), called whenever a worker task is finished
+    :return: None
+    """
+    topography = []
+    for measurement in measurements:
+        if not measurement.settings.source_channel == 11:  # only correct topography data
+            continue
+        if measurement.values_original is None:
+            measurement.correct_background(correction_type, keep_offset)
+            continue
+        topography.append(measurement)
+
+    corrected = parallel_correct_background([measurement.values_original for measurement in topography],
+                                            correction_type, keep_offset, max_workers=max_workers,
+                                            progress_callback=progress_callback)
+    for measurement, values in zip(topography, corrected):
+        measurement.values = values
+        measurement.background_correction_type = correction_type
+
+
+def _is_reusable_buffer(values: Optional[np.ndarray], values_original: np.ndarray) -> bool:
+    """Check, if values can be overwritten with corrected values_original."""
+    return (values is not None and values.shape == values_original.shape and values.dtype == np.float64
+            and values.flags.writeable and not np.shares_memory(values, values_original))
@@ -18,6 +18,7 @@ from gdef_reporter.pptx_styles import summary_table, position_2x2_00, position_2
 
 if TYPE_CHECKING:
     from afm_tools.gdef_indent_analyzer import GDEFIndentAnalyzer
+    from afm_tools.indent_result_cache import IndentResultCache
     from gdef_reader.gdef_importer import GDEFImporter
     from gdef_reader.gdef_measurement import GDEFMeasurement
 
@@ -78,14 +79,20 @@ def create_png_for_nanoindents(path: Path, png_save_path: Optional[Path] = None)
         print(png_save_path.joinpath(f"{measurement.pygdf_filename.stem + '.png'}"))
         figure.savefig(png_save_path.joinpath(f"{measurement.pygdf_filename.stem + '.png'}"),
                        dpi=96)  # , transparent=transparent)
-        indent_analyzer.add_indent_pile_up_mask_to_axes(figure.axes[0])
+        indent_analyzer.analyze_indent(roughness_part=0.05)
+        indent_analyzer.add_map_with_indent_pile_up_mask_to_axes(figure.axes[0], roughness_part=None)
         print(png_save_path.joinpath(f"{measurement.pygdf_filename.stem + '_masked.png'}"))
         figure.savefig(png_save_path.joinpath(f"{measurement.pygdf_filename.stem + '_masked.png'}"), dpi=96)
         figure.clear()
 
 
 # todo: move to ... ???
-def create_pptx_for_nanoindents(path, pptx_filename, pptx_template: Optional[AbstractTemplate] = None):
+def create_pptx_for_nanoindents(path, pptx_filename, pptx_template: Optional[AbstractTemplate] = None,
+                                result_cache: Optional[IndentResultCache] = None):
+    """
+    Create a pptx file with a slide for each \*.pygdf file in path, showing the measurement and the indent analysis.
+    If result_cache is given, the indent analysis is skipped for measurements already analyzed before.
+    """
     pptx = PPTXCreator(template=pptx_template)
     pptx.add_title_slide(f"AFM on Nanoindents - {path.stem}")
     measurements = load_pygdf_measurements(path)
@@ -103,10 +110,15 @@ def create_pptx_for_nanoindents(path, pptx_filename, pptx_template: Optional[Abs
         minimize_table_height(table_shape)
         # figure.savefig(f"{measurement.basename.with_suffix('.png')}")  # , transparent=transparent)
 
-        indent_analyzer.add_indent_pile_up_mask_to_axes(figure.axes[0], roughness_part=0.05)
+        if result_cache is None:
+            indent_analyzer.analyze_indent(roughness_part=0.05)
+            indent_result = indent_analyzer.get_indent_result()
+        else:
+            indent_result = result_cache.analyze(indent_analyzer, roughness_part=0.05)
+        indent_analyzer.add_map_with_indent_pile_up_mask_to_axes(figure.axes[0], roughness_part=None)
         # figure.savefig(f"{measurement.basename.with_name(measurement.basename.stem + '_masked.png')}", dpi=96)
         pptx.add_matplotlib_figure(figure, slide, position_2x2_10())
-        table_shape = pptx.add_table(slide, indent_analyzer.get_summary_table_data(), position_2x2_11(),
+        table_shape = pptx.add_table(slide, indent_analyzer.get_summary_table_data(indent_result), position_2x2_11(),
                                      table_style=summary_table())
         minimize_table_height(table_shape)
         figure.clear()
@@ -5,7 +5,7 @@ import os
 from collections import UserList
 from datetime import datetime
 from pathlib import Path
-from typing import List, Union
+from typing import Callable, List, Optional, Union
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -15,9 +15,10 @@ from pptx_tools.position import PPTXPosition
 from pptx_tools.table_style import PPTXTableStyle
 from pptx_tools.templates import TemplateExample
 
-from afm_tools.background_correction import BGCorrectionType
+from afm_tools.background_correction import BGCorrectionType, BufferPool
 from gdef_reader.gdef_importer import GDEFImporter
-from gdef_reader.gdef_measurement import GDEFMeasurement
+from gdef_reader.gdef_measurement import GDEFMeasurement, batch_correct_background, \
+    parallel_batch_correct_background
 from afm_tools.gdef_sticher import GDEFSticher
 from gdef_reporter.pptx_styles import summary_table, minimize_table_height
 
@@ -43,9 +44,19 @@ class GDEFContainer:
         return [x for x in self.measurements if x.gdf_block_id not in self.filter_ids]
 
     def correct_backgrounds(self, bg_correction_type: BGCorrectionType = BGCorrectionType.legendre_1,
-                            keep_offset: bool = False):
-        for measurement in self.measurements:
-            measurement.correct_background(bg_correction_type, keep_offset)
+                            keep_offset: bool = False, parallel: bool = False, max_workers: Optional[int] = None,
+                            progress_callback: Optional[Callable[[int, int], None]] = None,
+                            buffer_pool: Optional[BufferPool] = None):
+        """
+        Correct background for all measurements. If parallel is True, a process pool with max_workers is used
+        (see parallel_batch_correct_background). Otherwise, the results are written into buffers of buffer_pool,
+        if given (see batch_correct_background).
+        """
+        if parallel:
+            parallel_batch_correct_background(self.measurements, bg_correction_type, keep_offset, max_workers,
+                                              progress_callback)
+        else:
+            batch_correct_background(self.measurements, bg_correction_type, keep_offset, buffer_pool)
 
 
 class GDEFContainerList(UserList):
@@ -83,10 +94,21 @@ class GDEFContainerList(UserList):
         return self.add_iterable(items)
 
     def correct_backgrounds(self, bg_correction_type: BGCorrectionType = BGCorrectionType.legendre_1,
-                            keep_offset: bool = False):
-        """Correct background for all GDEFContainers in GDEFContainerList"""
-        for container in self:
-            container.correct_backgrounds(bg_correction_type, keep_offset)
+                            keep_offset: bool = False, parallel: bool = False, max_workers: Optional[int] = None,
+                            progress_callback: Optional[Callable[[int, int], None]] = None,
+                            buffer_pool: Optional[BufferPool] = None):
+        """
+        Correct background for all GDEFContainers in GDEFContainerList. If parallel is True, the measurements of
+        all containers are corrected by a process pool with max_workers (see parallel_batch_correct_background).
+        progress_callback(n_corrected, n_total) is only used if parallel is True, buffer_pool only if parallel is
+        False (see batch_correct_background).
+        """
+        measurements = [measurement for container in self for measurement in container.measurements]
+        if parallel:
+            parallel_batch_correct_background(measurements, bg_correction_type, keep_offset, max_workers,
+                                              progress_callback)
+        else:
+            batch_correct_background(measurements, bg_correction_type, keep_offset, buffer_pool)
 
     def set_filter_ids(self, filter_dict: dict):
         """
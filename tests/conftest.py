@@ -20,6 +20,7 @@ import pytest
 
 from afm_tools.gdef_sticher import GDEFSticher
 from gdef_reader.gdef_importer import GDEFImporter
+from gdef_reader.gdef_measurement import GDEFMeasurement
 
 AUTO_SHOW = True
 
@@ -88,3 +89,44 @@ def multiple_data_test_cases(request, gdef_measurements, data_mixed_dict):
         "mixed dict": data_mixed_dict
     }
     yield case_dict[request.param]
+
+
+def _create_indent_measurement(shape=(128, 160), center=(60, 70), pixel_width=5e-8) -> GDEFMeasurement:
+    """Synthetic measurement with a paraboloid indent (depth 100 nm) surrounded by a pile-up ring."""
+    rows, cols = np.ogrid[:shape[0], :shape[1]]
+    r = np.hypot(rows - center[0], cols - center[1]) * pixel_width
+    values = -1e-7 * np.clip(1 - (r / 1e-6) ** 2, 0, None) + 2e-8 * np.exp(-((r - 1.2e-6) / 2e-7) ** 2)
+    measurement = GDEFMeasurement()
+    measurement.settings._pixel_width = pixel_width
+    measurement.settings._pixel_height = pixel_width
+    measurement._values_original = values
+    measurement.values = values.copy()
+    return measurement
+
+
+def _create_indent_array_measurement(centers, shape=(192, 256), pixel_width=5e-8, depths=None) -> GDEFMeasurement:
+    """Synthetic measurement with several indents (like _create_indent_measurement)."""
+    values = np.zeros(shape)
+    depths = depths or [1e-7] * len(centers)
+    rows, cols = np.ogrid[:shape[0], :shape[1]]
+    for center, depth in zip(centers, depths):
+        r = np.hypot(rows - center[0], cols - center[1]) * pixel_width
+        values += -depth * np.clip(1 - (r / 1e-6) ** 2, 0, None) + 0.2 * depth * np.exp(-((r - 1.2e-6) / 2e-7) ** 2)
+    measurement = GDEFMeasurement()
+    measurement.settings._pixel_width = pixel_width
+    measurement.settings._pixel_height = pixel_width
+    measurement._values_original = values
+    measurement.values = values.copy()
+    return measurement
+
+
+@pytest.fixture(scope='session')
+def indent_measurement_factory():
+    """factory for synthetic measurements with one indent: factory(shape, center, pixel_width)"""
+    yield _create_indent_measurement
+
+
+@pytest.fixture(scope='session')
+def indent_array_measurement_factory():
+    """factory for synthetic measurements with several indents: factory(centers, shape, pixel_width, depths)"""
+    yield _create_indent_array_measurement
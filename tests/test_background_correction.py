@@ -2,10 +2,17 @@
 This file contains tests for background_corrections.py.
 @author: Nathanael Jöhrmann
 """
+import tracemalloc
+
 import numpy as np
 import pytest
 
-from afm_tools.background_correction import BGCorrectionType, correct_background
+from numpy.polynomial import Legendre
+
+from afm_tools.background_correction import BGCorrectionType, correct_background, subtract_mean_gradient_plane, \
+    nansubtract_mean_gradient_plane, subtract_mean_level, subtract_legendre_fit, correct_background_stack, \
+    subtract_polynomial_surface_fit, subtract_weighted_fit, correct_background_all, get_correction_quality, \
+    select_best_background_correction, BufferPool
 
 # -------------------------------------------------------------------------------------------------------------
 # --------------------------------------- immutable testcases ------------------------------------------------
@@ -68,27 +75,32 @@ class TestBackgroundCorrectionTypes:
     @pytest.mark.parametrize("correction", [c for c in BGCorrectionType if not c == BGCorrectionType.raw_data])
     def test_y_tilted_plane(self, correction):
         result = correct_background(np.array(y_tilted_plane), correction, keep_offset=True)
-        if correction is BGCorrectionType.legendre_0:
+        if correction in [BGCorrectionType.legendre_0, BGCorrectionType.line_median, BGCorrectionType.line_mean]:
             assert np.all(np.isclose(result, y_tilted_plane))
         else:
             assert np.all(np.isclose(result, offset_plane))
 
         result = correct_background(np.array(y_tilted_plane), correction, keep_offset=False)
-        if correction is BGCorrectionType.legendre_0:
+        if correction in [BGCorrectionType.legendre_0, BGCorrectionType.line_median, BGCorrectionType.line_mean]:
             assert np.all(np.isclose(result, (y_tilted_plane - np.mean(y_tilted_plane))))
         else:
             assert np.all(np.isclose(result, zero_plane))
 
     @pytest.mark.parametrize("correction", [c for c in BGCorrectionType if not c == BGCorrectionType.raw_data])
     def test_curved_plane(self, correction):
+        not_corrected = [BGCorrectionType.legendre_0, BGCorrectionType.legendre_1, BGCorrectionType.gradient,
+                         BGCorrectionType.surface_1, BGCorrectionType.line_median, BGCorrectionType.line_mean,
+                         BGCorrectionType.line_legendre_1]
         result = correct_background(np.array(curved_plane), correction, keep_offset=True)
-        if correction in [BGCorrectionType.legendre_0, BGCorrectionType.legendre_1, BGCorrectionType.gradient]:
+        if correction in not_corrected:
             assert np.all(np.isclose(result, curved_plane))
         else:
             assert np.all(np.isclose(result, (zero_plane + np.mean(curved_plane))))
 
         result = correct_background(np.array(curved_plane), correction, keep_offset=False)
-        if correction in [BGCorrectionType.legendre_0, BGCorrectionType.legendre_1, BGCorrectionType.gradient]:
+        if correction is BGCorrectionType.line_median:  # median (1) is not equal to mean (2/3)
+            assert np.all(np.isclose(result, np.array(curved_plane) - 1))
+        elif correction in not_corrected:
             assert np.all(np.isclose(result, (curved_plane - np.mean(curved_plane))))
         else:
             assert np.all(np.isclose(result, zero_plane))
@@ -97,3 +109,375 @@ class TestBackgroundCorrectionTypes:
     def test_none(self, correction):
         result = correct_background(None, correction, keep_offset=False)
         assert result is None
+
+
+def _subtract_mean_gradient_plane_loop(array2d: np.ndarray, keep_offset: bool = False) -> np.ndarray:
+    """Reference implementation (per pixel loop) used before vectorizing subtract_mean_gradient_plane."""
+    result = array2d.copy()
+    value_gradient = np.gradient(array2d)
+    mean_value_gradient_x = value_gradient[0].mean()
+    mean_value_gradient_y = value_gradient[1].mean()
+    for (nx, ny), _ in np.ndenumerate(array2d):
+        result[nx, ny] = array2d[nx, ny] - nx * mean_value_gradient_x - ny * mean_value_gradient_y
+    if keep_offset:
+        result = result + (array2d.mean() - result.mean())
+    else:
+        result = subtract_mean_level(result)
+    return result
+
+
+class TestMeanGradientPlane:
+    @pytest.mark.parametrize("keep_offset", [True, False])
+    def test_same_result_as_loop(self, random_ndarray2d_data, keep_offset):
+        data = random_ndarray2d_data + np.arange(256)[:, np.newaxis] * 1e-8
+        expected = _subtract_mean_gradient_plane_loop(data, keep_offset)
+        assert np.allclose(subtract_mean_gradient_plane(data, keep_offset), expected, rtol=0, atol=1e-20)
+
+    def test_single_row_integer_data(self):
+        data = np.array([[1, 2, 6]])  # no gradient along axis 0
+        with pytest.warns(UserWarning):
+            result = subtract_mean_gradient_plane(data)
+        assert result.dtype == np.float64
+        assert np.allclose(result, [[-2, -1, 3]])
+        with pytest.warns(UserWarning):
+            assert np.array_equal(subtract_mean_gradient_plane(data, keep_offset=True), data)
+        with pytest.warns(UserWarning):
+            assert np.allclose(nansubtract_mean_gradient_plane(data), [[-2, -1, 3]])
+
+    @pytest.mark.parametrize("keep_offset", [True, False])
+    def test_nan_variant(self, random_ndarray2d_data, keep_offset):
+        data = random_ndarray2d_data.copy()
+        # without NaN, nansubtract_mean_gradient_plane gives the same result
+        assert np.allclose(nansubtract_mean_gradient_plane(data, keep_offset),
+                           subtract_mean_gradient_plane(data, keep_offset))
+
+        data = np.add.outer(np.arange(8) * 0.5, np.arange(6) * 2.0)  # tilted plane
+        data[5, :] = np.nan
+        result = nansubtract_mean_gradient_plane(data, keep_offset)
+        assert np.all(np.isnan(result[5]))
+        assert np.allclose(np.delete(result, 5, axis=0), np.nanmean(data) if keep_offset else 0)
+
+
+def _subtract_legendre_fit_reference(array2d: np.ndarray, keep_offset: bool = False, deg: int = 1) -> np.ndarray:
+    """Reference implementation using Legendre.fit for each measurement (used before caching the legendre basis)."""
+    n_row = np.linspace(-1, 1, array2d.shape[0])
+    n_col = np.linspace(-1, 1, array2d.shape[1])
+    fit_x = Legendre.fit(n_row, array2d.mean(axis=1), deg)
+    fit_y = Legendre.fit(n_col, array2d.mean(axis=0), deg)
+    result = (array2d.transpose() - fit_x(n_row)).transpose() - fit_y(n_col)
+    return result + (2 if keep_offset else 1) * array2d.mean()
+
+
+@pytest.fixture(scope='session')
+def random_stack():
+    rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(2)))
+    rows, cols = np.meshgrid(np.linspace(-1, 1, 64), np.linspace(-1, 1, 48), indexing='ij')
+    background = [i * rows + (2 - i) * cols ** 2 + 0.5 * rows ** 3 for i in range(5)]
+    yield rs.random((5, 64, 48)) * 0.1 + np.array(background)
+
+
+class TestLegendreFit:
+    @pytest.mark.parametrize("deg", [1, 2, 3])
+    @pytest.mark.parametrize("keep_offset", [True, False])
+    def test_same_result_as_legendre_fit(self, random_stack, deg, keep_offset):
+        for array2d in random_stack:
+            assert np.allclose(subtract_legendre_fit(array2d, keep_offset, deg),
+                               _subtract_legendre_fit_reference(array2d, keep_offset, deg))
+
+    @pytest.mark.parametrize("correction", [c for c in BGCorrectionType])
+    @pytest.mark.parametrize("keep_offset", [True, False])
+    def test_correct_background_stack(self, random_stack, correction, keep_offset):
+        result = correct_background_stack(random_stack, correction, keep_offset)
+        assert result.shape == random_stack.shape
+        for array2d, corrected in zip(random_stack, result):
+            assert np.allclose(corrected, correct_background(array2d, correction, keep_offset))
+
+    def test_correct_background_stack_none(self):
+        assert correct_background_stack(None, BGCorrectionType.legendre_1) is None
+
+
+def _subtract_polynomial_surface_fit_reference(array2d: np.ndarray, deg: int) -> np.ndarray:
+    """Reference implementation using a full design matrix and np.linalg.lstsq."""
+    rows, cols = np.meshgrid(np.linspace(-1, 1, array2d.shape[0]), np.linspace(-1, 1, array2d.shape[1]),
+                             indexing='ij')
+    terms = [rows ** i * cols ** j for i in range(deg + 1) for j in range(deg + 1 - i)]
+    design_matrix = np.stack([term.ravel() for term in terms], axis=1)
+    coefficients, *_ = np.linalg.lstsq(design_matrix, array2d.ravel(), rcond=None)
+    return array2d - (design_matrix @ coefficients).reshape(array2d.shape)
+
+
+class TestPolynomialSurfaceFit:
+    @pytest.mark.parametrize("deg", [1, 2, 3, 4, 5])
+    def test_same_result_as_lstsq(self, random_stack, deg):
+        for array2d in random_stack:
+            assert np.allclose(subtract_polynomial_surface_fit(array2d, deg=deg),
+                               _subtract_polynomial_surface_fit_reference(array2d, deg))
+
+    def test_cross_term(self):
+        rows, cols = np.meshgrid(np.linspace(0, 3, 20), np.linspace(-2, 5, 30), indexing='ij')
+        warped_plane = 3 + rows - 2 * cols + 0.5 * rows * cols
+        result = correct_background(warped_plane, BGCorrectionType.surface_2, keep_offset=True)
+        assert np.allclose(result, np.mean(warped_plane))
+        # legendre fits of row and column means can't remove the cross term
+        result = correct_background(warped_plane, BGCorrectionType.legendre_3, keep_offset=True)
+        assert not np.allclose(result, np.mean(warped_plane))
+
+    def test_stack(self, random_stack):
+        result = subtract_polynomial_surface_fit(random_stack, keep_offset=True, deg=3)
+        for array2d, corrected in zip(random_stack, result):
+            assert np.allclose(corrected, subtract_polynomial_surface_fit(array2d, keep_offset=True, deg=3))
+            assert np.isclose(corrected.mean(), array2d.mean())
+
+
+@pytest.fixture(scope='session')
+def tilted_plane_with_indent():
+    rows, cols = np.meshgrid(np.arange(60), np.arange(80), indexing='ij')
+    plane = 0.2 * rows - 0.1 * cols + 0.01 * rows * cols
+    indent_mask = (rows - 25) ** 2 + (cols - 30) ** 2 < 15 ** 2
+    yield plane - 20 * indent_mask, indent_mask
+
+
+class TestWeightedFit:
+    @pytest.mark.parametrize("deg", [0, 1, 2, 3])
+    def test_equal_weights_like_unweighted(self, random_stack, deg):
+        weights = np.ones(random_stack.shape[1:])
+        for array2d in random_stack:
+            assert np.allclose(subtract_weighted_fit(array2d, weights, True, deg, additive=True),
+                               subtract_legendre_fit(array2d, True, deg))
+            assert np.allclose(subtract_weighted_fit(array2d, weights, True, deg, additive=False),
+                               subtract_polynomial_surface_fit(array2d, True, deg))
+
+    @pytest.mark.parametrize("correction", [c for c in BGCorrectionType if c not in
+                                            [BGCorrectionType.raw_data, BGCorrectionType.gradient,
+                                             BGCorrectionType.legendre_0,
+                                             BGCorrectionType.legendre_1, BGCorrectionType.legendre_2,
+                                             BGCorrectionType.legendre_3, BGCorrectionType.surface_1,
+                                             BGCorrectionType.line_median, BGCorrectionType.line_mean]])
+    def test_masked(self, tilted_plane_with_indent, correction):
+        data, indent_mask = tilted_plane_with_indent
+        result = correct_background(data, correction, mask=indent_mask)
+        assert np.allclose(result[~indent_mask], 0)
+        assert np.allclose(result[indent_mask], -20)
+
+        unmasked_result = correct_background(data, correction)
+        assert not np.allclose(unmasked_result[~indent_mask], unmasked_result[~indent_mask].mean())
+
+    def test_masked_gradient(self):
+        rows, cols = np.meshgrid(np.arange(30), np.arange(40), indexing='ij')
+        data = 0.2 * rows - 0.1 * cols
+        mask = cols > 30
+        data[mask] += 2 * (cols[mask] - 30)  # asymmetric structure on the right side
+        mask[:, 30] = True  # gradient at edge of structure
+        result = correct_background(data, BGCorrectionType.gradient, mask=mask)
+        assert np.allclose(result[~mask], 0)
+
+    def test_masked_keep_offset(self, tilted_plane_with_indent):
+        data, indent_mask = tilted_plane_with_indent
+        result = correct_background(data, BGCorrectionType.surface_2, keep_offset=True, mask=indent_mask)
+        assert np.isclose(result.mean(), data.mean())
+
+    def test_robust(self, tilted_plane_with_indent, random_ndarray2d_data):
+        data, indent_mask = tilted_plane_with_indent
+        data = data + random_ndarray2d_data[:60, :80]  # noise
+        result = correct_background(data, BGCorrectionType.surface_2, robust=True)
+        assert np.allclose(result[~indent_mask], 0, atol=1e-2)
+        assert np.allclose(result[indent_mask], -20, atol=1e-2)
+        unmasked_result = correct_background(data, BGCorrectionType.surface_2)
+        assert not np.allclose(unmasked_result[~indent_mask], 0, atol=1)
+
+    def test_robust_not_available_for_gradient(self, tilted_plane_with_indent):
+        with pytest.raises(ValueError):
+            correct_background(tilted_plane_with_indent[0], BGCorrectionType.gradient, robust=True)
+
+
+@pytest.fixture(scope='session')
+def data_with_line_offsets():
+    rows, cols = np.meshgrid(np.arange(40), np.linspace(-1, 1, 50), indexing='ij')
+    line_offsets = np.sin(rows * 1.3) * 5
+    line_tilts = np.cos(rows * 0.7) * 2 * cols
+    yield line_offsets + line_tilts + 0.5 * cols ** 2, line_offsets, line_tilts
+
+
+class TestLineLeveling:
+    def test_line_mean_and_median(self, data_with_line_offsets):
+        data, line_offsets, _ = data_with_line_offsets
+        result = correct_background(data, BGCorrectionType.line_mean)
+        assert np.allclose(result, correct_background(data - line_offsets, BGCorrectionType.line_mean))
+        result = correct_background(data, BGCorrectionType.line_median)
+        assert np.allclose(result, correct_background(data - line_offsets, BGCorrectionType.line_median))
+
+    @pytest.mark.parametrize("correction, deg", [(BGCorrectionType.line_legendre_1, 1),
+                                                 (BGCorrectionType.line_legendre_2, 2),
+                                                 (BGCorrectionType.line_legendre_3, 3)])
+    def test_line_legendre(self, data_with_line_offsets, correction, deg):
+        data, _, _ = data_with_line_offsets
+        result = correct_background(data, correction, keep_offset=True)
+        n_col = np.linspace(-1, 1, data.shape[1])
+        for line, corrected in zip(data, result):
+            expected = line - Legendre.fit(n_col, line, deg)(n_col) + data.mean()
+            assert np.allclose(corrected, expected)
+        if deg > 1:
+            assert np.allclose(result, data.mean())
+
+    @pytest.mark.parametrize("correction", [BGCorrectionType.line_median, BGCorrectionType.line_mean,
+                                            BGCorrectionType.line_legendre_1])
+    def test_masked_line_leveling(self, data_with_line_offsets, correction):
+        _, line_offsets, line_tilts = data_with_line_offsets
+        data = line_offsets + line_tilts if correction is BGCorrectionType.line_legendre_1 else line_offsets.copy()
+        mask = np.zeros(data.shape, dtype=bool)
+        mask[10:20, 30:40] = True
+        data[mask] += 100
+        result = correct_background(data, correction, mask=mask)
+        assert np.allclose(result[~mask], 0)
+        assert np.allclose(result[mask], 100)
+
+
+class TestCorrectBackgroundAll:
+    @pytest.mark.parametrize("keep_offset", [True, False])
+    def test_same_result_as_correct_background(self, random_stack, keep_offset):
+        result = correct_background_all(random_stack[0], keep_offset=keep_offset)
+        assert list(result) == list(BGCorrectionType)
+        for correction_type, corrected in result.items():
+            assert np.allclose(corrected, correct_background(random_stack[0], correction_type, keep_offset))
+
+    def test_stack(self, random_stack):
+        correction_types = [BGCorrectionType.gradient, BGCorrectionType.surface_2, BGCorrectionType.line_legendre_1]
+        result = correct_background_all(random_stack, correction_types)
+        assert list(result) == correction_types
+        for correction_type, corrected in result.items():
+            assert np.allclose(corrected, correct_background_stack(random_stack, correction_type))
+
+    def test_get_correction_quality(self):
+        data = np.add.outer(np.arange(10) * 0.5, np.arange(20) * -0.25)
+        data[:, 5] = np.nan
+        quality = get_correction_quality(data)
+        assert np.isclose(quality["tilt_x"], 0.5)
+        assert np.isclose(quality["tilt_y"], -0.25)
+        assert np.isclose(quality["tilt"], np.hypot(0.5, 0.25))
+        assert np.isclose(quality["rms"], np.nanstd(data))
+
+        quality = get_correction_quality(np.stack([data, data * 2]))
+        assert np.allclose(quality["tilt_x"], [0.5, 1.0])
+
+    def test_select_best_background_correction(self):
+        rows, cols = np.meshgrid(np.linspace(-1, 1, 30), np.linspace(-1, 1, 40), indexing='ij')
+        data = rows ** 2 + 0.3 * cols
+        correction_types = [BGCorrectionType.raw_data, BGCorrectionType.legendre_1, BGCorrectionType.legendre_2]
+        best, quality_dict = select_best_background_correction(data, correction_types)
+        assert best is BGCorrectionType.legendre_2
+        assert list(quality_dict) == correction_types
+        best, _ = select_best_background_correction(data, correction_types[:2], metric="tilt")
+        assert best is BGCorrectionType.legendre_1
+
+    def test_select_prefers_less_flexible_correction(self):
+        rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(11)))
+        rows, cols = np.meshgrid(np.linspace(-1, 1, 30), np.linspace(-1, 1, 40), indexing='ij')
+        data = 0.5 * rows + 0.3 * cols + 0.01 * rs.random((30, 40))
+        best, quality_dict = select_best_background_correction(data)
+        assert best is BGCorrectionType.legendre_1
+        best, _ = select_best_background_correction(data, tolerance=0)
+        assert best is min(quality_dict, key=lambda x: quality_dict[x]["rms"])
+
+    def test_select_stack_raises(self, random_stack):
+        with pytest.raises(ValueError):
+            select_best_background_correction(random_stack)
+
+
+class TestOutAndInplace:
+    @pytest.mark.parametrize("correction", [c for c in BGCorrectionType])
+    @pytest.mark.parametrize("keep_offset", [True, False])
+    def test_out(self, random_stack, correction, keep_offset):
+        expected = correct_background(random_stack[0], correction, keep_offset)
+        out = np.empty(random_stack[0].shape)
+        result = correct_background(random_stack[0], correction, keep_offset, out=out)
+        assert result is out
+        assert np.allclose(out, expected)
+
+        data = random_stack[0].copy()
+        result = correct_background(data, correction, keep_offset, inplace=True)
+        assert result is data
+        assert np.allclose(data, expected)
+
+    def test_inplace_integer_data_raises(self):
+        data = np.arange(12).reshape(3, 4)
+        with pytest.raises(TypeError):
+            correct_background(data, BGCorrectionType.legendre_1, inplace=True)
+        with pytest.raises(TypeError):
+            correct_background_stack(data[np.newaxis], BGCorrectionType.legendre_1, inplace=True)
+        with pytest.raises(TypeError):
+            correct_background(data.astype(float), BGCorrectionType.legendre_1, out=np.empty((3, 4), dtype=int))
+        assert np.array_equal(data, np.arange(12).reshape(3, 4))
+
+    @pytest.mark.parametrize("correction", [c for c in BGCorrectionType])
+    def test_stack_inplace(self, random_stack, correction):
+        expected = correct_background_stack(random_stack, correction)
+        stack = random_stack.copy()
+        assert correct_background_stack(stack, correction, inplace=True) is stack
+        assert np.allclose(stack, expected)
+
+    @pytest.mark.parametrize("correction", [BGCorrectionType.gradient, BGCorrectionType.legendre_3,
+                                            BGCorrectionType.surface_5, BGCorrectionType.line_legendre_2])
+    def test_no_full_size_temporaries(self, correction):
+        data = np.random.default_rng(0).random((1024, 1024))
+        correct_background(data, correction, inplace=True)  # fill caches
+        tracemalloc.start()
+        correct_background(data, correction, inplace=True)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert peak < data.nbytes / 2
+
+    def test_buffer_pool(self):
+        pool = BufferPool()
+        buffer = pool.get((2, 3))
+        assert buffer.shape == (2, 3) and buffer.dtype == np.float64
+        assert pool.get((2, 3)) is buffer
+        assert pool.get((2, 3), key="other") is not buffer
+        assert pool.get((2, 3), dtype=np.float32) is not buffer
+        assert pool.nbytes == 2 * 6 * 8 + 6 * 4
+        pool.clear()
+        assert pool.nbytes == 0
+
+
+@pytest.fixture(scope='session')
+def stiched_like_data(random_ndarray2d_data):
+    rows, cols = np.meshgrid(np.arange(50), np.arange(120), indexing='ij')
+    data = 0.1 * rows + 0.05 * cols + random_ndarray2d_data[:50, :120]
+    data[:8, 70:] = np.nan  # padding of stiched data
+    data[45:, :30] = np.nan
+    yield data
+
+
+class TestNaNAware:
+    @pytest.mark.parametrize("correction", [c for c in BGCorrectionType])
+    @pytest.mark.parametrize("keep_offset", [True, False])
+    def test_nan_like_mask(self, stiched_like_data, correction, keep_offset):
+        nan_mask = np.isnan(stiched_like_data)
+        result = correct_background(stiched_like_data, correction, keep_offset)
+        assert np.all(np.isnan(result[nan_mask]))
+        assert not np.any(np.isnan(result[~nan_mask]))
+
+        filled_data = np.where(nan_mask, 1e3, stiched_like_data)  # arbitrary values at masked pixels
+        expected = correct_background(filled_data, correction, keep_offset, mask=nan_mask)
+        # gradient at the edge of masked pixels and mean offset (keep_offset) depend on masked values
+        if correction in [BGCorrectionType.raw_data, BGCorrectionType.gradient] or keep_offset:
+            expected = correct_background(stiched_like_data, correction, keep_offset, mask=nan_mask)
+        assert np.allclose(result[~nan_mask], expected[~nan_mask])
+
+    @pytest.mark.parametrize("correction", [BGCorrectionType.gradient, BGCorrectionType.legendre_1,
+                                            BGCorrectionType.surface_1, BGCorrectionType.line_legendre_1])
+    def test_level_tilted_plane_with_nan(self, stiched_like_data, correction):
+        result = correct_background(stiched_like_data, correction)
+        assert np.nanmax(np.abs(result)) < 1e-6
+        assert np.isclose(np.nanmean(result), 0)
+
+    def test_stack_and_all_with_nan(self, stiched_like_data):
+        stack = np.stack([stiched_like_data, stiched_like_data * 2])
+        result = correct_background_stack(stack, BGCorrectionType.legendre_1)
+        assert np.allclose(result[1], correct_background(stack[1], BGCorrectionType.legendre_1), equal_nan=True)
+        assert np.nanmax(np.abs(result)) < 1e-5
+        result_dict = correct_background_all(stiched_like_data, [BGCorrectionType.surface_2])
+        assert np.allclose(result_dict[BGCorrectionType.surface_2],
+                           correct_background(stiched_like_data, BGCorrectionType.surface_2), equal_nan=True)
+
+    def test_subtract_mean_level(self, stiched_like_data):
+        assert np.isclose(np.nanmean(subtract_mean_level(stiched_like_data)), 0)
@@ -0,0 +1,227 @@
+"""
+This file contains tests for gdef_indent_analyzer.py.
+@author: Nathanael Jöhrmann
+"""
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from afm_tools.gdef_indent_analyzer import GDEFIndentAnalyzer, _pixel_distance_grid, _centered_distance_grid, \
+    _label_minimum_positions, _label_maxima
+
+
+def _indent_pile_up_area_mask_loop(analyzer: GDEFIndentAnalyzer, roughness_part=0.05):
+    """Reference implementation looping over all pixels (used before vectorization)."""
+    values = analyzer.measurement.values
+    minimum = np.min(values)
+    radius = abs(7 * minimum)
+    center = np.unravel_index(np.argmin(values), values.shape)
+    below_surface_limit = roughness_part * minimum
+    result = np.zeros((values.shape[0], values.shape[1], 4))
+    for index, value in np.ndenumerate(values):
+        distance = ((index[0] - center[0]) ** 2 + (index[1] - center[1]) ** 2) ** 0.5
+        if analyzer.measurement.settings.pixel_width * distance <= radius:
+            if value < below_surface_limit:
+                result[index] = (0, 0, 1, 0.6)
+            elif value > abs(below_surface_limit):
+                result[index] = (0, 1, 0, 0.6)
+            else:
+                result[index] = (0, 0, 0, 0.1)
+    return result
+
+
+@pytest.fixture(scope='function')
+def indent_measurement(indent_measurement_factory):
+    yield indent_measurement_factory()
+
+
+class TestGDEFIndentAnalyzer:
+    def test_minimum_position(self, indent_measurement):
+        assert GDEFIndentAnalyzer(indent_measurement)._get_minimum_position() == (60, 70)
+
+    def test_indent_pile_up_area_mask(self, indent_measurement):
+        analyzer = GDEFIndentAnalyzer(indent_measurement)
+        result = analyzer._get_indent_pile_up_area_mask()
+        assert np.array_equal(result, _indent_pile_up_area_mask_loop(analyzer))
+        assert len(analyzer.indent) == np.count_nonzero(result[..., 2])
+        assert len(analyzer.pileup) == np.count_nonzero(result[..., 1])
+
+    def test_calc_volume_with_radius(self, indent_measurement):
+        analyzer = GDEFIndentAnalyzer(indent_measurement)
+        # radius = 7 * 100 nm = 0.7 µm -> volume of paraboloid cut at 0.7 µm
+        r = 0.7e-6
+        expected = -1e-7 * np.pi * (r ** 2 - r ** 4 / (2 * 1e-6 ** 2))
+        assert np.isclose(analyzer._calc_volume_with_radius(), expected, rtol=0.02)
+
+    def test_masks(self, indent_measurement):
+        analyzer = GDEFIndentAnalyzer(indent_measurement)
+        assert analyzer.indent_mask is None and analyzer.label_mask is None and analyzer.indent == []
+        result = analyzer._get_indent_pile_up_area_mask()
+        assert np.array_equal(analyzer.indent_mask, result[..., 2] > 0)
+        assert np.array_equal(analyzer.pileup_mask, result[..., 1] > 0)
+        assert np.array_equal(analyzer.surface_mask, np.isclose(result[..., 3], 0.1))
+        assert not np.any(analyzer.indent_mask & analyzer.pileup_mask)
+
+        label_mask = analyzer.label_mask
+        assert np.array_equal(label_mask == GDEFIndentAnalyzer.label_indent, analyzer.indent_mask)
+        assert np.array_equal(label_mask == GDEFIndentAnalyzer.label_pileup, analyzer.pileup_mask)
+        assert np.array_equal(label_mask == GDEFIndentAnalyzer.label_surface, analyzer.surface_mask)
+        assert analyzer.indent == list(zip(*np.nonzero(analyzer.indent_mask)))
+
+    def test_masks_are_reset(self, indent_measurement):
+        analyzer = GDEFIndentAnalyzer(indent_measurement)
+        analyzer._get_indent_pile_up_area_mask()
+        n_indent = np.count_nonzero(analyzer.indent_mask)
+        analyzer._get_indent_pile_up_area_mask()
+        assert len(analyzer.indent) == n_indent
+
+    def test_calc_area_and_volume(self, indent_measurement):
+        analyzer = GDEFIndentAnalyzer(indent_measurement)
+        analyzer._get_indent_pile_up_area_mask()
+        pixel_area = indent_measurement.settings.pixel_area()
+        area, volume = analyzer._calc_area_and_volume(analyzer.indent_mask)
+        assert np.isclose(area, len(analyzer.indent) * pixel_area)
+        assert np.isclose(volume, sum(abs(indent_measurement.values[index]) * pixel_area
+                                      for index in analyzer.indent))
+        assert analyzer._calc_area_and_volume(None) == (0, 0)
+
+    @pytest.mark.parametrize("shape", [(600, 40), (1024, 1100)])
+    def test_large_shapes(self, shape, indent_measurement_factory):
+        analyzer = GDEFIndentAnalyzer(indent_measurement_factory(shape, center=(shape[0] - 5, 20), pixel_width=1e-8))
+        result = analyzer._get_indent_pile_up_area_mask()
+        assert result.shape == (*shape, 4)
+        assert np.count_nonzero(result[..., 2])
+
+    def test_summary_table_data(self, indent_measurement):
+        analyzer = GDEFIndentAnalyzer(indent_measurement)
+        analyzer._get_indent_pile_up_area_mask()
+        table = dict(analyzer.get_summary_table_data())
+        pixel_area = indent_measurement.settings.pixel_area()
+        assert table["indent area [m^2]"] == f"{len(analyzer.indent) * pixel_area:.2e}"
+        assert table["radius [m]"] == f"{7e-7:.2e}"
+
+    def test_indent_mask_2048(self, indent_measurement_factory):
+        analyzer = GDEFIndentAnalyzer(indent_measurement_factory((2048, 2048), center=(1000, 1100), pixel_width=1e-8))
+        analyzer._get_indent_pile_up_area_mask()
+        rows, cols = np.ogrid[:2048, :2048]
+        assert np.array_equal(analyzer.indent_mask, np.hypot(rows - 1000, cols - 1100) <= 70)  # radius 0.7 µm
+
+
+class TestPixelDistanceGrid:
+    def test_pixel_distance_grid(self):
+        grid = _pixel_distance_grid((5, 7), (1, 2))
+        assert grid.shape == (5, 7)
+        assert grid[1, 2] == 0
+        assert grid[4, 6] == 5
+        assert not grid.flags.writeable
+
+    @pytest.mark.parametrize("center", [(0, 0), (4, 6), (2, 3), (4, 0)])
+    def test_same_as_hypot(self, center):
+        rows, cols = np.ogrid[:5, :7]
+        assert np.array_equal(_pixel_distance_grid((5, 7), center), np.hypot(rows - center[0], cols - center[1]))
+
+    def test_cache_is_shared(self, indent_measurement_factory):
+        _centered_distance_grid.cache_clear()
+        measurements = [indent_measurement_factory() for _ in range(3)]
+        for measurement in measurements:
+            GDEFIndentAnalyzer(measurement)._get_indent_pile_up_area_mask()
+        cache_info = _centered_distance_grid.cache_info()
+        assert cache_info.misses == 1
+        assert cache_info.hits == 2
+
+    def test_one_grid_per_shape(self):
+        _centered_distance_grid.cache_clear()
+        for i in range(20):
+            _pixel_distance_grid((16, 16), (i % 16, 0))
+        assert _centered_distance_grid.cache_info().currsize == 1
+
+    def test_cache_is_bounded(self):
+        _centered_distance_grid.cache_clear()
+        for i in range(20):
+            _pixel_distance_grid((16, 10 + i), (0, 0))
+        assert _centered_distance_grid.cache_info().currsize == _centered_distance_grid.cache_info().maxsize
+
+
+class TestDetectIndents:
+    def test_single_indent_like_analyze_indent(self, indent_measurement):
+        analyzer = GDEFIndentAnalyzer(indent_measurement)
+        analyzer.analyze_indent()
+        expected = analyzer.get_indent_result()
+        expected_indent_mask = analyzer.indent_mask.copy()
+
+        results = analyzer.detect_indents()
+        assert len(results) == 1
+        for key, value in expected.items():
+            if key != "z_max":  # z_max of detect_indents is taken only within radius of each indent
+                assert np.isclose(results[0][key], value), key
+        assert np.array_equal(analyzer.indent_mask, expected_indent_mask)
+
+    def test_indent_array(self, indent_measurement_factory, indent_array_measurement_factory):
+        centers = [(40, 50), (40, 130), (40, 210), (150, 50), (150, 130), (150, 210)]
+        depths = [1e-7, 0.8e-7, 1.1e-7, 0.9e-7, 1e-7, 0.7e-7]
+        analyzer = GDEFIndentAnalyzer(indent_array_measurement_factory(centers, depths=depths))
+        results = analyzer.detect_indents()
+        assert [(result["center_row"], result["center_col"]) for result in results] == centers
+        assert np.allclose([result["z_min"] for result in results], np.negative(depths), rtol=0.01)
+        assert set(np.unique(analyzer.indent_labels)) == set(range(len(centers) + 1))
+
+        for result in results:  # compare to a single indent analysis of each indent
+            single = GDEFIndentAnalyzer(indent_measurement_factory(
+                shape=(192, 256), center=(int(result["center_row"]), int(result["center_col"]))))
+            depth = -result["z_min"] / 1e-7
+            single.measurement.values = single.measurement.values * depth
+            single.analyze_indent()
+            single_result = single.get_indent_result()
+            assert np.isclose(result["indent_area"], single_result["indent_area"], rtol=0.05)
+            assert np.isclose(result["indent_volume"], single_result["indent_volume"], rtol=0.05)
+
+    def test_label_statistics_like_ndimage(self):
+        rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(12)))
+        values = rs.random((60, 80))
+        labels, n_labels = ndimage.label(values < 0.3)
+        label_ids = list(range(1, n_labels + 1))
+        assert _label_minimum_positions(values, labels, label_ids) == \
+            [tuple(map(int, position)) for position in ndimage.minimum_position(values, labels, label_ids)]
+        assert np.array_equal(_label_maxima(values, labels, n_labels), ndimage.maximum(values, labels, label_ids))
+
+    def test_no_indent(self, indent_array_measurement_factory):
+        measurement = indent_array_measurement_factory([])
+        measurement.values = measurement.values + 1e-8
+        analyzer = GDEFIndentAnalyzer(measurement)
+        assert analyzer.detect_indents() == []
+        assert not np.any(analyzer.indent_mask)
+
+
+class TestSubpixelCenterAndContactRadius:
+    @pytest.mark.parametrize("center", [(60.3, 70.6), (59.5, 71.2), (64.0, 64.0)])
+    def test_subpixel_minimum_position(self, center, indent_measurement_factory):
+        analyzer = GDEFIndentAnalyzer(indent_measurement_factory(center=center))
+        assert np.allclose(analyzer.get_subpixel_minimum_position(), center, atol=1e-6)
+
+    def test_radial_profile(self, indent_measurement):
+        analyzer = GDEFIndentAnalyzer(indent_measurement)
+        radius, profile = analyzer.get_radial_profile()
+        assert radius[0] == 0
+        assert np.allclose(np.diff(radius), 5e-8)
+        assert np.isclose(profile[0], -1e-7)
+        assert np.all(np.diff(profile[:15]) > 0)  # paraboloid
+
+    def test_contact_radius(self, indent_measurement):
+        analyzer = GDEFIndentAnalyzer(indent_measurement)
+        analyzer.analyze_indent(roughness_part=0.05)
+        result = analyzer.get_indent_result()
+
+        r = np.linspace(0, 2e-6, 200001)  # z(r) of the synthetic indent
+        z = -1e-7 * np.clip(1 - (r / 1e-6) ** 2, 0, None) + 2e-8 * np.exp(-((r - 1.2e-6) / 2e-7) ** 2)
+        expected = r[np.argmax(z >= -0.05e-7)]
+        assert np.isclose(result["contact_radius"], expected, rtol=0.03)
+        assert np.isclose(result["contact_area"], np.pi * result["contact_radius"] ** 2)
+
+    def test_detect_indents_subpixel(self, indent_measurement_factory, indent_array_measurement_factory):
+        centers = [(40.4, 50.2), (40.0, 130.7), (150.6, 50.5)]
+        analyzer = GDEFIndentAnalyzer(indent_array_measurement_factory(centers))
+        results = analyzer.detect_indents()
+        assert np.allclose([(result["center_row"], result["center_col"]) for result in results], centers, atol=1e-6)
+        single = GDEFIndentAnalyzer(indent_measurement_factory(center=(60.4, 70.2)))
+        single.analyze_indent()
+        assert np.isclose(results[0]["contact_radius"], single.get_indent_result()["contact_radius"], rtol=0.03)
@@ -7,7 +7,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pytest
 
-from afm_tools.background_correction import BGCorrectionType
+from afm_tools.background_correction import BGCorrectionType, BufferPool
+from gdef_reader.gdef_measurement import GDEFMeasurement, batch_correct_background, parallel_batch_correct_background
 
 
 def auto_show_fig(fig):
@@ -22,6 +23,22 @@ def gdef_settings(gdef_measurement):
     yield gdef_settings
 
 
+@pytest.fixture(scope='function')
+def synthetic_measurements(random_ndarray2d_data):
+    """topography measurements with tilted background and two different shapes (no *.gdf file needed)"""
+    result = []
+    for i, shape in enumerate([(64, 256), (32, 128), (64, 256), (64, 256)]):
+        measurement = GDEFMeasurement()
+        measurement.settings.source_channel = 11
+        measurement.gdf_block_id = i
+        values = random_ndarray2d_data[:shape[0], :shape[1]] + np.arange(shape[1]) * i * 1e-8
+        measurement._values_original = values
+        measurement._values_original.flags.writeable = False
+        measurement.values = values.copy()
+        result.append(measurement)
+    yield result
+
+
 class TestGDEFSettings:
     def test_pixel_width(self, gdef_settings):
         assert np.isclose(gdef_settings.pixel_width, 1.9531249506599124e-07)
@@ -127,3 +144,40 @@ class TestGDEFMeasurement:
         ]
 
         assert gdef_measurement.get_summary_table_data() == table_data  #[:6]
+
+
+@pytest.mark.parametrize("correction", [c for c in BGCorrectionType])
+def test_batch_correct_background(synthetic_measurements, correction):
+    batch_correct_background(synthetic_measurements, correction, keep_offset=True)
+    for measurement in synthetic_measurements:
+        assert measurement.background_correction_type == correction
+        expected = measurement.values.copy()
+        measurement.correct_background(correction, keep_offset=True)
+        assert np.allclose(measurement.values, expected)
+
+
+def test_batch_correct_background_with_buffer_pool(synthetic_measurements):
+    buffer_pool = BufferPool()
+    batch_correct_background(synthetic_measurements, BGCorrectionType.legendre_2, buffer_pool=buffer_pool)
+    pool_size = buffer_pool.nbytes
+    values_ids = [id(measurement.values) for measurement in synthetic_measurements]
+
+    batch_correct_background(synthetic_measurements, BGCorrectionType.surface_2, buffer_pool=buffer_pool)
+    assert buffer_pool.nbytes == pool_size  # buffers are reused
+    assert [id(measurement.values) for measurement in synthetic_measurements] == values_ids
+    for measurement in synthetic_measurements:
+        expected = measurement.values.copy()
+        measurement.correct_background(BGCorrectionType.surface_2)
+        assert np.allclose(measurement.values, expected)
+
+
+def test_parallel_batch_correct_background(synthetic_measurements):
+    progress = []
+    parallel_batch_correct_background(synthetic_measurements, BGCorrectionType.legendre_2, max_workers=2,
+                                      progress_callback=lambda done, total: progress.append((done, total)))
+    assert progress[-1] == (4, 4)
+    for measurement in synthetic_measurements:
+        assert measurement.background_correction_type == BGCorrectionType.legendre_2
+        expected = measurement.values.copy()
+        measurement.correct_background(BGCorrectionType.legendre_2)
+        assert np.allclose(measurement.values, expected)
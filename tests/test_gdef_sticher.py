@@ -0,0 +1,483 @@
+"""
+This file contains tests for gdef_sticher.py and correlation.py.
+@author: Nathanael Jöhrmann
+"""
+import numpy as np
+import pytest
+from scipy import ndimage, signal
+
+from afm_tools.correlation import cross_correlate, normalized_cross_correlate, correlation_at_positions
+from afm_tools.gdef_sticher import GDEFSticher, GDEFGridSticher, compose_mosaic, _resample_subpixel, blending_modes
+from gdef_reader.gdef_measurement import GDEFMeasurement
+
+
+def create_tile_measurements(surface: np.ndarray, positions, tile_shape) -> list:
+    """Cut measurements with tile_shape at positions (row, col) out of surface."""
+    result = []
+    for i, (row, col) in enumerate(positions):
+        measurement = GDEFMeasurement()
+        measurement.settings._pixel_width = 1e-7
+        measurement.settings._pixel_height = 1e-7
+        measurement.gdf_block_id = i
+        values = surface[row:row + tile_shape[0], col:col + tile_shape[1]].copy()
+        measurement._values_original = values
+        measurement.values = values.copy()
+        result.append(measurement)
+    return result
+
+
+@pytest.fixture(scope='session')
+def surface():
+    rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(2)))
+    yield (ndimage.gaussian_filter(rs.random((160, 420)), 1.5) - 0.5) * 1e-7  # zero mean like corrected data
+
+
+@pytest.fixture(scope='session')
+def grid_surface():
+    rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(8)))
+    yield (ndimage.gaussian_filter(rs.random((190, 240)), 1.5) - 0.5) * 1e-7
+
+
+@pytest.fixture(scope='function')
+def tile_measurements(surface):
+    yield create_tile_measurements(surface, [(10, 0), (12, 90), (15, 185), (15, 270)], (96, 128))
+
+
+class TestCrossCorrelate:
+    @pytest.mark.parametrize("shapes", [((20, 30), (20, 30)), ((17, 40), (23, 11))])
+    def test_fft_equals_direct(self, shapes):
+        rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(3)))
+        data01, data02 = rs.random(shapes[0]), rs.random(shapes[1])
+        assert np.allclose(cross_correlate(data01, data02, "fft"), signal.correlate2d(data01, data02))
+        assert np.array_equal(cross_correlate(data01, data02, "direct"), signal.correlate2d(data01, data02))
+
+    def test_nan(self):
+        rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(4)))
+        data01, data02 = rs.random((20, 30)), rs.random((15, 10))
+        data01[:5, :7] = np.nan
+        expected = signal.correlate2d(data01, data02)
+        result = cross_correlate(data01, data02, "fft")
+        assert np.array_equal(np.isnan(result), np.isnan(expected))
+        assert np.allclose(result, expected, equal_nan=True)
+
+    def test_nan_in_data02(self):
+        rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(4)))
+        data01, data02 = rs.random((20, 30)), rs.random((15, 10))
+        data02[-1, 3] = np.nan
+        result = cross_correlate(data01, data02, "fft")
+        expected = signal.correlate2d(data01, np.nan_to_num(data02))
+        nan_expected = signal.correlate2d(np.ones(data01.shape), np.isnan(data02)) > 0  # NaN only if in overlap
+        assert np.array_equal(np.isnan(result), nan_expected)
+        assert np.allclose(result[~nan_expected], expected[~nan_expected])
+
+    def test_unknown_method(self):
+        with pytest.raises(ValueError):
+            cross_correlate(np.ones((3, 3)), np.ones((3, 3)), "magic")
+
+
+def _normalized_cross_correlate_loop(data01: np.ndarray, data02: np.ndarray) -> np.ndarray:
+    """Reference implementation with np.corrcoef for each position."""
+    result = np.full((data01.shape[0] + data02.shape[0] - 1, data01.shape[1] + data02.shape[1] - 1), np.nan)
+    for (k, m), _ in np.ndenumerate(result):
+        y, x = k - data02.shape[0] + 1, m - data02.shape[1] + 1
+        row0, row1 = max(0, y), min(data01.shape[0], y + data02.shape[0])
+        col0, col1 = max(0, x), min(data01.shape[1], x + data02.shape[1])
+        overlap01 = data01[row0:row1, col0:col1]
+        overlap02 = data02[row0 - y:row1 - y, col0 - x:col1 - x]
+        if overlap01.size > 1 and np.std(overlap01) > 0 and np.std(overlap02) > 0:
+            result[k, m] = np.corrcoef(overlap01.ravel(), overlap02.ravel())[0, 1]
+    return result
+
+
+def _plane_residual(array2d: np.ndarray) -> np.ndarray:
+    """Reference implementation: array2d minus least squares plane (np.linalg.lstsq)."""
+    rows, cols = np.indices(array2d.shape)
+    design = np.stack([np.ones(array2d.size), rows.ravel(), cols.ravel()], axis=1)
+    coefficients = np.linalg.lstsq(design, array2d.ravel(), rcond=None)[0]
+    return array2d - (design @ coefficients).reshape(array2d.shape)
+
+
+def _detrended_cross_correlate_loop(data01: np.ndarray, data02: np.ndarray) -> np.ndarray:
+    """Reference implementation with np.corrcoef of plane residuals for each position."""
+    result = np.full((data01.shape[0] + data02.shape[0] - 1, data01.shape[1] + data02.shape[1] - 1), np.nan)
+    for (k, m), _ in np.ndenumerate(result):
+        y, x = k - data02.shape[0] + 1, m - data02.shape[1] + 1
+        row0, row1 = max(0, y), min(data01.shape[0], y + data02.shape[0])
+        col0, col1 = max(0, x), min(data01.shape[1], x + data02.shape[1])
+        residual01 = _plane_residual(data01[row0:row1, col0:col1])
+        residual02 = _plane_residual(data02[row0 - y:row1 - y, col0 - x:col1 - x])
+        if residual01.size > 1 and np.std(residual01) > 1e-6 and np.std(residual02) > 1e-9:
+            result[k, m] = np.corrcoef(residual01.ravel(), residual02.ravel())[0, 1]
+    return result
+
+
+class TestNormalizedCrossCorrelate:
+    @pytest.mark.parametrize("with_nan", [False, True])
+    def test_compare_to_loop(self, with_nan):
+        rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(6)))
+        data01, data02 = rs.random((12, 17)) + 3, rs.random((7, 9)) * 1e-3
+        if with_nan:
+            data01[2:4, 3:6] = np.nan
+            data02[0, 0] = np.nan
+        expected = _normalized_cross_correlate_loop(data01, data02)
+        result = normalized_cross_correlate(data01, data02)
+        assert np.array_equal(np.isnan(result), np.isnan(expected))
+        assert np.allclose(result, expected, equal_nan=True)
+
+        positions = [(-3, 4), (0, 0), (5, 10), (2, -8)]
+        expected_at_positions = [expected[y + 6, x + 8] for y, x in positions]
+        assert np.allclose(correlation_at_positions(data01, data02, positions, normalized=True),
+                           expected_at_positions, equal_nan=True)
+
+    def test_min_overlap(self):
+        rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(6)))
+        result = normalized_cross_correlate(rs.random((10, 10)), rs.random((10, 10)), min_overlap=50)
+        assert np.isnan(result[0, 0]) and np.isnan(result[3, 9])  # overlap 1 and 40 pixels
+        assert not np.isnan(result[4, 9]) and not np.isnan(result[9, 9])  # overlap 50 and 100 pixels
+
+    def test_detrend_compare_to_loop(self):
+        rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(6)))
+        data01, data02 = rs.random((12, 17)) + 3, rs.random((7, 9)) * 1e-3
+        expected = _detrended_cross_correlate_loop(data01, data02)
+        result = normalized_cross_correlate(data01, data02, detrend=True)
+        valid = ~np.isnan(expected)
+        assert np.allclose(result[valid], expected[valid])
+        assert np.all(np.isnan(result[[0, 0, -1, -1], [0, -1, 0, -1]]))  # single pixel overlap
+
+        positions = [(-3, 4), (0, 0), (5, 10), (2, -8)]
+        expected_at_positions = [expected[y + 6, x + 8] for y, x in positions]
+        assert np.allclose(correlation_at_positions(data01, data02, positions, normalized=True, detrend=True),
+                           expected_at_positions)
+
+    def test_detrend_ignores_tilt(self):
+        rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(6)))
+        data01, data02 = rs.random((12, 17)), rs.random((7, 9))
+        rows, cols = np.indices(data02.shape)
+        expected = normalized_cross_correlate(data01, data02, detrend=True)
+        result = normalized_cross_correlate(data01, data02 + 0.3 * rows - 0.2 * cols, detrend=True)
+        assert np.allclose(result, expected, equal_nan=True)
+        assert np.array_equal(cross_correlate(data01, data02, "ncc_plane"), expected, equal_nan=True)
+
+    def test_ncc_method(self):
+        rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(6)))
+        data01, data02 = rs.random((12, 17)), rs.random((7, 9))
+        assert np.array_equal(cross_correlate(data01, data02, "ncc"), normalized_cross_correlate(data01, data02),
+                              equal_nan=True)
+
+
+class TestGDEFSticher:
+    @pytest.mark.parametrize("method", ["direct", "fft"])
+    def test_stich(self, tile_measurements, surface, method):
+        sticher = GDEFSticher(tile_measurements, method=method)
+        expected = surface[10:10 + sticher.values.shape[0], :sticher.values.shape[1]]
+        assert sticher.values.shape == (96 + 5, 270 + 128)
+        assert np.allclose(sticher.values[-1, :128], np.nan, equal_nan=True)  # padding below first tile
+        valid = ~np.isnan(sticher.values)
+        assert np.allclose(sticher.values[valid], expected[valid])
+
+    def test_pair_offsets_and_positions(self, tile_measurements):
+        sticher = GDEFSticher(tile_measurements, max_workers=2)
+        assert sticher.pair_offsets == [(0, 1, 2, 90), (1, 2, 3, 95), (2, 3, 0, 85)]
+        assert np.array_equal(sticher.positions, [(0, 0), (2, 90), (5, 185), (5, 270)])
+
+    def test_tile_shifted_upwards(self, surface):
+        measurements = create_tile_measurements(surface, [(20, 0), (12, 90), (25, 180)], (96, 128))
+        sticher = GDEFSticher(measurements, method="ncc")
+        assert np.array_equal(sticher.positions, [(8, 0), (0, 90), (13, 180)])
+        valid = ~np.isnan(sticher.values)
+        assert np.allclose(sticher.values[valid], surface[12:12 + 109, :308][valid])
+
+    def test_memmap_canvas(self, tile_measurements, tmp_path):
+        expected = GDEFSticher(tile_measurements).values
+        sticher = GDEFSticher(tile_measurements, canvas_filename=tmp_path.joinpath("mosaic.npy"))
+        assert isinstance(sticher.values, np.memmap)
+        assert np.array_equal(sticher.values, expected, equal_nan=True)
+        assert np.array_equal(np.load(tmp_path.joinpath("mosaic.npy")), expected, equal_nan=True)
+
+    def test_compose_equals_incremental(self):
+        arrays = [np.ones((256, 256))] * 40
+        positions = [(0, 200 * i) for i in range(40)]
+        incremental = arrays[0]
+        for (y, x), array2d in zip(positions[1:], arrays[1:]):  # old GDEFSticher: growing result is copied each step
+            incremental = GDEFSticher._combine(incremental, array2d, y, x)
+        assert np.array_equal(compose_mosaic(arrays, positions), incremental)
+
+    def test_find_offset_fft_equals_direct(self, tile_measurements):
+        sticher = GDEFSticher(tile_measurements[:1])
+        data01, data02 = tile_measurements[0].values, tile_measurements[1].values
+        sticher.method = "direct"
+        y_direct, x_direct, _ = sticher._find_offset(data01, data02, 80)
+        sticher.method = "fft"
+        y_fft, x_fft, _ = sticher._find_offset(data01, data02, 80)
+        assert (y_fft, x_fft) == (y_direct, x_direct) == (2, 90)
+
+
+class TestCoarseToFine:
+    @pytest.mark.parametrize("n_levels", [2, 3])
+    def test_same_result_as_full_search(self, tile_measurements, n_levels):
+        expected = GDEFSticher(tile_measurements).values
+        result = GDEFSticher(tile_measurements, n_levels=n_levels).values
+        assert np.array_equal(result, expected, equal_nan=True)
+
+    @pytest.mark.parametrize("n_levels", [4, 6])
+    def test_small_tiles(self, surface, n_levels):
+        measurements = create_tile_measurements(surface, [(10, 0), (12, 90), (15, 185), (15, 270)], (96, 127))
+        sticher = GDEFSticher(measurements, method="ncc", n_levels=n_levels)
+        assert sticher._effective_n_levels((96, 44), (96, 127)) == 2  # search area 96 x 44 px
+        assert sticher.pair_offsets == [(0, 1, 2, 90), (1, 2, 3, 95), (2, 3, 0, 85)]
+
+    def test_large_tiles(self):
+        rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(5)))
+        surface = (ndimage.gaussian_filter(rs.random((1100, 1900)), 3) - 0.5) * 1e-7
+        measurements = create_tile_measurements(surface, [(20, 0), (33, 700)], (1024, 1024))
+        sticher = GDEFSticher(measurements[:1])
+        data01, data02 = measurements[0].values, measurements[1].values
+        offsets = {}
+        for n_levels in [1, 4]:
+            sticher.n_levels = n_levels
+            offsets[n_levels] = sticher._find_offset(data01, data02, 500)[:2]
+        assert offsets[1] == offsets[4] == (13, 700)
+
+
+class TestNCCSticher:
+    @pytest.fixture(scope='function')
+    def shifted_tile_measurements(self, tile_measurements):
+        """tiles with different z-offset and z-scale (e.g. drift or different calibration)"""
+        for i, measurement in enumerate(tile_measurements):
+            measurement.values = measurement.values * (1 + 0.3 * i) + 2e-8 * i
+        yield tile_measurements
+
+    @pytest.mark.parametrize("n_levels", [1, 3])
+    def test_ncc_with_z_offsets(self, shifted_tile_measurements, n_levels):
+        sticher = GDEFSticher(shifted_tile_measurements, method="ncc", n_levels=n_levels)
+        assert sticher.values.shape == (96 + 5, 270 + 128)
+        for measurement, (row, col) in zip(shifted_tile_measurements, [(0, 0), (2, 90), (5, 185), (5, 270)]):
+            assert np.array_equal(sticher.values[row:row + 96, col:col + 20], measurement.values[:, :20])
+
+    def test_ncc_plane_with_tilts(self, tile_measurements):
+        for i, measurement in enumerate(tile_measurements):
+            rows, cols = np.indices(measurement.values.shape)
+            measurement.values = measurement.values + (-1) ** i * 2e-9 * (rows + cols)
+        sticher = GDEFSticher(tile_measurements, method="ncc_plane", n_levels=2, subpixel=True)
+        assert np.allclose(sticher.positions, [(0, 0), (2, 90), (5, 185), (5, 270)], atol=0.1)
+
+    def test_raw_correlation_with_z_offsets(self, shifted_tile_measurements):
+        sticher = GDEFSticher(shifted_tile_measurements, method="fft")
+        assert sticher.values.shape != (96 + 5, 270 + 128)  # wrong offsets without normalization
+
+
+class TestGDEFGridSticher:
+    grid_positions = [[(10, 10), (12, 58), (9, 105), (11, 153)],
+                      [(58, 8), (60, 57), (57, 106), (59, 152)],
+                      [(105, 11), (107, 59), (106, 104), (108, 155)]]
+
+    @pytest.fixture(scope='function')
+    def grid(self, grid_surface):
+        measurements = create_tile_measurements(grid_surface, [pos for row in self.grid_positions for pos in row],
+                                                (64, 64))
+        yield [measurements[i:i + 4] for i in range(0, 12, 4)]
+
+    @pytest.mark.parametrize("method, n_levels", [("fft", 1), ("ncc", 1), ("ncc", 2)])
+    def test_stich_grid(self, grid, grid_surface, method, n_levels):
+        sticher = GDEFGridSticher(grid, method=method, n_levels=n_levels, max_workers=2)
+        expected_positions = np.array([pos for row in self.grid_positions for pos in row])
+        assert len(sticher.pair_offsets) == 3 * 3 + 2 * 4
+        assert np.array_equal(sticher.positions, expected_positions - expected_positions.min(axis=0))
+        row0, col0 = expected_positions.min(axis=0)
+        expected = grid_surface[row0:row0 + sticher.values.shape[0], col0:col0 + sticher.values.shape[1]]
+        valid = ~np.isnan(sticher.values)
+        assert sticher.values.shape == (108 + 64 - 9, 155 + 64 - 8)
+        assert np.allclose(sticher.values[valid], expected[valid])
+
+    def test_ragged_grid(self, grid):
+        sticher = GDEFGridSticher([grid[0], grid[1][:2]])
+        assert len(sticher.pair_offsets) == 3 + 1 + 2
+        assert np.array_equal(sticher.positions[4:], [[49, 0], [51, 49]])
+
+    def test_single_measurement(self, grid):
+        sticher = GDEFGridSticher([grid[0][:1]])
+        assert np.array_equal(sticher.values, grid[0][0].values)
+
+    def test_solve_positions_distributes_errors(self):
+        # 2 x 2 grid, offset from 0 to 1 is wrong by 4 px: least-squares error is distributed over the loop
+        pair_offsets = [(0, 1, 0, 54), (0, 2, 50, 0), (1, 3, 50, 0), (2, 3, 0, 50)]
+        positions = GDEFGridSticher.solve_positions(4, pair_offsets)
+        assert np.array_equal(positions, [[0, 0], [0, 53], [50, 1], [50, 52]])
+
+    def test_compose_mosaic(self):
+        result = compose_mosaic([np.zeros((2, 3)), np.ones((2, 2))], [(5, 5), (4, 7)])
+        assert result.shape == (3, 4)
+        assert np.array_equal(result, [[np.nan, np.nan, 1, 1], [0, 0, 1, 1], [0, 0, 0, np.nan]], equal_nan=True)
+
+
+def create_subpixel_tile_measurements(surface: np.ndarray, positions, tile_shape) -> list:
+    """Like create_tile_measurements, but positions (row, col) can be sub-pixel values (cubic spline interpolation)."""
+    result = []
+    for i, (row, col) in enumerate(positions):
+        shifted = ndimage.shift(surface, (-(row % 1), -(col % 1)), order=3)
+        result.extend(create_tile_measurements(shifted, [(int(row), int(col))], tile_shape))
+        result[-1].gdf_block_id = i
+    return result
+
+
+@pytest.fixture(scope='session')
+def smooth_surface():
+    rs = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(9)))
+    yield (ndimage.gaussian_filter(rs.random((140, 260)), 2.5) - 0.5) * 1e-7
+
+
+class TestSubpixel:
+    @pytest.mark.parametrize("method, n_levels", [("fft", 1), ("ncc", 1), ("ncc", 2)])
+    def test_subpixel_offset(self, smooth_surface, method, n_levels):
+        measurements = create_subpixel_tile_measurements(smooth_surface, [(10, 0), (12.3, 90.6)], (96, 128))
+        sticher = GDEFSticher(measurements[:1], method=method, n_levels=n_levels, subpixel=True)
+        y, x, _ = sticher._find_offset(measurements[0].values, measurements[1].values, 80)
+        assert abs(y - 2.3) < 0.1 and abs(x - 90.6) < 0.1
+        sticher.subpixel = False
+        assert sticher._find_offset(measurements[0].values, measurements[1].values, 80)[:2] in [(2, 90), (2, 91)]
+
+    def test_stich_subpixel(self, smooth_surface):
+        measurements = create_subpixel_tile_measurements(smooth_surface, [(10, 0), (12.3, 90.6)], (96, 128))
+        sticher = GDEFSticher(measurements, method="ncc", subpixel=True)
+        assert sticher.values.shape == (96 + 2, 91 + 127)  # first row and column of resampled tile are lost
+        expected = smooth_surface[10:10 + 98, :218]
+        valid = ~np.isnan(sticher.values)
+        seam_error = np.abs(sticher.values[valid] - expected[valid]).max()
+        integer_sticher = GDEFSticher(measurements, method="ncc")
+        integer_error = np.nanmax(np.abs(integer_sticher.values - smooth_surface[10:10 + 98, :219]))
+        assert seam_error < 0.3 * integer_error
+
+    def test_resample_subpixel_linear(self):
+        rows, cols = np.mgrid[0:6, 0:8]
+        ramp = (rows + 2 * cols).astype(np.float64)
+        result = _resample_subpixel(ramp, 0.25, 0.5)
+        assert result.shape == (5, 7)
+        assert np.allclose(result, (rows[1:, 1:] - 0.25) + 2 * (cols[1:, 1:] - 0.5))
+        assert np.array_equal(_resample_subpixel(ramp, 0, 0), ramp)
+
+    def test_compose_mosaic_subpixel(self):
+        result = compose_mosaic([np.zeros((3, 3)), np.ones((3, 3))], [(0, 0), (-0.5, 2.5)])
+        # positions are shifted to (1, 0) and (0.5, 2.5); resampled second array (2 x 2) starts at (1, 3)
+        assert result.shape == (4, 5)
+        assert np.array_equal(result[1:, :3], np.zeros((3, 3)))
+        assert np.array_equal(result[1:3, 3:], np.ones((2, 2)))
+        assert np.all(np.isnan(result[0]))
+
+    def test_grid_subpixel(self, smooth_surface):
+        positions = [(5, 3), (6.4, 50.2), (52.7, 4.5), (51.1, 52.8)]
+        measurements = create_subpixel_tile_measurements(smooth_surface, positions, (64, 64))
+        sticher = GDEFGridSticher([measurements[:2], measurements[2:]], method="ncc", subpixel=True)
+        expected = np.array(positions) - np.floor(np.min(positions, axis=0))
+        assert np.allclose(sticher.positions, expected, atol=0.15)
+
+
+class TestBlending:
+    @pytest.mark.parametrize("blending", blending_modes)
+    def test_stich_identical_overlap(self, tile_measurements, surface, blending):
+        sticher = GDEFSticher(tile_measurements, blending=blending)
+        expected = surface[10:10 + sticher.values.shape[0], :sticher.values.shape[1]]
+        valid = ~np.isnan(sticher.values)
+        assert np.array_equal(valid, ~np.isnan(GDEFSticher(tile_measurements).values))
+        assert np.allclose(sticher.values[valid], expected[valid])
+
+    def test_mean(self):
+        data02 = np.ones((2, 4))
+        data02[0, 0] = np.nan  # NaN values are ignored
+        result = compose_mosaic([np.zeros((2, 4)), data02], [(0, 0), (0, 2)], blending="mean")
+        assert np.array_equal(result, [[0, 0, 0, 0.5, 1, 1], [0, 0, 0.5, 0.5, 1, 1]])
+
+    @pytest.mark.parametrize("blending", ["feather", "distance"])
+    def test_seam(self, blending):
+        arrays = [np.zeros((20, 30)), np.ones((20, 30))]
+        result = compose_mosaic(arrays, [(0, 0), (0, 20)], blending=blending)
+        overlap = result[10, 19:31]
+        assert overlap[0] == 0 and overlap[-1] == 1
+        assert np.all(np.diff(overlap) > 0) and np.all(np.diff(overlap) < 0.2)  # smooth transition
+        assert np.allclose(overlap + overlap[::-1], 1)  # symmetric
+        assert np.max(np.abs(np.diff(compose_mosaic(arrays, [(0, 0), (0, 20)]), axis=1))) == 1  # "last": hard seam
+
+    @pytest.mark.parametrize("blending", ["mean", "feather", "distance"])
+    def test_memmap(self, tmp_path, monkeypatch, blending):
+        arrays = [np.zeros((5, 6)), np.ones((5, 6))]
+        expected = compose_mosaic(arrays, [(0, 0), (1, 3)], blending=blending)
+        memmap_shapes = []
+        open_memmap = np.lib.format.open_memmap
+
+        def counting_open_memmap(*args, **kwargs):
+            memmap_shapes.append(kwargs["shape"])
+            return open_memmap(*args, **kwargs)
+
+        monkeypatch.setattr(np.lib.format, "open_memmap", counting_open_memmap)
+        monkeypatch.setattr(np, "zeros", None)  # no canvas in memory
+        result = compose_mosaic(arrays, [(0, 0), (1, 3)], tmp_path.joinpath("mosaic.npy"), blending=blending)
+        assert memmap_shapes == [(6, 9), (6, 9)]  # result and weight canvas on disk
+        assert np.array_equal(result, expected, equal_nan=True)
+        assert [file.name for file in tmp_path.iterdir()] == ["mosaic.npy"]  # temporary weight file is removed
+
+    def test_unknown_blending(self):
+        with pytest.raises(ValueError):
+            compose_mosaic([np.ones((2, 2))], [(0, 0)], blending="magic")
+
+
+class TestOffsets:
+    @staticmethod
+    def no_correlation(*args, **kwargs):
+        raise AssertionError("cross-correlation should not be calculated")
+
+    def test_save_and_load(self, tile_measurements, tmp_path, monkeypatch):
+        filename = tmp_path.joinpath("offsets.json")
+        expected = GDEFSticher(tile_measurements, method="ncc", offsets_filename=filename)
+        assert filename.exists()
+        monkeypatch.setattr(GDEFSticher, "_find_offset", self.no_correlation)
+        sticher = GDEFSticher(tile_measurements, method="ncc", offsets_filename=filename)
+        assert sticher.pair_offsets == expected.pair_offsets
+        assert np.array_equal(sticher.values, expected.values, equal_nan=True)
+
+    def test_key(self, tile_measurements, tmp_path):
+        filename = tmp_path.joinpath("offsets.json")
+        sticher = GDEFSticher(tile_measurements, offsets_filename=filename)
+        key = sticher.offsets_key()
+        for measurement in tile_measurements:  # key depends on values_original only
+            measurement.values = measurement.values + 1e-8
+        assert sticher.offsets_key() == key
+        sticher.method = "ncc"
+        assert sticher.offsets_key() != key
+        assert sticher.load_offsets(filename) is None
+        assert GDEFSticher(tile_measurements[::-1][:1]).offsets_key() != key
+        sticher.save_offsets(filename)  # entries for other parameters are kept
+        sticher.method = "fft"
+        assert sticher.load_offsets(filename) == sticher.pair_offsets
+
+    def test_damaged_file(self, tile_measurements, tmp_path):
+        filename = tmp_path.joinpath("offsets.json")
+        filename.write_text("{no json")
+        sticher = GDEFSticher(tile_measurements, offsets_filename=filename)
+        assert sticher.load_offsets(filename) == sticher.pair_offsets
+
+    def test_from_offsets_other_channel(self, tile_measurements, monkeypatch):
+        topography = GDEFSticher(tile_measurements)
+        channel = create_tile_measurements(np.arange(160 * 420, dtype=np.float64).reshape(160, 420),
+                                           [(10, 0), (12, 90), (15, 185), (15, 270)], (96, 128))
+        monkeypatch.setattr(GDEFSticher, "_find_offset", self.no_correlation)
+        sticher = GDEFSticher.from_offsets(channel, topography.pair_offsets)
+        assert np.array_equal(sticher.positions, topography.positions)
+        valid = ~np.isnan(sticher.values)
+        assert np.array_equal(sticher.values[valid], np.arange(160 * 420).reshape(160, 420)[10:111, :398][valid])
+
+    def test_compose_after_background_correction(self, tile_measurements, monkeypatch):
+        sticher = GDEFSticher(tile_measurements)
+        expected = sticher.values + 1e-8
+        monkeypatch.setattr(GDEFSticher, "_find_offset", self.no_correlation)
+        for measurement in tile_measurements:
+            measurement.values = measurement.values + 1e-8
+        assert np.allclose(sticher.compose(), expected, equal_nan=True)
+
+    def test_grid_from_offsets(self, grid_surface, tmp_path):
+        measurements = create_tile_measurements(grid_surface, TestGDEFGridSticher.grid_positions[0]
+                                                + TestGDEFGridSticher.grid_positions[1], (64, 64))
+        grid = [measurements[:4], measurements[4:]]
+        filename = tmp_path.joinpath("offsets.json")
+        expected = GDEFGridSticher(grid, subpixel=True, offsets_filename=filename)
+        sticher = GDEFGridSticher.from_offsets(grid, expected.load_offsets(filename), subpixel=True)
+        assert np.allclose(sticher.positions, expected.positions)
+        assert np.array_equal(sticher.values, expected.values, equal_nan=True)
@@ -0,0 +1,84 @@
+"""
+This file contains tests for indent_batch_analysis.py.
+@author: Nathanael Jöhrmann
+"""
+import csv
+import pickle
+
+import numpy as np
+import pytest
+
+from afm_tools.gdef_indent_analyzer import GDEFIndentAnalyzer
+from afm_tools.indent_batch_analysis import analyze_indents, save_indent_results, indent_result_fields, \
+    find_measurement_files
+
+
+@pytest.fixture(scope='function')
+def pygdf_folder(tmp_path, indent_measurement_factory):
+    for i, center in enumerate([(60, 70), (50, 80), (64, 64)]):
+        measurement = indent_measurement_factory(center=center)
+        measurement.settings.source_channel = 11
+        measurement.gdf_basename = "indents"
+        measurement.gdf_block_id = i
+        measurement.comment = f"indent {i}"
+        with open(tmp_path.joinpath(f"indents_block_{i:04}.pygdf"), 'wb') as file:
+            pickle.dump(measurement, file)
+    tmp_path.joinpath("notes.txt").write_text("not a measurement")
+    yield tmp_path
+
+
+def test_find_measurement_files(pygdf_folder):
+    assert [file.name for file in find_measurement_files(pygdf_folder)] == \
+           [f"indents_block_{i:04}.pygdf" for i in range(3)]
+
+
+def test_analyze_indents(pygdf_folder, indent_measurement_factory):
+    progress = []
+    results = analyze_indents(pygdf_folder, max_workers=2,
+                              progress_callback=lambda done, total: progress.append((done, total)))
+    assert progress[-1] == (3, 3)
+    assert [row["name"] for row in results] == [f"indents_block_{i:04}" for i in range(3)]
+    for row in results:
+        assert list(row) == indent_result_fields
+
+    analyzer = GDEFIndentAnalyzer(indent_measurement_factory(center=(60, 70)))
+    analyzer.analyze_indent()
+    expected = analyzer.get_indent_result()
+    for key, value in expected.items():
+        assert np.isclose(results[0][key], value)
+
+
+@pytest.mark.parametrize("suffix", [".csv", ".npy"])
+def test_save_indent_results(pygdf_folder, suffix):
+    results = analyze_indents(pygdf_folder, max_workers=1)
+    filename = pygdf_folder.joinpath("results" + suffix)
+    save_indent_results(results, filename)
+    if suffix == ".csv":
+        with open(filename, newline='') as file:
+            rows = list(csv.DictReader(file))
+        indent_area = [float(row["indent_area"]) for row in rows]
+        names = [row["name"] for row in rows]
+    else:
+        table = np.load(filename)
+        assert table.dtype.names == tuple(indent_result_fields)
+        indent_area = table["indent_area"]
+        names = list(table["name"])
+    assert np.allclose(indent_area, [row["indent_area"] for row in results])
+    assert names == [row["name"] for row in results]
+
+
+def test_save_indent_results_unknown_suffix(tmp_path):
+    with pytest.raises(ValueError):
+        save_indent_results([], tmp_path.joinpath("results.txt"))
+
+
+def test_analyze_indents_multi_indent(tmp_path, indent_array_measurement_factory):
+    measurement = indent_array_measurement_factory([(40, 50), (40, 130), (150, 50), (150, 130)])
+    measurement.settings.source_channel = 11
+    measurement.gdf_block_id = 0
+    with open(tmp_path.joinpath("array.pygdf"), 'wb') as file:
+        pickle.dump(measurement, file)
+    results = analyze_indents(tmp_path, multi_indent=True, max_workers=1)
+    assert [row["indent_id"] for row in results] == [0, 1, 2, 3]
+    save_indent_results(results, tmp_path.joinpath("results.npy"))
+    assert list(np.load(tmp_path.joinpath("results.npy"))["indent_id"]) == [0, 1, 2, 3]
@@ -0,0 +1,76 @@
+"""
+This file contains tests for indent_result_cache.py.
+@author: Nathanael Jöhrmann
+"""
+import os
+
+import numpy as np
+import pytest
+
+from afm_tools.background_correction import BGCorrectionType
+from afm_tools.gdef_indent_analyzer import GDEFIndentAnalyzer
+from afm_tools.indent_result_cache import IndentResultCache
+
+
+@pytest.fixture(scope='function')
+def cache(tmp_path):
+    yield IndentResultCache(tmp_path)
+
+
+class TestIndentResultCache:
+    def test_analyze(self, cache, monkeypatch, indent_measurement_factory):
+        measurement = indent_measurement_factory()
+        analyzer = GDEFIndentAnalyzer(measurement)
+        result = cache.analyze(analyzer, roughness_part=0.05)
+        indent_mask, pileup_mask = analyzer.indent_mask.copy(), analyzer.pileup_mask.copy()
+        summary = analyzer.get_summary_table_data()
+
+        cached_analyzer = GDEFIndentAnalyzer(measurement)
+        monkeypatch.setattr(cached_analyzer, "analyze_indent", None)  # analysis has to be skipped
+        assert cache.analyze(cached_analyzer, roughness_part=0.05) == result
+        assert np.array_equal(cached_analyzer.indent_mask, indent_mask)
+        assert np.array_equal(cached_analyzer.pileup_mask, pileup_mask)
+        assert cached_analyzer.get_summary_table_data(result) == summary
+
+    def test_key(self, indent_measurement_factory):
+        measurement = indent_measurement_factory()
+        key = IndentResultCache.key(measurement, 0.05)
+        assert key == IndentResultCache.key(indent_measurement_factory(), 0.05)
+        assert key != IndentResultCache.key(measurement, 0.1)
+        assert key != IndentResultCache.key(indent_measurement_factory(center=(61, 70)), 0.05)
+        measurement.settings.source_channel = 11  # background is only corrected for topography
+        measurement.correct_background(BGCorrectionType.legendre_1)
+        assert key != IndentResultCache.key(measurement, 0.05)
+
+    def test_keep_offset_changes_key(self, cache, indent_measurement_factory):
+        measurement = indent_measurement_factory()
+        measurement.settings.source_channel = 11  # background is only corrected for topography
+        measurement.correct_background(BGCorrectionType.legendre_1, keep_offset=False)
+        cache.analyze(GDEFIndentAnalyzer(measurement))
+        measurement.correct_background(BGCorrectionType.legendre_1, keep_offset=True)
+        analyzer = GDEFIndentAnalyzer(measurement)
+        assert cache.get(analyzer, 0.05) is None
+        fresh_analyzer = GDEFIndentAnalyzer(measurement)
+        fresh_analyzer.analyze_indent(0.05)
+        assert cache.analyze(analyzer) == fresh_analyzer.get_indent_result()
+
+    def test_get_missing_entry(self, cache, indent_measurement_factory):
+        assert cache.get(GDEFIndentAnalyzer(indent_measurement_factory()), 0.05) is None
+
+    def test_evict_by_size(self, cache, indent_measurement_factory):
+        measurements = [indent_measurement_factory(center=(50 + i, 60)) for i in range(5)]
+        filenames = []
+        for i, measurement in enumerate(measurements):
+            cache.analyze(GDEFIndentAnalyzer(measurement))
+            filenames.append(cache._filename(cache.key(measurement, 0.05)))
+            os.utime(filenames[-1], (1e9 + i, 1e9 + i))  # explicit access times (mtime resolution might be coarse)
+        assert cache.get(GDEFIndentAnalyzer(measurements[0]), 0.05) is not None  # marks oldest entry as used
+        cache.max_size = int(2.5 * cache.nbytes / 5)  # compressed entries have slightly different sizes
+        cache._evict()
+        assert cache.nbytes <= cache.max_size
+        assert [filename.exists() for filename in filenames] == [True, False, False, False, True]
+
+    def test_clear(self, cache, indent_measurement_factory):
+        cache.analyze(GDEFIndentAnalyzer(indent_measurement_factory()))
+        cache.clear()
+        assert cache.nbytes == 0
@@ -0,0 +1,37 @@
+"""
+This file contains tests for parallel_correction.py.
+@author: Nathanael Jöhrmann
+"""
+import numpy as np
+import pytest
+
+from afm_tools.background_correction import BGCorrectionType, correct_background
+from afm_tools.parallel_correction import parallel_correct_background
+
+
+@pytest.fixture(scope='function')
+def arrays(random_ndarray2d_data):
+    result = []
+    for i, shape in enumerate([(64, 128), (32, 64), (64, 128), (64, 128), (32, 64), (64, 128)]):
+        result.append(random_ndarray2d_data[:shape[0], :shape[1]] + np.arange(shape[1]) * i * 1e-8)
+    yield result
+
+
+@pytest.mark.parametrize("correction", [BGCorrectionType.legendre_1, BGCorrectionType.surface_2,
+                                        BGCorrectionType.line_median])
+def test_parallel_correct_background(arrays, correction):
+    originals = [array2d.copy() for array2d in arrays]
+    result = parallel_correct_background(arrays, correction, keep_offset=True, max_workers=2, chunk_size=1)
+    assert len(result) == len(arrays)
+    for array2d, original, corrected in zip(arrays, originals, result):
+        assert np.array_equal(array2d, original)  # input is not changed
+        assert np.allclose(corrected, correct_background(array2d, correction, keep_offset=True))
+
+
+def test_progress_callback(arrays):
+    progress = []
+    parallel_correct_background(arrays, BGCorrectionType.legendre_1, max_workers=2, chunk_size=2,
+                                progress_callback=lambda done, total: progress.append((done, total)))
+    assert progress[-1] == (len(arrays), len(arrays))
+    assert len(progress) == 3  # one call per task: 4 arrays of shape (64, 128) and 2 of shape (32, 64)
+    assert [done for done, _ in progress] == sorted(done for done, _ in progress)
@@ -0,0 +1,28 @@
+"""
+This file contains tests for peak_utils.py.
+@author: Nathanael Jöhrmann
+"""
+import numpy as np
+
+from afm_tools.peak_utils import subpixel_minimum_positions
+
+
+class TestSubpixelMinimumPositions:
+    def test_parabola(self):
+        cols = np.arange(7)
+        values = np.add.outer((np.arange(5) - 2.25) ** 2, (cols - 3.4) ** 2)
+        assert np.allclose(subpixel_minimum_positions(values, (2, 3)), [[2.25, 3.4]])
+
+    def test_several_positions(self):
+        values = np.ones((6, 6))
+        values[2, 2], values[2, 3] = 0, 0.5
+        values[4, 4] = -1
+        result = subpixel_minimum_positions(values, [(2, 2), (4, 4)])
+        assert result.shape == (2, 2)
+        assert np.allclose(result, [[2, 2 + 0.5 / 3], [4, 4]])
+
+    def test_at_border(self):
+        values = np.ones((5, 5))
+        values[0, 2] = 0
+        values[0, 3] = 0.5
+        assert np.allclose(subpixel_minimum_positions(values, (0, 2)), [[0, 2 + 0.5 / 3]])  # row 0 is not refined
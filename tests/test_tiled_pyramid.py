@@ -0,0 +1,71 @@
+"""
+This file contains tests for tiled_pyramid.py.
+@author: Nathanael Jöhrmann
+"""
+import numpy as np
+import pytest
+
+from afm_tools.tiled_pyramid import TiledPyramid, downsample_nanmean
+
+
+@pytest.fixture(scope='function')
+def data_with_nan(random_ndarray2d_data):
+    data = np.hstack([random_ndarray2d_data, random_ndarray2d_data[:, :90]])  # shape (256, 346)
+    data[:20, 300:] = np.nan  # padding like in GDEFSticher.values
+    yield data
+
+
+@pytest.fixture(scope='function')
+def tiled_pyramid(data_with_nan, tmp_path):
+    yield TiledPyramid.create(data_with_nan, tmp_path, pixel_width=2e-7, tile_size=64)
+
+
+class TestDownsampleNanmean:
+    def test_downsample_nanmean(self):
+        data = np.array([[1., 3., 5.],
+                         [np.nan, 2., 7.]])
+        result = downsample_nanmean(data)
+        assert result.shape == (1, 2)
+        assert np.allclose(result, [[2., 6.]])
+
+    def test_all_nan_block(self):
+        data = np.full((4, 4), np.nan)
+        data[0, 0] = 1.
+        result = downsample_nanmean(data)
+        assert result[0, 0] == 1.
+        assert np.isnan(result[1, 1])
+
+
+class TestTiledPyramid:
+    def test_create(self, tiled_pyramid, data_with_nan):
+        assert tiled_pyramid.shape == data_with_nan.shape
+        assert tiled_pyramid.n_levels == 4  # 346 px -> 173 -> 87 -> 44 (fits into one tile)
+        assert tiled_pyramid.level_shape(1) == (128, 173)
+
+    def test_read_region_level_0(self, tiled_pyramid, data_with_nan):
+        assert np.array_equal(tiled_pyramid.read_region(), data_with_nan, equal_nan=True)
+        region = tiled_pyramid.read_region(10, 100, 250, 330)
+        assert np.array_equal(region, data_with_nan[10:100, 250:330], equal_nan=True)
+
+    def test_read_region_coarse_levels(self, tiled_pyramid, data_with_nan):
+        level_1 = downsample_nanmean(data_with_nan)
+        assert np.allclose(tiled_pyramid.read_region(level=1), level_1, equal_nan=True)
+        assert np.allclose(tiled_pyramid.read_region(0, 128, 64, 200, level=1), level_1[:64, 32:100], equal_nan=True)
+        level_2 = downsample_nanmean(level_1)
+        assert np.allclose(tiled_pyramid.read_region(level=2), level_2, equal_nan=True)
+
+    def test_reopen(self, tiled_pyramid, data_with_nan, tmp_path):
+        pyramid = TiledPyramid(tmp_path)
+        assert pyramid.shape == tiled_pyramid.shape
+        assert np.array_equal(pyramid.read_region(5, 50, 5, 50), data_with_nan[5:50, 5:50], equal_nan=True)
+
+    def test_best_level(self, tiled_pyramid):
+        assert tiled_pyramid.best_level((256, 346)) == 0
+        assert tiled_pyramid.best_level((128, 200)) == 1
+        assert tiled_pyramid.best_level((64, 64), region_shape=(128, 128)) == 1
+        assert tiled_pyramid.best_level((1, 1)) == tiled_pyramid.n_levels - 1
+
+    def test_values_and_pixel_width(self, tiled_pyramid):
+        tiled_pyramid.display_level = 2
+        assert tiled_pyramid.values.shape == tiled_pyramid.level_shape(2)
+        assert np.isclose(tiled_pyramid.pixel_width, 8e-7)